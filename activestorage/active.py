@@ -0,0 +1,169 @@
+"""
+The user-facing entry point: load a netCDF variable, or a reduction of it.
+
+>>> load('tas.nc', 'tas')  # doctest: +SKIP
+masked_array(...)
+>>> load('tas.nc', 'tas', operation='max')  # doctest: +SKIP
+312.4
+
+A global mean time series over the ocean, weighted by the cell areas
+of another file (whose missing values over land have no weight):
+
+>>> load('tos.nc', 'tos', 'mean', axis=(1, 2),
+...      weights=('areacello.nc', 'areacello'))  # doctest: +SKIP
+
+Reductions are computed next to the data (see
+`activestorage.netcdf_array.NetCDFArray`) and their results cached
+(see `activestorage.cache`), so asking the same question of the same
+file again costs a dictionary lookup.
+"""
+import hashlib
+import time
+
+import numpy as np
+
+from activestorage import stats
+from activestorage.cache import cache_key, default_cache, file_identity
+from activestorage.chunks import orthogonal_index
+from activestorage.handles import dataset_pool
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.plan import normalise_indices, subspace_dimensions
+from activestorage.planner import default_planner
+from activestorage.reductions import (
+    check_operation,
+    finalise,
+    normalise_axis,
+    partial_reduce,
+)
+
+
+def _weights(filepath, weights):
+    """
+    Return the weights of a reduction and what identifies them.
+
+    ``weights`` is an array, the name of a variable in ``filepath`` or
+    a ``(filename, ncvar)`` pair; the values of variables are read once
+    per grid (see `activestorage.handles.DatasetPool.weights`).
+    """
+    if isinstance(weights, str):
+        weights = (filepath, weights)
+    if isinstance(weights, tuple) and len(weights) == 2 \
+            and all(isinstance(name, str) for name in weights):
+        filename, ncvar = weights
+        return (dataset_pool().weights(filename, ncvar),
+                file_identity(filename) + [ncvar])
+
+    weights = np.ma.filled(weights, 0)
+    digest = hashlib.sha256(np.ascontiguousarray(weights).tobytes())
+    return weights, [list(weights.shape), weights.dtype.str,
+                     digest.hexdigest()]
+
+
+def load(filepath, ncvar, operation=None, indices=Ellipsis, axis=None,
+         mask=True, group=None, cache=None, active=True, active_client=None,
+         weights=None, planner=None):
+    """
+    Return a subspace of a netCDF variable, or a reduction of it.
+
+    Parameters
+    ----------
+    filepath: str, the netCDF file
+    ncvar: str, the netCDF variable
+    operation: str, one of ``activestorage.reductions.OPERATIONS`` or
+        ``SKETCHES`` (e.g. ``'quantile(0.95)'``), or None to return the
+        data themselves
+    indices: the subspace, by default the whole variable
+    axis: int, tuple of int or None (all axes), the axes of the
+        subspace to reduce; axes may also be named by their
+        dimensions, e.g. ``axis='time'`` for a time mean
+    mask: bool, whether missing data are masked or ignored
+    group: sequence of str, the variable's group, as for
+        `NetCDFArray`
+    cache: `activestorage.cache.ResultCache`, or False to not cache; by
+        default the process-wide in-memory cache
+    active: bool, reduce the data next to the storage; if False the
+        subspace is read in full and reduced here. If ``'auto'``, the
+        quicker of the two is chosen by the ``planner``
+    active_client: `activestorage.client.ActiveStorageClient`, the
+        server to reduce the data on, by default they are reduced here
+    weights: the weights of the reduction, that broadcast against the
+        variable: an array, the name of a variable in the same file,
+        or a ``(filename, ncvar)`` pair such as a cell area variable.
+        Sums and means are weighted, and elements with zero weight (or
+        a missing weight) are ignored by every operation.
+    planner: `activestorage.planner.Planner`, the planner of
+        ``active='auto'``, by default the process-wide planner
+
+    Returns
+    -------
+    numpy array (masked where there were no valid data), or a scalar if
+    every axis is reduced
+    """
+    array = NetCDFArray(filename=filepath, ncvar=ncvar, group=group,
+                        mask=mask, active_client=active_client)
+    if operation is None:
+        return array[indices]
+
+    check_operation(operation)
+    metadata = dataset_pool().metadata(filepath, ncvar, group)
+    subspace = normalise_indices(indices, metadata.shape)
+    axis = normalise_axis(
+        axis, sum(not isinstance(index, int) for index in subspace),
+        subspace_dimensions(metadata.dimensions, subspace))
+    if cache is None:
+        cache = default_cache()
+
+    identity = None
+    if weights is not None:
+        weights, identity = _weights(filepath, weights)
+
+    key = partial = None
+    if cache is not False:
+        key = cache_key(filepath, ncvar, metadata.shape, indices, operation,
+                        axis=axis, mask=mask, group=group, weights=identity)
+        start = time.perf_counter()
+        partial = cache.get(key)
+        if partial is not None:
+            # only hits are answered by the cache
+            with stats.record(operation, filepath, ncvar,
+                              route='cache') as request:
+                request.add_time('cache', time.perf_counter() - start)
+                request.add(bytes_returned=sum(
+                    values.nbytes for values in partial.values()))
+
+    if partial is None:
+        decision = None
+        if active == 'auto':
+            if planner is None:
+                planner = default_planner()
+            decision = planner.plan(filepath, ncvar, operation, indices,
+                                    axis, group=group,
+                                    active_client=active_client,
+                                    weighted=weights is not None)
+            active = decision.active
+
+        start = time.perf_counter()
+        if active:
+            array.active_method = operation
+            array.active_axis = axis
+            array.active_weights = weights
+            partial = array[indices]
+        else:
+            if weights is not None:
+                weights = orthogonal_index(
+                    np.broadcast_to(weights, metadata.shape),
+                    normalise_indices(indices, metadata.shape))
+            partial = partial_reduce(array[indices], operation, axis,
+                                     weights=weights)
+        if decision is not None:
+            planner.observe(decision, time.perf_counter() - start)
+        if cache is not False:
+            cache.put(key, partial)
+
+    result = finalise(partial, operation)
+    axis = normalise_axis(axis, result.ndim)
+    result = result.reshape([n for i, n in enumerate(result.shape)
+                             if i not in axis])
+    if not result.ndim:
+        return result[()]
+    return result
@@ -0,0 +1,265 @@
+"""
+A netCDF variable split across many files, presented as one array.
+
+Model output is usually split along time into many files, e.g. one per
+decade of a CMIP6 member. `AggregatedDataset` concatenates the variable
+of each file along its first (time) axis:
+
+>>> tas = AggregatedDataset('tas_Amon_*_r1i1p1f1_*.nc',
+...                         'tas')  # doctest: +SKIP
+>>> tas.shape  # doctest: +SKIP
+(1980, 144, 192)
+>>> tas.reduce('mean', indices=slice(120, 600),
+...            axis=(1, 2))  # doctest: +SKIP
+
+Each file's range of the time axis is indexed when the dataset is
+made, so a subspace or reduction only touches the files that overlap
+it. A reduction makes one active request (see
+`activestorage.netcdf_array.NetCDFArray`) per overlapping file, in a
+pool of threads, and merges their partial results.
+"""
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from activestorage.handles import dataset_pool
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.plan import (
+    index_size,
+    intersect,
+    normalise_indices,
+    subspace_dimensions,
+)
+from activestorage.reductions import (
+    check_operation,
+    empty_partial,
+    finalise,
+    merge_partials,
+    normalise_axis,
+    weighted_dtype,
+)
+
+
+class AggregatedDataset:
+    """
+    A netCDF variable concatenated along its first axis from many files.
+
+    Like `NetCDFArray`, indexing returns the data of a subspace or, if
+    ``active_method`` is set, the partial result of that reduction over
+    it, so an `AggregatedDataset` can also be given to
+    ``dask.array.from_array``.
+    """
+
+    def __init__(self, files, ncvar, group=None, mask=True,
+                 max_workers=None, active_client=None, executor=None):
+        """
+        Parameters
+        ----------
+        files: str, a glob pattern matching the files (which are taken
+            in sorted order, as CMIP file names sort by date), or a
+            sequence of file names in the order to concatenate them
+        ncvar: str, the netCDF variable
+        group: sequence of str, the variable's group, as for
+            `NetCDFArray`
+        mask: bool, whether missing data are masked or ignored
+        max_workers: int, the number of files reduced at once, by
+            default the number of CPUs
+        active_client: `activestorage.client.ActiveStorageClient`, the
+            server to reduce each file's data on, if any
+        executor: what reduces the stored chunks of each file, as for
+            `activestorage.executors.get_executor`
+        """
+        if isinstance(files, (str, os.PathLike)):
+            pattern = os.fspath(files)
+            files = sorted(glob.glob(pattern))
+            if not files:
+                raise FileNotFoundError(f"No files match {pattern!r}")
+        files = [os.fspath(filename) for filename in files]
+        if not files:
+            raise ValueError("No files to aggregate")
+
+        pool = dataset_pool()
+        metadata = [pool.metadata(filename, ncvar, group)
+                    for filename in files]
+        first = metadata[0]
+        if not first.shape:
+            raise ValueError(f"Can't aggregate the scalar {ncvar!r}")
+        for filename, other in zip(files, metadata):
+            if other.shape[1:] != first.shape[1:]:
+                raise ValueError(
+                    f"{ncvar!r} of {filename} has shape {other.shape}, "
+                    f"which can't be concatenated with {first.shape}")
+
+        self.files = files
+        self.ncvar = ncvar
+        self.group = group
+        self.mask = mask
+        self.max_workers = max_workers
+        self.active_client = active_client
+        self.executor = executor
+        self.active_method = None
+        self.active_axis = None
+        self.active_weights = None
+        #: Where each file's part of the first axis starts and stops
+        self.offsets = np.cumsum([0] + [m.shape[0] for m in metadata])
+        self.dimensions = first.dimensions
+        self.dtype = first.dtype
+        self.shape = (int(self.offsets[-1]),) + first.shape[1:]
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {self.ncvar} {self.shape} "
+                f"from {len(self.files)} files>")
+
+    def _parts(self, indices):
+        """
+        Split a subspace into the parts of the files it overlaps.
+
+        Returns the shape of the subspace and a list of ``(filename,
+        (start, stop), local, out)`` tuples: the file, its part of the
+        first axis, the file's index of the subspace and the positions
+        of the file's part in the subspace's first axis (None if the
+        first axis is dropped by an integer index).
+        """
+        indices = normalise_indices(indices, self.shape)
+        shape = tuple(index_size(index) for index in indices
+                      if not isinstance(index, int))
+        parts = []
+        for filename, start, stop in zip(self.files, self.offsets[:-1],
+                                         self.offsets[1:]):
+            start, stop = int(start), int(stop)
+            overlap = intersect(indices[0], start, stop)
+            if overlap is not None:
+                local, out = overlap
+                parts.append((filename, (start, stop),
+                              (local,) + indices[1:], out))
+        return shape, parts
+
+    def _dimensions(self, indices):
+        """The names of the dimensions of a subspace."""
+        return subspace_dimensions(self.dimensions,
+                                   normalise_indices(indices, self.shape))
+
+    def _array(self, filename, **kwargs):
+        return NetCDFArray(filename=filename, ncvar=self.ncvar,
+                           group=self.group, mask=self.mask,
+                           active_client=self.active_client,
+                           executor=self.executor, **kwargs)
+
+    def _map(self, function, parts):
+        """Apply ``function`` to every part, in parallel."""
+        if len(parts) < 2:
+            return [function(part) for part in parts]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(function, parts))
+
+    def __getitem__(self, indices):
+        """
+        Return a subspace, or the partial result of ``active_method``.
+
+        x.__getitem__(indices) <==> x[indices]
+
+        Indices are as for `NetCDFArray`.
+        """
+        if self.active_method is not None:
+            return self.partial(self.active_method, indices,
+                                self.active_axis, self.active_weights)
+
+        shape, parts = self._parts(indices)
+        arrays = self._map(lambda part: self._array(part[0])[part[2]],
+                           parts)
+        if not arrays:
+            return np.ma.masked_all(shape, dtype=self.dtype)
+        if parts[0][3] is None:
+            return arrays[0]
+
+        dtype = np.result_type(*arrays)
+        if self.mask:
+            result = np.ma.masked_all(shape, dtype=dtype)
+        else:
+            result = np.empty(shape, dtype=dtype)
+        for (_, _, _, out), array in zip(parts, arrays):
+            result[out] = array
+        return result
+
+    def partial(self, op, indices=Ellipsis, axis=None, weights=None):
+        """
+        Return the partial result of a reduction of a subspace.
+
+        Parameters
+        ----------
+        op: str, one of ``activestorage.reductions.OPERATIONS``
+        indices: the subspace, by default everything
+        axis: int, tuple of int or None (all axes), the axes of the
+            subspace to reduce, by position or dimension name
+        weights: numpy array that broadcasts against the whole
+            aggregated variable, as for ``NetCDFArray.active_weights``
+
+        Returns
+        -------
+        dict, as returned by `activestorage.reductions.partial_reduce`
+        """
+        check_operation(op)
+        shape, parts = self._parts(indices)
+        axis = normalise_axis(axis, len(shape), self._dimensions(indices))
+        shape = tuple(1 if i in axis else n for i, n in enumerate(shape))
+        if weights is not None:
+            weights = np.broadcast_to(np.ma.filled(weights, 0), self.shape)
+        if not parts:
+            return empty_partial(op, shape,
+                                 weighted_dtype(self.dtype, weights),
+                                 weighted=weights is not None)
+
+        def reduce(part):
+            filename, (start, stop), local, _ = part
+            file_weights = None
+            if weights is not None:
+                # a view of the file's part of the weights
+                file_weights = weights[start:stop]
+            array = self._array(filename, active_method=op, active_axis=axis,
+                                active_weights=file_weights)
+            return array[local]
+
+        partials = self._map(reduce, parts)
+        if parts[0][3] is None or 0 in axis:
+            # the files' partial results all have the same shape
+            return merge_partials(partials, op)
+
+        # lay the files' partial results along the first axis
+        result = {
+            field: np.empty(shape + values.shape[len(shape):],
+                            dtype=np.result_type(
+                                *(partial[field] for partial in partials)))
+            for field, values in partials[0].items()
+        }
+        for (_, _, _, out), partial in zip(parts, partials):
+            for field, values in partial.items():
+                result[field][out] = values
+        return result
+
+    def reduce(self, op, indices=Ellipsis, axis=None, weights=None):
+        """
+        Return a reduction of a subspace.
+
+        Parameters are as for `partial`.
+
+        Returns
+        -------
+        numpy array (masked where there were no valid data), or a
+        scalar if every axis is reduced
+        """
+        partial = self.partial(op, indices, axis, weights)
+        result = finalise(partial, op)
+        axis = normalise_axis(axis, partial['count'].ndim,
+                              self._dimensions(indices))
+        result = result.reshape([n for i, n in enumerate(result.shape)
+                                 if i not in axis])
+        if not result.ndim:
+            return result[()]
+        return result
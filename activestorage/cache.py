@@ -0,0 +1,264 @@
+"""
+A cache of reduction results, in memory and optionally on disk.
+
+A result is keyed by the identity of the file it came from (its path,
+size and modification time, or a checksum of its contents alone, so
+that copies of a file share results), the
+variable, the normalised selection, the operation and its parameters
+(see `cache_key`), so a result is never returned for a file that has
+since changed. What is cached is the partial result of the reduction
+(see `activestorage.reductions.partial_reduce`), from which the answer
+is cheaply finalised. Results are copied in and out of the cache, so
+callers may change what they put or get.
+
+>>> cache = ResultCache(max_entries=2)
+>>> cache.put('k', {'max': np.array([3.]), 'count': np.array([2])})
+>>> cache.get('k')['max']
+array([3.])
+>>> cache.get('other') is None
+True
+>>> cache.stats()['hits'], cache.stats()['misses']
+(1, 1)
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from activestorage import protocol
+from activestorage.plan import normalise_indices
+from activestorage.reductions import normalise_axis
+
+logger = logging.getLogger(__name__)
+
+_checksums = {}
+
+
+def file_identity(filename, checksum=False):
+    """
+    Return what identifies one version of a file.
+
+    Parameters
+    ----------
+    filename: str
+    checksum: bool, identify the file by the SHA256 of its contents
+        alone, rather than by its path and modification time, so that
+        copies of the file, and files touched but not changed, have the
+        same identity. The checksum of each version (by path, size and
+        modification time) is only made once per process.
+
+    Returns
+    -------
+    list, JSON-able
+    """
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    if not checksum:
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+    signature = (path, stat.st_size, stat.st_mtime_ns)
+    if signature not in _checksums:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _checksums[signature] = digest.hexdigest()
+    return ['sha256', stat.st_size, _checksums[signature]]
+
+
+def cache_key(filename, ncvar, shape, indices, op, axis=None, mask=True,
+              group=None, checksum=False, **parameters):
+    """
+    Return the cache key of a reduction of a subspace of a variable.
+
+    Parameters
+    ----------
+    filename, ncvar, group: the netCDF variable
+    shape: tuple of int, shape of the variable, to normalise ``indices``
+    indices: the subspace, as for `activestorage.plan.normalise_indices`
+    op: str, the operation
+    axis: int, tuple of int or None (all axes), the reduced axes
+    mask: bool, whether missing data are ignored
+    checksum: bool, see `file_identity`
+    parameters: any other parameters that change the result; they
+        must be JSON-able
+
+    Returns
+    -------
+    str, a hex digest
+    """
+    indices = normalise_indices(indices, shape)
+    ndim = sum(not isinstance(index, int) for index in indices)
+    document = {
+        'file': file_identity(filename, checksum=checksum),
+        'variable': [list(group or ()), ncvar],
+        'selection': protocol.encode_selection(indices),
+        'op': op,
+        'axis': sorted(normalise_axis(axis, ndim)),
+        'mask': bool(mask),
+        'parameters': parameters,
+    }
+    encoded = json.dumps(document, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _copy(partial, writeable):
+    """Return a copy of a partial result, with read-only arrays or not."""
+    copied = {}
+    for field, values in partial.items():
+        values = np.array(values)
+        values.flags.writeable = writeable
+        copied[field] = values
+    return copied
+
+
+def _nbytes(partial):
+    return sum(np.asarray(values).nbytes for values in partial.values())
+
+
+class ResultCache:
+    """
+    A least recently used cache of partial results.
+
+    The in-memory tier holds up to ``max_entries`` results. If a
+    ``directory`` is given, results are also written there (as ``.npz``
+    files, read back without pickle) and the least recently used files
+    are deleted once they take more than ``max_bytes``; the directory
+    may be shared between processes.
+    """
+
+    def __init__(self, max_entries=1024, directory=None,
+                 max_bytes=1 << 30):
+        """
+        Parameters
+        ----------
+        max_entries: int, the most results kept in memory
+        directory: str, where to keep results on disk, if at all
+        max_bytes: int, the most bytes kept on disk
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __repr__(self):
+        where = f" and {self.directory}" if self.directory else ""
+        return (f"<{self.__class__.__name__}: {len(self)} of "
+                f"{self.max_entries} in memory{where}>")
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def _remember(self, key, partial):
+        """Add a result to the memory tier; the lock must be held."""
+        self._memory[key] = partial
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return a copy of the cached partial result, or None."""
+        with self._lock:
+            partial = self._memory.get(key)
+            if partial is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return _copy(partial, writeable=True)
+
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                with np.load(path, allow_pickle=False) as npz:
+                    partial = {field: npz[field] for field in npz.files}
+                # mark it as recently used
+                os.utime(path)
+            except (OSError, ValueError):
+                partial = None
+            if partial is not None:
+                with self._lock:
+                    self._remember(key, _copy(partial, writeable=False))
+                    self.hits += 1
+                    self.disk_hits += 1
+                return partial
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, partial):
+        """Cache a copy of a partial result."""
+        partial = _copy(partial, writeable=False)
+        with self._lock:
+            self._remember(key, partial)
+
+        if self.directory is not None:
+            path = self._path(key)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, 'wb') as f:
+                np.savez(f, **partial)
+            os.replace(temporary, path)
+            self._evict()
+
+    def _evict(self):
+        """Delete the least recently used files beyond ``max_bytes``."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Forget every result, in memory and on disk."""
+        with self._lock:
+            self._memory.clear()
+        if self.directory is not None:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.npz'):
+                    os.remove(entry.path)
+
+    def stats(self):
+        """Return the hit and miss counts and the memory tier size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self._memory),
+                'nbytes': sum(map(_nbytes, self._memory.values())),
+            }
+
+
+_cache = ResultCache()
+
+
+def default_cache():
+    """Return the process-wide, in-memory, `ResultCache`."""
+    return _cache
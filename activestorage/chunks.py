@@ -0,0 +1,446 @@
+"""
+Read, decode and reduce the raw storage chunks of netCDF4 variables.
+
+Instead of asking libnetcdf for the data (which decodes chunk after
+chunk in one thread), the byte ranges of the stored chunks are read
+from the HDF5 chunk index and each chunk is read, decompressed,
+unshuffled and reduced in a pool of threads. File reads, zlib and the
+numpy kernels all release the GIL, so the work spreads over the cores
+of the storage node. Other executors (a process pool, or a dask
+cluster) can be used instead; see `activestorage.executors`.
+"""
+import logging
+import mmap
+import os
+import zlib
+
+import h5py
+import numpy as np
+
+from activestorage import executors
+from activestorage import stats as _stats
+from activestorage.reductions import (
+    empty_partial,
+    merge_into,
+    merge_partials,
+    partial_reduce,
+    reduce_partial,
+    weighted_dtype,
+)
+
+logger = logging.getLogger(__name__)
+
+#: HDF5 filter identifiers
+H5Z_FILTER_DEFLATE = 1
+H5Z_FILTER_SHUFFLE = 2
+H5Z_FILTER_FLETCHER32 = 3
+
+#: The HDF5 filters that can be decoded here
+SUPPORTED_FILTERS = (H5Z_FILTER_DEFLATE, H5Z_FILTER_SHUFFLE,
+                     H5Z_FILTER_FLETCHER32)
+
+
+def unshuffle(buffer, itemsize):
+    """
+    Undo the HDF5 shuffle filter.
+
+    The shuffle filter stores the first byte of every element, then
+    the second byte of every element, and so on. Any trailing bytes
+    that don't make a whole element are left where they are.
+
+    >>> shuffled = bytes([1, 3, 2, 4])
+    >>> unshuffle(shuffled, 2).tobytes()
+    b'\\x01\\x02\\x03\\x04'
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if itemsize == 1:
+        return data
+    n = data.size // itemsize
+    out = np.empty_like(data)
+    out[:n * itemsize].reshape(n, itemsize)[...] = \
+        data[:n * itemsize].reshape(itemsize, n).T
+    out[n * itemsize:] = data[n * itemsize:]
+    return out
+
+
+def fletcher32(buffer):
+    """
+    Return the HDF5 Fletcher32 checksum of a buffer.
+
+    The sums are of big-endian 16-bit words (an odd last byte is the
+    high byte of a word), modulo 65535 but with 65535 rather than 0
+    for a nonzero sum, as ``H5_checksum_fletcher32`` computes them.
+
+    >>> hex(fletcher32(b'abcde'))
+    '0x4ff029c7'
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size % 2:
+        data = np.append(data, np.uint8(0))
+    words = data.view('>u2').astype(np.int64)
+    if not words.any():
+        return 0
+    # the second sum adds the first after every word, so counts each
+    # word once for every word from it to the end
+    weights = np.arange(words.size, 0, -1, dtype=np.int64) % 65535
+    sum1 = int(words.sum() % 65535)
+    sum2 = int(np.sum(words * weights) % 65535)
+    return ((sum2 or 65535) << 16) | (sum1 or 65535)
+
+
+def orthogonal_index(data, selection):
+    """
+    Index ``data`` one dimension at a time, as netCDF does.
+
+    Integer sequences index their dimension independently of each
+    other (unlike numpy's fancy indexing).
+    """
+    basic = tuple(slice(None) if isinstance(index, np.ndarray) else index
+                  for index in selection)
+    data = data[basic]
+    axis = 0
+    for index in selection:
+        if isinstance(index, int):
+            continue
+        if isinstance(index, np.ndarray):
+            data = np.take(data, index, axis=axis)
+        axis += 1
+    return data
+
+
+class StorageLayout:
+    """Where the chunks of an HDF5 dataset are stored, and how to decode them.
+
+    Byte offsets of chunks are keyed by the chunk's position in the
+    chunk grid, as `activestorage.plan.ChunkSelection.coords`.
+    """
+
+    def __init__(self, dtype, shape, chunk_shape, filters, chunks,
+                 fill_value=None):
+        """
+        Parameters
+        ----------
+        dtype: numpy dtype of the stored values (including byte order)
+        shape: tuple of int, shape of the dataset
+        chunk_shape: tuple of int, shape of a stored chunk, or None if
+            the dataset is stored contiguously
+        filters: sequence of ``(filter_id, client_values)`` in the order
+            they were applied when writing
+        chunks: dict mapping chunk grid coordinates to ``(byte_offset,
+            size, filter_mask)``; for a contiguous dataset the single
+            entry has coordinates of all zeros
+        fill_value: value of elements in chunks that were never written
+        """
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.chunk_shape = None if chunk_shape is None else tuple(chunk_shape)
+        self.filters = tuple(filters)
+        self.chunks = chunks
+        self.fill_value = fill_value
+
+    @classmethod
+    def from_file(cls, filename, ncvar, group=None):
+        """
+        Read the storage layout of a netCDF4 variable with h5py.
+
+        Returns ``None`` if the variable can't be read directly, for
+        instance because the file is not HDF5 (netCDF3) or the variable
+        uses filters that can't be decoded here.
+        """
+        path = '/'.join(list(group or ()) + [ncvar])
+        try:
+            h5 = h5py.File(filename, 'r')
+        except OSError:
+            return None
+
+        with h5:
+            dataset = h5[path]
+            dsid = dataset.id
+            plist = dsid.get_create_plist()
+            filters = []
+            for i in range(plist.get_nfilters()):
+                code, _, values, name = plist.get_filter(i)
+                if code not in SUPPORTED_FILTERS:
+                    logger.info("Can't decode %s filter of %s in %s",
+                                name, ncvar, filename)
+                    return None
+                filters.append((code, values))
+
+            chunks = {}
+            if dataset.chunks is None:
+                offset = dsid.get_offset()
+                if offset is not None:
+                    chunks[(0,) * dataset.ndim] = (
+                        offset, dsid.get_storage_size(), 0)
+            else:
+                def add(info):
+                    coords = tuple(o // c for o, c in
+                                   zip(info.chunk_offset, dataset.chunks))
+                    chunks[coords] = (info.byte_offset, info.size,
+                                      info.filter_mask)
+
+                if hasattr(dsid, 'chunk_iter'):
+                    dsid.chunk_iter(add)
+                else:
+                    for i in range(dsid.get_num_chunks()):
+                        add(dsid.get_chunk_info(i))
+
+            return cls(dataset.dtype, dataset.shape, dataset.chunks, filters,
+                       chunks, dataset.fillvalue)
+
+    def subset(self, coords):
+        """Return the layout of only the chunks at ``coords``."""
+        chunks = {c: self.chunks[c] for c in map(tuple, coords)
+                  if c in self.chunks}
+        return StorageLayout(self.dtype, self.shape, self.chunk_shape,
+                             self.filters, chunks, self.fill_value)
+
+    @property
+    def contiguous(self):
+        """True if the dataset is stored as one block."""
+        return self.chunk_shape is None
+
+    def attach(self, plan):
+        """Record the byte ranges of the chunks of a `ChunkPlan`."""
+        for chunk in plan:
+            offset, size, _ = self.chunks.get(chunk.coords, (None, None, 0))
+            chunk.offset, chunk.size = offset, size
+        return plan
+
+    def decode(self, raw, filter_mask=0):
+        """Undo the filter pipeline of one stored chunk."""
+        data = raw
+        for i, (code, values) in reversed(list(enumerate(self.filters))):
+            if filter_mask & (1 << i):
+                # the filter was skipped for this chunk
+                continue
+            if code == H5Z_FILTER_DEFLATE:
+                data = zlib.decompress(data)
+            elif code == H5Z_FILTER_SHUFFLE:
+                data = unshuffle(data, self.dtype.itemsize)
+            elif code == H5Z_FILTER_FLETCHER32:
+                data = memoryview(data)
+                stored = bytes(data[-4:])
+                data = data[:-4]
+                # older versions of HDF5 wrote the bytes the other way
+                # round, and HDF5 accepts both
+                checksum = fletcher32(data).to_bytes(4, 'little')
+                if stored not in (checksum, checksum[::-1]):
+                    raise OSError("Data error detected by the Fletcher32 "
+                                  "checksum of a chunk")
+        return data
+
+    def read_chunk(self, fd, coords, stats=_stats.NULL):
+        """
+        Return the decoded values of one stored chunk as a numpy array.
+
+        Chunks on the edges of the dataset are returned whole, so may
+        extend beyond the dataset shape. The bytes read and decoded
+        are counted in ``stats`` (a `activestorage.stats.RequestStats`),
+        except for contiguous data, which are mapped rather than read.
+        """
+        shape = self.shape if self.contiguous else self.chunk_shape
+        entry = self.chunks.get(tuple(coords))
+        if entry is None:
+            # never written, so all fill values
+            return np.full(shape, self.fill_value, dtype=self.dtype)
+
+        offset, size, filter_mask = entry
+        if self.contiguous:
+            # map rather than read, so only the selected pages are read
+            mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            return np.frombuffer(mapped, dtype=self.dtype,
+                                 count=int(np.prod(shape)),
+                                 offset=offset).reshape(shape)
+
+        with stats.stage('read'):
+            raw = os.pread(fd, size, offset)
+        with stats.stage('decode'):
+            data = self.decode(raw, filter_mask)
+        stats.add(bytes_read=len(raw), bytes_decompressed=len(data))
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+
+def _reduce_chunk(fd, layout, chunk, op, axis, missing, weights, stats):
+    """Read, decode and reduce the selected part of one chunk."""
+    data = layout.read_chunk(fd, chunk.coords, stats=stats)
+    data = data[tuple(slice(0, n) for n in chunk.shape)]
+    with stats.stage('reduce'):
+        data = orthogonal_index(data, chunk.selection)
+        chunk_partial = partial_reduce(data, op, axis, missing=missing,
+                                       weights=weights)
+    if layout.contiguous:
+        # only the pages of the selection are read
+        stats.add(bytes_read=data.nbytes, bytes_decompressed=data.nbytes)
+    stats.add(elements=data.size)
+    return chunk_partial
+
+
+def _reduce_task(task):
+    """
+    Reduce the chunks of a task, in a worker of an executor.
+
+    The chunks of each of the task's regions (parts of the result) are
+    merged and written into the region's slot of the shared partial
+    result, or, without shared memory, returned.
+
+    Returns a ``(regions, counts, timings)`` tuple, where ``regions`` is
+    a list of ``(slot, index, partial)``, or None if they were written
+    to shared memory.
+    """
+    stats = _stats.RequestStats()
+    op = task['op']
+    regions = []
+    fd = os.open(task['filename'], os.O_RDONLY)
+    try:
+        for slot, index, chunks in task['regions']:
+            regions.append((slot, index, merge_partials(
+                [_reduce_chunk(fd, task['layout'], chunk, op, task['axis'],
+                               task['missing'], weights, stats)
+                 for chunk, weights in chunks], op)))
+    finally:
+        os.close(fd)
+
+    if task['spec'] is not None:
+        executors.write(task['spec'], regions)
+        regions = None
+    counts = {name: getattr(stats, name)
+              for name in ('bytes_read', 'bytes_decompressed', 'elements')}
+    return regions, counts, stats.timings
+
+
+def _tasks(filename, layout, plan, op, axis, missing, weights, workers):
+    """
+    Split the chunks of a plan into tasks for the workers of an executor.
+
+    Chunks that share a part of the result (a region) are split over
+    up to ``slots`` tasks, so that a reduction over every axis still
+    uses every worker, and each part writes to its own slot.
+
+    Returns the tasks and the number of slots.
+    """
+    regions = {}
+    for chunk in plan:
+        key = tuple((o.start, o.stop) if isinstance(o, slice)
+                    else tuple(o.tolist())
+                    for i, o in enumerate(chunk.out_selection)
+                    if i not in axis)
+        regions.setdefault(key, []).append(chunk)
+
+    slots = max(1, min(workers // max(len(regions), 1),
+                       max(map(len, regions.values()), default=1)))
+    parts = []
+    for chunks in regions.values():
+        index = chunks[0].out_index(axis)
+        for slot in range(slots):
+            part = [(chunk, None if weights is None else np.ascontiguousarray(
+                orthogonal_index(weights, chunk.out_selection)))
+                for chunk in chunks[slot::slots]]
+            if part:
+                parts.append((slot, index, part))
+
+    tasks = []
+    if not parts:
+        return tasks, slots
+    for batch in np.array_split(np.arange(len(parts)),
+                                min(len(parts), 2 * workers)):
+        batch = [parts[i] for i in batch]
+        tasks.append({
+            'filename': filename,
+            'layout': layout.subset(chunk.coords for _, _, part in batch
+                                    for chunk, _ in part),
+            'op': op,
+            'axis': axis,
+            'missing': missing,
+            'regions': batch,
+        })
+    return tasks, slots
+
+
+def reduce_chunks(filename, layout, plan, op, axis, missing=None,
+                  max_workers=None, weights=None, executor=None,
+                  stats=_stats.NULL):
+    """
+    Reduce the selected part of every chunk of a plan, in parallel.
+
+    Parameters
+    ----------
+    filename: str, the netCDF4 file
+    layout: `StorageLayout` of the variable
+    plan: `ChunkPlan` of the selection
+    op: str, one of ``activestorage.reductions.OPERATIONS``
+    axis: tuple of int, the (normalised) axes of the selection to reduce
+    missing: `MissingValues`, the values to ignore, if any
+    max_workers: int, the number of workers, by default the number of
+        CPUs
+    weights: numpy array that broadcasts to the selection's shape, the
+        weights of the reduction (see
+        `activestorage.reductions.partial_reduce`). Each chunk is
+        reduced with its own part of the weights, which is a view of
+        them.
+    executor: what reads and reduces the chunks, as for
+        `activestorage.executors.get_executor`; by default a pool of
+        ``max_workers`` threads
+    stats: `activestorage.stats.RequestStats` to count the work in
+
+    Returns
+    -------
+    dict, the partial result over the whole selection (with the
+    reduced axes kept)
+    """
+    shape = tuple(1 if i in axis else n
+                  for i, n in enumerate(plan.out_shape))
+    partial = empty_partial(op, shape, weighted_dtype(layout.dtype, weights),
+                            weighted=weights is not None)
+    if weights is not None:
+        weights = np.broadcast_to(weights, plan.out_shape)
+
+    runner = executors.get_executor(executor, max_workers)
+    if not runner.in_process:
+        return _reduce_in_workers(filename, layout, plan, op, axis, missing,
+                                  weights, runner, partial, stats)
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        def reduce_chunk(chunk):
+            chunk_weights = None
+            if weights is not None:
+                chunk_weights = orthogonal_index(weights,
+                                                 chunk.out_selection)
+            return chunk, _reduce_chunk(fd, layout, chunk, op, axis, missing,
+                                        chunk_weights, stats)
+
+        for chunk, chunk_partial in runner.map(reduce_chunk, plan):
+            merge_into(partial, chunk_partial, op, chunk.out_index(axis))
+    finally:
+        os.close(fd)
+
+    return partial
+
+
+def _reduce_in_workers(filename, layout, plan, op, axis, missing, weights,
+                       runner, partial, stats):
+    """Reduce the chunks of a plan with the workers of another process."""
+    tasks, slots = _tasks(filename, layout, plan, op, axis, missing,
+                          weights, runner.workers)
+    shared = None
+    if runner.shared_memory:
+        shared = executors.SharedPartial(partial, slots)
+    try:
+        for task in tasks:
+            task['spec'] = None if shared is None else shared.spec
+        with stats.stage('wait'):
+            results = list(runner.map(_reduce_task, tasks))
+        for regions, counts, timings in results:
+            stats.add(**counts)
+            for name, seconds in timings.items():
+                stats.add_time(name, seconds)
+            for _, index, region in regions or ():
+                merge_into(partial, region, op, index)
+        if shared is not None:
+            partial = {field: values[0] for field, values in reduce_partial(
+                shared.arrays(), op, axis=0).items()}
+    finally:
+        if shared is not None:
+            shared.close()
+    return partial
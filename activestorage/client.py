@@ -0,0 +1,422 @@
+"""
+Client for an active storage server (see `activestorage.server`).
+
+>>> client = ActiveStorageClient('http://localhost:8000')  # doctest: +SKIP
+>>> client.reduce_range('tas.bin', 0, 4000, 'f4', 'mean')  # doctest: +SKIP
+280.5
+>>> client.last_stats  # doctest: +SKIP
+{'latency': 0.0011, 'bytes_sent': 95, 'bytes_received': 172, ...}
+
+Many small requests are better sent together. `ActiveStorageClient.submit`
+queues a request and returns a future; queued requests for the same
+file go to the server in one round trip once ``batch_size`` of them are
+waiting or the oldest has waited ``flush_interval`` seconds.
+
+>>> futures = [client.submit(r) for r in requests]  # doctest: +SKIP
+>>> partials = [f.result() for f in futures]  # doctest: +SKIP
+"""
+import http.client
+import os
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from activestorage import protocol
+from activestorage import stats as _stats
+from activestorage.chunks import orthogonal_index
+from activestorage.reductions import (
+    empty_partial,
+    finalise,
+    merge_into,
+    partial_reduce,
+)
+
+
+class ActiveStorageError(RuntimeError):
+    """The active storage server could not carry out a request."""
+
+
+class _Batch:
+    """Requests for one file waiting to be sent together."""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.requests = []
+        self.futures = []
+
+    def __len__(self):
+        return len(self.requests)
+
+
+class ActiveStorageClient:
+    """
+    Send reduction requests to an active storage server.
+
+    One HTTP connection is kept open and reused. The cost of the last
+    round trip is kept in ``last_stats``: the latency, the bytes sent
+    and received, and the bytes read and CPU time used by the server.
+    It's that of any thread's last round trip, so a client shared by
+    threads should be given a ``stats`` to count each call's cost in.
+    ``round_trips`` counts the round trips made so far.
+    """
+
+    def __init__(self, url='http://localhost:8000', timeout=60,
+                 batch_size=64, flush_interval=0.002):
+        """
+        Parameters
+        ----------
+        url: str, the server address
+        timeout: float, seconds to wait for the server
+        batch_size: int, the most requests that `submit` sends in one
+            round trip
+        flush_interval: float, the longest that `submit` holds a
+            request back, in seconds, waiting for others to batch it with
+        """
+        parts = urlsplit(url)
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.last_stats = None
+        self.round_trips = 0
+        self._connection = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_changed = threading.Condition()
+        self._flusher = None
+        self._closed = False
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.url}>"
+
+    def _post(self, body):
+        """POST to /reduce, reconnecting once if the connection dropped."""
+        for attempt in (0, 1):
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                self._connection.request(
+                    'POST', '/reduce', body=body,
+                    headers={'Content-Type': protocol.CONTENT_TYPE})
+                response = self._connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self._connection.close()
+                self._connection = None
+                if attempt:
+                    raise
+
+    def close(self):
+        """Send any queued requests and close the connection to the server."""
+        with self._pending_changed:
+            self._closed = True
+            self._pending_changed.notify()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def reduce_many(self, requests, stats=_stats.NULL):
+        """
+        Send several requests in one round trip.
+
+        See `activestorage.server` for the request format. The bytes
+        read by the server and received here, and the server's CPU
+        time, are counted in ``stats``, a
+        `activestorage.stats.RequestStats`.
+
+        Returns
+        -------
+        list of partial results, one per request
+        """
+        return self._reduce_many(requests, stats)[0]
+
+    def _reduce_many(self, requests, stats=_stats.NULL):
+        """`reduce_many`, also returning the server's stats per request."""
+        body = protocol.dumps({'requests': list(requests)})
+        start = time.perf_counter()
+        with self._lock:
+            status, data = self._post(body)
+        latency = time.perf_counter() - start
+        self.round_trips += 1
+        if status != 200:
+            raise ActiveStorageError(
+                f"{self.url} answered {status}: "
+                f"{data.decode('utf-8', 'replace')}")
+
+        results = protocol.loads(data)['results']
+        self.last_stats = {
+            'latency': latency,
+            'bytes_sent': len(body),
+            'bytes_received': len(data),
+            'bytes_read': sum(r['stats']['bytes_read'] for r in results),
+            'server_cpu_time': sum(r['stats']['cpu_time'] for r in results),
+        }
+        stats.add(bytes_read=self.last_stats['bytes_read'],
+                  bytes_returned=len(data))
+        stats.add_time('server', self.last_stats['server_cpu_time'])
+        return ([protocol.decode_partial(r['partial']) if 'partial' in r
+                 else [protocol.decode_partial(p) for p in r['partials']]
+                 for r in results],
+                [r['stats'] for r in results])
+
+    def reduce(self, request, stats=_stats.NULL):
+        """Send one request and return its partial result."""
+        return self.reduce_many([request], stats)[0]
+
+    def submit(self, request):
+        """
+        Queue a request to be sent in a batch with others for its file.
+
+        Returns
+        -------
+        `concurrent.futures.Future` of the partial result
+        """
+        future = Future()
+        path = request['path']
+        with self._pending_changed:
+            if self._closed:
+                raise ActiveStorageError(f"{self!r} is closed")
+            batch = self._pending.get(path)
+            if batch is None:
+                batch = self._pending[path] = _Batch(
+                    time.monotonic() + self.flush_interval)
+            batch.requests.append(request)
+            batch.futures.append(future)
+            if len(batch) >= self.batch_size:
+                del self._pending[path]
+            else:
+                batch = None
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_due,
+                                                     daemon=True)
+                    self._flusher.start()
+                self._pending_changed.notify()
+
+        if batch is not None:
+            self._send(batch)
+        return future
+
+    def flush(self):
+        """Send every queued request now."""
+        with self._pending_changed:
+            batches = list(self._pending.values())
+            self._pending.clear()
+        for batch in batches:
+            self._send(batch)
+
+    def _send(self, batch):
+        """
+        Send a batch and hand the results to its futures.
+
+        The server's stats of each request are left in the ``stats``
+        attribute of its future.
+        """
+        try:
+            partials, stats = self._reduce_many(batch.requests)
+        except Exception as error:
+            for future in batch.futures:
+                future.set_exception(error)
+        else:
+            for future, partial, request_stats in zip(batch.futures,
+                                                      partials, stats):
+                future.stats = request_stats
+                future.set_result(partial)
+
+    def _flush_due(self):
+        """Send batches whose deadline has passed, until closed."""
+        with self._pending_changed:
+            while not self._closed:
+                if not self._pending:
+                    self._pending_changed.wait()
+                    continue
+                now = time.monotonic()
+                due = [path for path, batch in self._pending.items()
+                       if batch.deadline <= now]
+                if not due:
+                    self._pending_changed.wait(
+                        min(b.deadline for b in self._pending.values()) - now)
+                    continue
+                batches = [self._pending.pop(path) for path in due]
+                self._pending_changed.release()
+                try:
+                    for batch in batches:
+                        self._send(batch)
+                finally:
+                    self._pending_changed.acquire()
+
+    def reduce_range(self, path, offset, nbytes, dtype, op, missing=None,
+                     stats=_stats.NULL):
+        """
+        Return ``op`` over the values in a byte range of a file.
+
+        Parameters
+        ----------
+        path: str, the file, as seen by the server
+        offset: int, byte offset of the first value
+        nbytes: int, number of bytes to reduce
+        dtype: numpy dtype of the stored values
+        op: str, one of ``activestorage.reductions.OPERATIONS``
+        missing: `MissingValues`, the values to ignore, if any
+        stats: `activestorage.stats.RequestStats`, see `reduce_many`
+        """
+        partial = self.reduce({
+            'path': os.fspath(path),
+            'dtype': np.dtype(dtype).str,
+            'op': op,
+            'offset': int(offset),
+            'size': int(nbytes),
+            'missing': protocol.encode_missing(missing),
+        }, stats)
+        return finalise(partial, op)[0]
+
+    def reduce_hyperslab(self, path, offset, shape, dtype, op, start=None,
+                         count=None, stride=None, missing=None,
+                         stats=_stats.NULL):
+        """
+        Return ``op`` over a hyperslab of a contiguous array in a file.
+
+        See `activestorage.storage.read_hyperslab` for the arguments,
+        and `reduce_many` for ``stats``.
+        """
+        request = {
+            'path': os.fspath(path),
+            'dtype': np.dtype(dtype).str,
+            'op': op,
+            'offset': int(offset),
+            'shape': [int(n) for n in shape],
+            'missing': protocol.encode_missing(missing),
+        }
+        for name, value in (('start', start), ('count', count),
+                            ('stride', stride)):
+            if value is not None:
+                request[name] = [int(v) for v in value]
+        partial = self.reduce(request, stats)
+        return finalise(partial, op)[(0,) * len(shape)]
+
+    def reduce_chunks(self, filename, layout, plan, op, axis, missing=None,
+                      stats=_stats.NULL):
+        """
+        Reduce the selected part of every chunk of a plan on the server.
+
+        The stored chunks go in one request, whose chunks aren't merged
+        by the server, so that the partial result of each can be placed
+        in the result; neighbouring chunks are read together. Chunks
+        that were never written hold only the fill value, so are
+        reduced here without a request. The selection of a contiguous
+        variable is sent as a hyperslab, or as a selection of rows if
+        it has an integer array index, so that the server reads only
+        the selected part of it.
+
+        See `activestorage.chunks.reduce_chunks` for the arguments and
+        the returned partial result. The work reported by the server is
+        counted in ``stats``.
+        """
+        shape = tuple(1 if i in axis else n
+                      for i, n in enumerate(plan.out_shape))
+        partial = empty_partial(op, shape, layout.dtype)
+        common = {
+            'path': os.path.abspath(filename),
+            'dtype': layout.dtype.str,
+            'op': op,
+            'axis': list(axis),
+            'missing': protocol.encode_missing(missing),
+        }
+
+        stored = []
+        for chunk in plan:
+            entry = layout.chunks.get(chunk.coords)
+            if entry is None:
+                data = np.full(chunk.shape, layout.fill_value,
+                               dtype=layout.dtype)
+                data = orthogonal_index(data, chunk.selection)
+                merge_into(partial,
+                           partial_reduce(data, op, axis, missing=missing),
+                           op, chunk.out_index(axis))
+            else:
+                stored.append((chunk, entry))
+        if not stored:
+            return partial
+
+        kept = None
+        if layout.contiguous:
+            (chunk, (offset, _, _)), = stored
+            slab = _hyperslab(chunk.selection)
+            if slab is None:
+                request = dict(common, offset=offset,
+                               shape=list(layout.shape),
+                               selection=protocol.encode_selection(
+                                   chunk.selection))
+            else:
+                start, count, stride, kept = slab
+                request = dict(common, offset=offset,
+                               shape=list(layout.shape), start=start,
+                               count=count, stride=stride,
+                               axis=[kept[i] for i in axis])
+        else:
+            request = dict(
+                common, chunk_shape=list(layout.chunk_shape),
+                filters=[[code, list(values)]
+                         for code, values in layout.filters],
+                merge=False,
+                chunks=[{'offset': offset, 'size': size,
+                         'filter_mask': filter_mask,
+                         'selection': protocol.encode_selection(
+                             chunk.selection)}
+                        for chunk, (offset, size, filter_mask) in stored])
+        future = self.submit(request)
+
+        with stats.stage('wait'):
+            partials = future.result()
+        if layout.contiguous:
+            if kept is not None:
+                # drop the axes of integer indices, kept by the server
+                index = tuple(slice(None) if i in kept else 0
+                              for i in range(len(chunk.selection)))
+                partials = {field: values[index]
+                            for field, values in partials.items()}
+            partials = [partials]
+        for (chunk, _), chunk_partial in zip(stored, partials):
+            merge_into(partial, chunk_partial, op, chunk.out_index(axis))
+        stats.add(**{name: future.stats[name] for name in
+                     ('bytes_read', 'bytes_decompressed', 'elements')})
+        stats.add_time('server', future.stats['cpu_time'])
+        return partial
+
+
+def _hyperslab(selection):
+    """
+    Return a normalised selection as a hyperslab, if it is one.
+
+    Returns ``(start, count, stride, kept)``, where ``kept`` are the
+    dimensions of the hyperslab that remain in the selection, which
+    drops those of integer indices; or None if the selection has an
+    integer array index.
+
+    >>> _hyperslab((slice(2, 9, 3), 4))
+    ([2, 4], [3, 1], [3, 1], [0])
+    """
+    start, count, stride, kept = [], [], [], []
+    for i, index in enumerate(selection):
+        if isinstance(index, slice):
+            start.append(int(index.start))
+            count.append(len(range(index.start, index.stop, index.step)))
+            stride.append(int(index.step))
+            kept.append(i)
+        elif np.ndim(index) == 0:
+            start.append(int(index))
+            count.append(1)
+            stride.append(1)
+        else:
+            return None
+    return start, count, stride, kept
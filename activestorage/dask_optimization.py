@@ -0,0 +1,229 @@
+"""
+A dask graph optimisation that pushes reductions into the storage read.
+
+Ordinary dask code over an active-capable array (an array, such as a
+`NetCDFArray`, whose ``active_method`` and ``active_weights`` are
+None)::
+
+    dx = da.from_array(NetCDFArray(...), chunks=...)
+    dx.sum(axis=0).compute()
+
+builds, for each block, a getter task that reads the block followed by
+a chunk task (``np.sum``, ``chunk_max``, ``mean_chunk``, ...) that
+reduces it. `optimize` finds those pairs and fuses each into one task
+that asks the array for the partial result of the reduction of the
+block (see `activestorage.reductions.partial_reduce`), and then gives
+it the form that the chunk task would have returned, so dask's own
+combine and aggregate tasks are left as they are. Only the reduced
+values leave the storage.
+
+The pairs fused are those of ``sum``, ``min``, ``max``, ``mean`` and
+``dask.array.ma.count``, over any axes. Anything else (for instance a
+reduction of ``dx + 1``, or ``nansum``) is computed as before.
+
+`register` makes `optimize` dask's array optimisation (the
+``array_optimize`` config option), so that it applies to every dask
+array; graphs without an active-capable array are passed straight to
+dask's own optimisation. Nothing is registered on import::
+
+    import activestorage.dask_optimization
+    activestorage.dask_optimization.register()
+
+The rewriting relies on dask's private task spec, which changes between
+releases, so the versions of dask that it's tested with are pinned in
+``setup.py``. With a dask that lacks it, `FUSABLE` is False and
+`optimize` is dask's own optimisation.
+"""
+from copy import copy
+from functools import partial
+
+import dask
+import numpy as np
+from dask.array import chunk, reductions
+from dask.array.core import getter, getter_inline, getter_nofancy
+from dask.array.optimization import optimize as dask_optimize
+from dask.blockwise import Blockwise
+from dask.highlevelgraph import HighLevelGraph
+from dask.utils import ensure_dict
+
+from activestorage.reductions import finalise
+
+try:
+    from dask._task_spec import (
+        DataNode,
+        Task,
+        TaskRef,
+        convert_legacy_graph,
+    )
+except ImportError:
+    DataNode = Task = TaskRef = convert_legacy_graph = None
+
+try:
+    from dask.array.ma import _chunk_count
+except ImportError:
+    _chunk_count = None
+
+#: Whether this version of dask's graphs can be rewritten
+FUSABLE = convert_legacy_graph is not None
+
+GETTERS = (getter, getter_nofancy, getter_inline)
+
+#: The dask chunk functions that can be fused, and their operations
+CHUNK_FUNCTIONS = {
+    chunk.sum: 'sum',
+    reductions.chunk_min: 'min',
+    reductions.chunk_max: 'max',
+    reductions.mean_chunk: 'mean',
+}
+if _chunk_count is not None:
+    CHUNK_FUNCTIONS[_chunk_count] = 'count'
+
+
+def is_active(array):
+    """Whether an array can return partial results of reductions."""
+    return (hasattr(array, 'active_method') and array.active_method is None
+            and hasattr(array, 'active_axis')
+            and getattr(array, 'active_weights', None) is None)
+
+
+def active_block(array, index, op, axis, dtype=None):
+    """
+    Reduce a block of an active-capable array next to its storage.
+
+    Returns what the dask chunk function of ``op`` would have returned
+    for the block, with the reduced axes kept.
+
+    Parameters
+    ----------
+    array: the active-capable array
+    index: tuple of slice, the block
+    op: str, one of `CHUNK_FUNCTIONS` operations
+    axis: tuple of int, the reduced axes of the block
+    dtype: the dtype of the chunk function's result, if it had one
+    """
+    array = copy(array)
+    array.active_method = 'sum' if op == 'mean' else op
+    array.active_axis = axis
+    partial_result = array[index]
+
+    count = partial_result['count']
+    if op == 'count':
+        return count
+    if op == 'mean':
+        total = partial_result['sum'].astype(dtype)
+        return {'n': count.astype(dtype),
+                'total': np.ma.masked_where(count == 0, total)}
+    result = finalise(partial_result, op)
+    if dtype is not None:
+        result = result.astype(dtype)
+    return result
+
+
+def _unwrap(func):
+    """Return a function and the keywords it was partially applied to."""
+    keywords = {}
+    while isinstance(func, partial):
+        keywords = dict(func.keywords, **keywords)
+        func = func.func
+    return func, keywords
+
+
+def _value(dsk, arg):
+    """Return the value of a data argument of a task, or None."""
+    if isinstance(arg, TaskRef):
+        arg = dsk.get(arg.key)
+    if isinstance(arg, DataNode):
+        return arg.value
+    return None
+
+
+def _fuse(dsk, task):
+    """Return the fused task replacing a chunk task, or None."""
+    func, keywords = _unwrap(task.func)
+    op = CHUNK_FUNCTIONS.get(func)
+    if (op is None or set(keywords) - {'dtype'}
+            or set(task.kwargs) != {'axis', 'keepdims'}
+            or not task.kwargs['keepdims'] or len(task.args) != 1
+            or not isinstance(task.args[0], TaskRef)):
+        return None
+
+    getter_task = dsk.get(task.args[0].key)
+    if (not isinstance(getter_task, Task) or getter_task.func not in GETTERS
+            or len(getter_task.args) != 2):
+        return None
+    array_arg, index_arg = getter_task.args
+    array = _value(dsk, array_arg)
+    index = _value(dsk, index_arg)
+    if (not is_active(array) or not isinstance(index, tuple)
+            or not all(isinstance(i, slice) for i in index)):
+        return None
+
+    if not isinstance(array_arg, TaskRef):
+        array_arg = DataNode(None, array)
+    return Task(task.key, active_block, array_arg, DataNode(None, index),
+                op=op, axis=tuple(task.kwargs['axis']),
+                dtype=keywords.get('dtype'))
+
+
+def fuse_active_reductions(dsk):
+    """
+    Fuse the reductions of active-capable arrays into their reads.
+
+    Parameters
+    ----------
+    dsk: dict, a low level task graph
+
+    Returns
+    -------
+    dict, the graph with every fusable chunk task replaced, and the
+    number of tasks replaced; the graph is returned as it was if
+    `FUSABLE` is False
+    """
+    if not FUSABLE:
+        return dsk, 0
+    dsk = convert_legacy_graph(dsk)
+    fused = {}
+    for key, task in dsk.items():
+        if isinstance(task, Task):
+            new = _fuse(dsk, task)
+            if new is not None:
+                fused[key] = new
+    dsk.update(fused)
+    return dsk, len(fused)
+
+
+def _has_active(dsk):
+    """Whether a graph holds an active-capable array."""
+    if not isinstance(dsk, HighLevelGraph):
+        return True
+    for layer in dsk.layers.values():
+        if isinstance(layer, Blockwise):
+            values = (value for value, _ in layer.indices)
+        else:
+            values = layer.values()
+        if any(is_active(getattr(value, 'value', value))
+               for value in values):
+            return True
+    return False
+
+
+def optimize(dsk, keys, **kwargs):
+    """
+    Fuse active reductions, then apply dask's array optimisation.
+
+    Has the signature of ``dask.array.optimization.optimize``.
+    """
+    if FUSABLE and _has_active(dsk):
+        dsk, _ = fuse_active_reductions(ensure_dict(dsk))
+    return dask_optimize(dsk, keys, **kwargs)
+
+
+def register():
+    """
+    Make `optimize` dask's array optimisation, for the whole process.
+
+    An ``array_optimize`` already set by the user is left alone. Not
+    done on import, so dask is only changed for those who ask.
+    """
+    if dask.config.get('array_optimize', None) is None:
+        dask.config.set(array_optimize=optimize)
@@ -0,0 +1,108 @@
+"""
+Dask reductions whose per-block work is done by active storage.
+
+Each block of the dask array is a `NetCDFArray` subspace that returns
+the partial result of the reduction (see
+`activestorage.reductions.partial_reduce`) rather than data. The
+combine and aggregate functions below merge those partial results, so
+any reduction tree that `dask.array.reduction` builds gives the right
+answer for every operation, whatever the chunking.
+"""
+from copy import copy
+from functools import partial
+
+import dask.array as da
+import numpy as np
+from dask.array.core import _concatenate2
+from dask.utils import deepmap
+
+from activestorage.reductions import (
+    finalise,
+    normalise_axis,
+    operation_name,
+    partial_fields,
+    reduce_partial,
+    result_dtype,
+)
+
+
+def active_chunk(x, axis=None, keepdims=True, computing_meta=False,
+                 **kwargs):
+    """The blocks are already partial results, so pass them on."""
+    return x
+
+
+def active_combine(partials, op, axis=None, keepdims=True,
+                   computing_meta=False, **kwargs):
+    """Merge the (nested lists of) partial results of adjacent blocks."""
+    if computing_meta:
+        return partials
+    if not isinstance(partials, list):
+        partials = [partials]
+    fields = {
+        field: _concatenate2(deepmap(lambda p: p[field], partials),
+                             axes=axis)
+        for field in partial_fields(op)
+    }
+    return reduce_partial(fields, op, axis=axis)
+
+
+def active_aggregate(partials, op, axis=None, keepdims=False,
+                     computing_meta=False, **kwargs):
+    """Merge the last partial results and finalise the reduction."""
+    if computing_meta:
+        return partials
+    result = finalise(active_combine(partials, op, axis=axis), op)
+    if not keepdims:
+        result = result.reshape([n for i, n in enumerate(result.shape)
+                                 if i not in axis])
+    return result
+
+
+def active_reduction(array, op, axis=None, keepdims=False, chunks='auto',
+                     split_every=None):
+    """
+    Return a dask array of the reduction ``op`` of a `NetCDFArray`.
+
+    Parameters
+    ----------
+    array: `NetCDFArray`, the whole netCDF variable
+    op: str, one of ``activestorage.reductions.OPERATIONS``
+    axis: int, tuple of int or None (all axes), the axes to reduce
+    keepdims: bool, keep the reduced axes with size 1
+    chunks: the dask chunks, as for ``dask.array.from_array``
+    split_every: passed to ``dask.array.reduction``
+    """
+    if operation_name(op) == 'histogram':
+        # a dask reduction can't add the axis of the bins
+        raise NotImplementedError(
+            "Histograms can't be computed as dask reductions")
+    axis = normalise_axis(axis, array.ndim)
+    array = copy(array)
+    array.active_method = op
+    array.active_axis = axis
+
+    dtype = result_dtype(op, array.dtype)
+    dx = da.from_array(
+        array,
+        chunks=chunks,
+        asarray=False,
+        # No dask lock: __getitem__ shares a pooled netCDF4.Dataset
+        # handle (see activestorage.handles) and takes netcdf_lock
+        # itself, only around its netCDF4 calls, so the reductions of
+        # blocks (and their reads on the other routes) run in parallel
+        lock=False,
+        meta=np.array((), dtype=array.dtype),
+    )
+    return da.reduction(
+        dx,
+        chunk=active_chunk,
+        combine=partial(active_combine, op=op),
+        aggregate=partial(active_aggregate, op=op),
+        axis=axis,
+        keepdims=keepdims,
+        dtype=dtype,
+        split_every=split_every,
+        concatenate=False,
+        meta=np.array((), dtype=dtype),
+    )
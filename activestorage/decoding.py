@@ -0,0 +1,148 @@
+"""
+The decoding of stored values into the values of a netCDF variable.
+
+Stored values are viewed in place with their stored dtype, byte order
+included (``'>f4'`` for the big-endian floats of a netCDF classic
+file), so decoding never copies: numpy's reduction kernels read either
+byte order, swapping a buffer at a time inside the kernel rather than
+making a swapped copy of the data.
+
+Packed variables (integers with ``scale_factor`` and ``add_offset``)
+are reduced as the stored integers, and the scale and offset applied
+to the partial result afterwards (`Packing.unpack_partial`), which
+touches one value per result element rather than every element read.
+This works for every operation because they all commute with a linear
+map: the minimum of ``s * x + o`` is ``s * min(x) + o`` (or
+``s * max(x) + o`` if ``s`` is negative), the sum is ``s * sum(x) + o *
+n``, central moments scale by powers of ``s``, and so on. Thresholds
+and histogram bins are mapped the other way, into packed units
+(`Packing.packed_operation`).
+
+>>> import numpy as np
+>>> from activestorage.reductions import finalise, partial_reduce
+>>> packing = Packing(scale_factor=0.5, add_offset=100.)
+>>> x = np.array([2, 4, 9], dtype='i2')
+>>> op = packing.packed_operation('mean')
+>>> finalise(packing.unpack_partial(partial_reduce(x, op), 'mean'),
+...          'mean').item()
+102.5
+"""
+import numpy as np
+
+from activestorage.reductions import MOMENT_FIELDS, parse_operation
+
+#: The fields of partial results that swap under a negative scale
+FLIP = {'min': 'max', 'max': 'min'}
+
+
+class Packing:
+    """The ``scale_factor`` and ``add_offset`` of a packed variable."""
+
+    def __init__(self, scale_factor=None, add_offset=None):
+        """
+        Parameters
+        ----------
+        scale_factor: scalar, or None for 1
+        add_offset: scalar, or None for 0
+        """
+        self.scale_factor = scale_factor
+        self.add_offset = add_offset
+
+    @classmethod
+    def from_attributes(cls, attrs):
+        """
+        Read the packing attributes from a dict of attributes.
+
+        Single element array attributes (as read by h5py) are taken as
+        scalars. Returns ``None`` if the values aren't packed.
+        """
+        def scalar(name):
+            value = attrs.get(name)
+            if value is not None and np.size(value) == 1:
+                return np.ravel(value)[0]
+            return value
+
+        scale_factor = scalar('scale_factor')
+        add_offset = scalar('add_offset')
+        if scale_factor is None and add_offset is None:
+            return None
+        return cls(scale_factor, add_offset)
+
+    @classmethod
+    def from_variable(cls, variable):
+        """Read the packing attributes of a `netCDF4.Variable`, or None."""
+        return cls.from_attributes({name: variable.getncattr(name)
+                                    for name in variable.ncattrs()})
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: "
+                f"scale_factor={self.scale_factor} "
+                f"add_offset={self.add_offset}>")
+
+    @property
+    def scale(self):
+        return 1 if self.scale_factor is None else self.scale_factor
+
+    @property
+    def offset(self):
+        return 0 if self.add_offset is None else self.add_offset
+
+    def _pack(self, value):
+        return (value - self.offset) / self.scale
+
+    def packed_operation(self, op):
+        """
+        Return the operation on packed values that answers ``op``.
+
+        Only the arguments of thresholds and histograms need mapping
+        into packed units; a negative scale factor turns "above" into
+        "below", and minima into maxima.
+        """
+        name, args = parse_operation(op)
+        if self.scale < 0 and name in ('min', 'max'):
+            return 'max' if name == 'min' else 'min'
+        if name in ('count_above', 'count_below'):
+            if self.scale < 0:
+                name = ('count_below' if name == 'count_above'
+                        else 'count_above')
+            return f"{name}({float(self._pack(args[0]))!r})"
+        if name == 'histogram':
+            lo, hi = sorted((float(self._pack(args[0])),
+                             float(self._pack(args[1]))))
+            return f"histogram({lo!r}, {hi!r}, {args[2]})"
+        return op
+
+    def unpack_partial(self, partial, op):
+        """
+        Turn the partial result of `packed_operation` into that of ``op``.
+
+        Parameters
+        ----------
+        partial: dict, the partial result of ``packed_operation(op)``
+            over packed values
+        op: str, the operation
+
+        Returns
+        -------
+        dict, the partial result of ``op`` over the unpacked values
+        """
+        scale, offset = self.scale, self.offset
+        if scale < 0:
+            # the least packed value is the greatest unpacked one
+            partial = {FLIP.get(field, field): values
+                       for field, values in partial.items()}
+            if 'histogram' in partial:
+                partial['histogram'] = partial['histogram'][..., ::-1]
+        else:
+            partial = dict(partial)
+
+        for field, values in partial.items():
+            if field in ('min', 'max', 'mean', 'centroids'):
+                partial[field] = values * scale + offset
+            elif field == 'sum':
+                weight = partial.get('weight', partial['count'])
+                partial[field] = values * scale + offset * weight
+            elif field in MOMENT_FIELDS:
+                power = MOMENT_FIELDS.index(field) + 1
+                partial[field] = values * scale**power
+        return partial
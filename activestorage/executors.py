@@ -0,0 +1,233 @@
+"""
+Where the storage-side work of a reduction is done.
+
+`activestorage.chunks.reduce_chunks` hands the reads and reductions of
+stored chunks to an executor, chosen with `get_executor`:
+
+``'serial'``
+    one chunk after another, in the calling thread
+``'threads'`` (the default)
+    a pool of threads; file reads, zlib and numpy release the GIL
+``'processes'``
+    a pool of worker processes, for reductions whose Python overheads
+    (many small chunks, say) keep threads from scaling. The pool is
+    started once per process and reused.
+a ``concurrent.futures.Executor``
+    any pool of the caller's own
+a ``distributed.Client``
+    the workers of a dask cluster (``distributed`` is not a
+    dependency of activestorage; the client is used if given)
+
+Workers outside this process are each given a range of chunks, which
+they read and reduce straight from the file. Workers on this machine
+write their partial results into shared memory (see `SharedPartial`),
+so only the chunk range goes in and nothing is pickled on the way
+back; other workers return them.
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from multiprocessing import shared_memory
+
+import numpy as np
+
+#: The names understood by `get_executor`
+EXECUTORS = ('serial', 'threads', 'processes')
+
+
+class SerialExecutor:
+    """Run every task in the calling thread."""
+
+    #: Tasks run in this process, so can share its objects
+    in_process = True
+    #: Workers can return results through shared memory
+    shared_memory = False
+    workers = 1
+
+    def map(self, function, tasks):
+        return map(function, tasks)
+
+
+class ThreadExecutor:
+    """Run tasks in a pool of threads made for each `map`."""
+
+    in_process = True
+    shared_memory = False
+
+    def __init__(self, max_workers=None):
+        self.workers = max_workers or os.cpu_count() or 1
+
+    def map(self, function, tasks):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            yield from executor.map(function, tasks)
+
+
+class FuturesExecutor:
+    """Run tasks in a ``concurrent.futures.Executor`` of the caller's."""
+
+    def __init__(self, executor, workers=None):
+        self.executor = executor
+        self.in_process = isinstance(executor, ThreadPoolExecutor)
+        self.shared_memory = isinstance(executor, ProcessPoolExecutor)
+        self.workers = (workers or getattr(executor, '_max_workers', None)
+                        or os.cpu_count() or 1)
+
+    def map(self, function, tasks):
+        return self.executor.map(function, tasks)
+
+
+class DistributedExecutor:
+    """Run tasks on the workers of a ``distributed.Client``."""
+
+    in_process = False
+    shared_memory = False
+
+    def __init__(self, client):
+        self.client = client
+        try:
+            self.workers = sum(
+                client.nthreads().values()) or os.cpu_count() or 1
+        except Exception:
+            self.workers = os.cpu_count() or 1
+
+    def map(self, function, tasks):
+        tasks = list(tasks)
+        futures = self.client.map(function, tasks, pure=False)
+        return self.client.gather(futures)
+
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def _process_pool(max_workers):
+    """Return the (started once) process pool with ``max_workers``."""
+    with _process_pools_lock:
+        pool = _process_pools.get(max_workers)
+        if pool is None:
+            # fork is unsafe with the threads (and the netCDF-C state)
+            # of this process
+            context = multiprocessing.get_context('spawn')
+            pool = _process_pools[max_workers] = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=context)
+        return pool
+
+
+@atexit.register
+def _shutdown():
+    with _process_pools_lock:
+        for pool in _process_pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _process_pools.clear()
+
+
+def get_executor(executor=None, max_workers=None):
+    """
+    Return the executor to run storage-side tasks with.
+
+    Parameters
+    ----------
+    executor: one of `EXECUTORS`, a ``concurrent.futures.Executor``, a
+        ``distributed.Client``, or None for ``'threads'``
+    max_workers: int, the number of workers of a ``'threads'`` or
+        ``'processes'`` pool, by default the number of CPUs
+
+    >>> get_executor('serial').workers
+    1
+    """
+    if executor is None or executor == 'threads':
+        return ThreadExecutor(max_workers)
+    if executor == 'serial':
+        return SerialExecutor()
+    if executor == 'processes':
+        workers = max_workers or os.cpu_count() or 1
+        return FuturesExecutor(_process_pool(workers), workers)
+    if isinstance(executor, Executor):
+        return FuturesExecutor(executor, max_workers)
+    if hasattr(executor, 'gather') and hasattr(executor, 'map'):
+        return DistributedExecutor(executor)
+    if isinstance(executor, str):
+        raise ValueError(
+            f"Unknown executor {executor!r}; use one of {EXECUTORS}")
+    raise TypeError(f"Can't run tasks with {executor!r}")
+
+
+class SharedPartial:
+    """
+    Slots for the partial results of many workers, in shared memory.
+
+    Each slot is a partial result (see
+    `activestorage.reductions.partial_reduce`) whose disjoint parts are
+    written by different workers with `write`, so workers never merge
+    into the same values; the slots are merged once every worker is
+    done.
+    """
+
+    def __init__(self, partial, slots):
+        """
+        Parameters
+        ----------
+        partial: dict, an empty partial result, the initial value of
+            every slot
+        slots: int, the number of slots
+        """
+        self.fields = []
+        offset = 0
+        for field, values in partial.items():
+            shape = (slots,) + values.shape
+            nbytes = int(np.prod(shape)) * values.dtype.itemsize
+            self.fields.append((field, shape, values.dtype.str, offset))
+            offset += -(-nbytes // 8) * 8
+        self.memory = shared_memory.SharedMemory(create=True,
+                                                 size=max(offset, 1))
+        for field, values in self.arrays().items():
+            values[...] = partial[field]
+
+    @property
+    def spec(self):
+        """What a worker needs to `write` to a slot."""
+        return self.memory.name, self.fields
+
+    def arrays(self):
+        """The fields of all slots, with the slots along the first axis."""
+        return _views(self.memory.buf, self.fields)
+
+    def close(self):
+        """Free the shared memory."""
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _views(buffer, fields):
+    return {field: np.ndarray(shape, dtype=dtype, buffer=buffer,
+                              offset=offset)
+            for field, shape, dtype, offset in fields}
+
+
+def write(spec, regions):
+    """
+    Write a worker's partial results into a `SharedPartial`.
+
+    Parameters
+    ----------
+    spec: `SharedPartial.spec`
+    regions: sequence of ``(slot, index, partial)``, the partial result
+        of the part ``index`` of a slot
+    """
+    name, fields = spec
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        arrays = _views(memory.buf, fields)
+        for slot, index, partial in regions:
+            for field, values in arrays.items():
+                values[slot][index] = partial[field]
+        # the views must be gone before the memory is closed
+        del arrays, values
+    finally:
+        memory.close()
@@ -0,0 +1,338 @@
+"""
+A process-wide pool of open netCDF datasets and their variable metadata.
+
+Opening a netCDF file parses its header and, for netCDF4, the HDF5
+object headers of the groups; on a parallel file system that can take
+tens of milliseconds. `DatasetPool` keeps recently used datasets open,
+keyed by filename, so that the many subspaces read by dask tasks share
+one handle per file:
+
+>>> pool = dataset_pool()
+>>> with pool.dataset('tas.nc') as nc, netcdf_lock:  # doctest: +SKIP
+...     data = nc.variables['tas'][0]
+
+The netCDF-C library is not thread safe, so calls into any handle of
+the pool are made holding `netcdf_lock` (the raw chunk reads of
+`activestorage.chunks` don't need a handle, so still run in
+parallel). The lock is taken after a handle is checked out, never
+while waiting for one. The least recently used idle handles are closed once
+``max_open`` are open, and a file that has changed on disk since it was
+opened is opened again. The metadata of each variable (`VariableMetadata`)
+and the layout of its stored chunks are cached as well, so that
+planning a read needs no handle at all, and so are the values of the
+weight variables of weighted reductions (e.g. cell areas), which are
+read once per grid.
+
+Close a file's handle with ``dataset_pool().close(filename)`` before
+opening it for writing in the same process.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import netCDF4
+import numpy as np
+
+from activestorage.chunks import StorageLayout
+from activestorage.decoding import Packing
+from activestorage.reductions import MissingValues
+
+logger = logging.getLogger(__name__)
+
+#: Held while calling the (not thread safe) netCDF-C library
+netcdf_lock = threading.RLock()
+
+
+def find_variable(netcdf, ncvar, group=None):
+    """
+    Return a `netCDF4.Variable` from an open dataset.
+
+    ``group`` is a sequence of group names, from the root group
+    downwards, as for `activestorage.netcdf_array.NetCDFArray`.
+    """
+    for g in group or ():
+        netcdf = netcdf.groups[g]
+    return netcdf.variables[ncvar]
+
+
+def _signature(filename):
+    """What identifies one version of a file on disk."""
+    stat = os.stat(filename)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class VariableMetadata:
+    """What is needed to plan a read of a netCDF variable."""
+
+    def __init__(self, dtype, shape, chunking, filters, missing, packing,
+                 dimensions=None):
+        """
+        Parameters
+        ----------
+        dtype: numpy dtype of the variable
+        shape: tuple of int
+        chunking: sequence of int, or ``'contiguous'`` or None (netCDF3),
+            as returned by ``netCDF4.Variable.chunking``
+        filters: dict, as returned by ``netCDF4.Variable.filters``
+        missing: `MissingValues` or None
+        packing: `activestorage.decoding.Packing`, or None if the
+            variable isn't packed
+        dimensions: sequence of str, the names of the dimensions
+        """
+        self.dtype = dtype
+        self.shape = tuple(shape)
+        self.chunking = chunking
+        self.filters = filters
+        self.missing = missing
+        self.packing = packing
+        self.dimensions = None if dimensions is None else tuple(dimensions)
+
+    @classmethod
+    def from_variable(cls, variable):
+        """Read the metadata of a `netCDF4.Variable`."""
+        return cls(variable.dtype, variable.shape, variable.chunking(),
+                   variable.filters(), MissingValues.from_variable(variable),
+                   Packing.from_variable(variable), variable.dimensions)
+
+    @property
+    def packed(self):
+        """Whether the variable has ``scale_factor`` or ``add_offset``."""
+        return self.packing is not None
+
+    @property
+    def chunk_shape(self):
+        """Shape of a storage chunk, the whole shape if not chunked."""
+        if self.chunking is None or self.chunking == 'contiguous':
+            return self.shape
+        return tuple(self.chunking)
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {self.dtype} {self.shape} "
+                f"chunks={self.chunk_shape}>")
+
+
+class _Handle:
+    """An open dataset, or one being opened."""
+
+    def __init__(self):
+        self.dataset = None
+        self.error = None
+        self.signature = None
+        self.users = 0
+        self.ready = threading.Event()
+
+
+class DatasetPool:
+    """
+    Open `netCDF4.Dataset` handles, shared between threads.
+
+    ``hits`` and ``misses`` count the requests for a handle that found
+    it open and that had to open the file.
+    """
+
+    def __init__(self, max_open=128):
+        """
+        Parameters
+        ----------
+        max_open: int, the most files to keep open; a thread that needs
+            another file waits for a handle to become idle
+        """
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self._handles = OrderedDict()
+        self._metadata = {}
+        self._layouts = {}
+        self._weights = {}
+        self._changed = threading.Condition()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {len(self)} of "
+                f"{self.max_open} open>")
+
+    def _check_fork(self):
+        """Forget the parent's handles in a forked child process."""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._handles = OrderedDict()
+
+    def _evict(self):
+        """Remove the least recently used idle handle and return it."""
+        for filename, handle in self._handles.items():
+            if not handle.users:
+                del self._handles[filename]
+                return handle
+        return None
+
+    @staticmethod
+    def _close(handles):
+        """Close removed handles (without holding the pool's lock)."""
+        for handle in handles:
+            with netcdf_lock:
+                filename = handle.dataset.filepath()
+                handle.dataset.close()
+            logger.debug("Closed %s", filename)
+
+    def _checkout(self, filename):
+        """Return the handle of a file, opening it if need be."""
+        signature = _signature(filename)
+        closing = []
+        opener = False
+        with self._changed:
+            self._check_fork()
+            while True:
+                handle = self._handles.get(filename)
+                if handle is not None and handle.signature != signature \
+                        and not handle.users:
+                    # the file has changed since it was opened
+                    closing.append(self._handles.pop(filename))
+                    handle = None
+                if handle is not None:
+                    self._handles.move_to_end(filename)
+                    handle.users += 1
+                    self.hits += 1
+                    break
+                if len(self._handles) >= self.max_open:
+                    evicted = self._evict()
+                    if evicted is None:
+                        self._changed.wait()
+                        continue
+                    closing.append(evicted)
+
+                # Open the file outside the pool's lock; threads that
+                # want the same file wait until the handle is ready
+                handle = _Handle()
+                handle.users = 1
+                handle.signature = signature
+                self._handles[filename] = handle
+                self.misses += 1
+                opener = True
+                break
+
+        self._close(closing)
+        if not opener:
+            return handle
+
+        try:
+            with netcdf_lock:
+                handle.dataset = netCDF4.Dataset(filename, "r")
+        except (OSError, RuntimeError) as error:
+            handle.error = RuntimeError(f"{error}: {filename}")
+            with self._changed:
+                if self._handles.get(filename) is handle:
+                    del self._handles[filename]
+                handle.users -= 1
+                self._changed.notify_all()
+            raise handle.error
+        finally:
+            handle.ready.set()
+        return handle
+
+    def _checkin(self, handle):
+        with self._changed:
+            handle.users -= 1
+            self._changed.notify_all()
+
+    @contextmanager
+    def dataset(self, filename):
+        """
+        Use the open `netCDF4.Dataset` of a file.
+
+        The handle may be used by other threads at the same time, so
+        calls into the dataset must hold `netcdf_lock`. That lock must
+        not be held on entering the context, as this may wait for
+        another thread to return a handle.
+        """
+        filename = os.fspath(filename)
+        handle = self._checkout(filename)
+        try:
+            handle.ready.wait()
+            if handle.dataset is None:
+                raise handle.error
+            yield handle.dataset
+        finally:
+            self._checkin(handle)
+
+    def _cached(self, cache, filename, ncvar, group, read):
+        """Return ``read(filename)``, cached while the file is unchanged."""
+        filename = os.fspath(filename)
+        key = (filename, tuple(group or ()), ncvar)
+        signature = _signature(filename)
+        cached = cache.get(key)
+        if cached is None or cached[0] != signature:
+            cached = cache[key] = (signature, read(filename))
+        return cached[1]
+
+    def metadata(self, filename, ncvar, group=None):
+        """Return the (cached) `VariableMetadata` of a variable."""
+        def read(filename):
+            with self.dataset(filename) as netcdf, netcdf_lock:
+                return VariableMetadata.from_variable(
+                    find_variable(netcdf, ncvar, group))
+
+        return self._cached(self._metadata, filename, ncvar, group, read)
+
+    def storage_layout(self, filename, ncvar, group=None):
+        """
+        Return the (cached) `StorageLayout` of a variable.
+
+        ``None`` if the stored chunks can't be read directly.
+        """
+        def read(filename):
+            return StorageLayout.from_file(filename, ncvar, group)
+
+        return self._cached(self._layouts, filename, ncvar, group, read)
+
+    def weights(self, filename, ncvar, group=None):
+        """
+        Return the (cached) values of a variable, as reduction weights.
+
+        Missing values (e.g. the land points of an ocean cell area)
+        have zero weight. The array is read-only, as it is shared.
+        """
+        def read(filename):
+            with self.dataset(filename) as netcdf, netcdf_lock:
+                variable = find_variable(netcdf, ncvar, group)
+                variable.set_auto_maskandscale(True)
+                weights = np.ma.filled(variable[...], 0)
+            weights = np.asarray(weights, dtype=np.float64)
+            weights.flags.writeable = False
+            return weights
+
+        return self._cached(self._weights, filename, ncvar, group, read)
+
+    def close(self, filename=None):
+        """
+        Close idle handles and forget cached metadata.
+
+        Parameters
+        ----------
+        filename: str, only close this file, by default close them all
+        """
+        closing = []
+        with self._changed:
+            for name, handle in list(self._handles.items()):
+                if filename is not None and name != os.fspath(filename):
+                    continue
+                if not handle.users:
+                    closing.append(self._handles.pop(name))
+            for cache in (self._metadata, self._layouts, self._weights):
+                for key in list(cache):
+                    if filename is None or key[0] == os.fspath(filename):
+                        del cache[key]
+            self._changed.notify_all()
+        self._close(closing)
+
+
+_pool = DatasetPool()
+
+
+def dataset_pool():
+    """Return the process-wide `DatasetPool`."""
+    return _pool
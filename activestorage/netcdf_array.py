@@ -0,0 +1,460 @@
+"""A netCDF variable presented as a lazily read, numpy-like array."""
+import logging
+
+import netCDF4
+import numpy as np
+
+from activestorage import stats
+from activestorage.chunks import orthogonal_index, reduce_chunks
+from activestorage.handles import dataset_pool, find_variable, netcdf_lock
+from activestorage.plan import plan_selection, subspace_dimensions
+from activestorage.reductions import (
+    empty_partial,
+    merge_into,
+    normalise_axis,
+    partial_reduce,
+    weighted_dtype,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class NetCDFArray:
+    """An underlying array stored in a netCDF file.
+
+    .. versionadded:: (cfdm) 1.7.0
+
+    """
+
+    def __init__(
+        self,
+        filename=None,
+        ncvar=None,
+        varid=None,
+        group=None,
+        dtype=None,
+        ndim=None,
+        shape=None,
+        size=None,
+        mask=True,
+        active_method=None,
+        active_axis=None,
+        max_workers=None,
+        active_client=None,
+        active_weights=None,
+        executor=None,
+    ):
+        """**Initialisation**
+
+        :Parameters:
+
+            filename: `str`
+                The name of the netCDF file containing the array.
+
+            ncvar: `str`, optional
+                The name of the netCDF variable containing the
+                array. Required unless *varid* is set.
+
+            group: `None` or sequence of `str`, optional
+                Specify the netCDF4 group to which the netCDF variable
+                belongs. By default, or if *group* is `None` or an
+                empty sequence, it assumed to be in the root
+                group. The last element in the sequence is the name of
+                the group in which the variable lies, with other
+                elements naming any parent groups (excluding the root
+                group).
+
+                *Parameter example:*
+                  To specify that a variable is in the root group:
+                  ``group=()`` or ``group=None``
+
+                *Parameter example:*
+                  To specify that a variable is in the group '/forecasts':
+                  ``group=['forecasts']``
+
+                *Parameter example:*
+                  To specify that a variable is in the group
+                  '/forecasts/model2': ``group=['forecasts', 'model2']``
+
+                .. versionadded:: (cfdm) 1.8.6.0
+
+            dtype: `numpy.dtype`
+                The data type of the array in the netCDF file. May be
+                `None` if the numpy data-type is not known (which can be
+                the case for netCDF string types, for example).
+
+            shape: `tuple`
+                The array dimension sizes in the netCDF file.
+
+            size: `int`
+                Number of elements in the array in the netCDF file.
+
+            ndim: `int`
+                The number of array dimensions in the netCDF file.
+
+            mask: `bool`
+                If False then do not mask by convention when reading data
+                from disk. By default data is masked by convention.
+
+                A netCDF array is masked depending on the values of any of
+                the netCDF variable attributes ``valid_min``,
+                ``valid_max``, ``valid_range``, ``_FillValue`` and
+                ``missing_value``.
+
+                .. versionadded:: (cfdm) 1.8.2
+
+            active_method: `str`, optional
+                If set, one of the reduction operations in
+                `activestorage.reductions.OPERATIONS` or ``SKETCHES``
+                (such as ``'quantile(0.95)'``). Indexing then
+                returns the partial result of that reduction over the
+                subspace, computed chunk by chunk next to the data,
+                instead of the data themselves.
+
+            active_axis: `int`, `str` or sequence of them, optional
+                The axes of the subspace that *active_method* reduces,
+                by position or by dimension name (e.g. ``'time'``).
+                By default all of them.
+
+            max_workers: `int`, optional
+                The number of workers that read, decompress and reduce
+                stored chunks for *active_method*. By default the
+                number of CPUs.
+
+            active_client: `ActiveStorageClient`, optional
+                If set, the stored chunks for *active_method* are
+                reduced by this active storage server instead of
+                locally. Requests from concurrent subspaces of the
+                same file are batched by the client.
+
+            active_weights: array_like, optional
+                Weights for *active_method* that broadcast against the
+                whole array, such as cell areas of shape ``(lat,
+                lon)`` for a ``(time, lat, lon)`` variable, or a 0/1
+                land-sea mask. Sums and means are weighted, and
+                elements with zero weight are ignored by every
+                operation. Each stored chunk is reduced with its own
+                part of the weights as it is read. Weighted
+                reductions are always made here, even if
+                *active_client* is set.
+
+            executor: optional
+                What reads, decompresses and reduces the stored chunks
+                for *active_method*: ``'serial'``, ``'threads'`` (the
+                default), ``'processes'``, a
+                `concurrent.futures.Executor` or a
+                ``distributed.Client``. See `activestorage.executors`.
+
+        **Examples:**
+
+        >>> import netCDF4  # doctest: +SKIP
+        >>> nc = netCDF4.Dataset('file.nc', 'r')  # doctest: +SKIP
+        >>> v = nc.variable['tas']  # doctest: +SKIP
+        >>> a = NetCDFArray(filename='file.nc', ncvar='tas',
+        ...                 group=['forecast'], dtype=v.dtype,
+        ...                 ndim=v.ndim,
+        ...                 shape=v.shape, size=v.size)  # doctest: +SKIP
+
+        """
+        self.filename = filename
+        self.ncvar = ncvar
+        self.group = group
+        self.dtype = dtype
+        self.ndim = ndim
+        self.shape = shape
+        self.size = size
+        self.mask = mask
+        self.active_method = active_method
+        self.active_axis = active_axis
+        self.max_workers = max_workers
+        self.active_client = active_client
+        self.active_weights = active_weights
+        self.executor = executor
+
+    def __getitem__(self, indices):
+        """Returns a subspace of the array as a numpy array.
+
+        x.__getitem__(indices) <==> x[indices]
+
+        The indices that define the subspace must be either `Ellipsis` or
+        a sequence that contains an index for each dimension. In the
+        latter case, each dimension's index must either be a `slice`
+        object or a sequence of two or more integers.
+
+        Indexing is similar to numpy indexing. The only difference to
+        numpy indexing (given the restrictions on the type of indices
+        allowed) is:
+
+          * When two or more dimension's indices are sequences of integers
+            then these indices work independently along each dimension
+            (similar to the way vector subscripts work in Fortran).
+
+        If *active_method* is set then the partial result of that
+        reduction over the subspace is returned instead, as a `dict`
+        of arrays (see `activestorage.reductions.partial_reduce`).
+
+        .. versionadded:: (cfdm) 1.7.0
+
+        """
+        pool = dataset_pool()
+        method = self.active_method
+        if method is None:
+            # Read the data
+            with stats.record(None, self.filename, self.ncvar,
+                              route="read") as request:
+                with pool.dataset(self.filename) as netcdf, netcdf_lock:
+                    variable = self._variable(netcdf)
+                    # the handle is shared, so set both flags every time
+                    variable.set_auto_mask(self.mask)
+                    variable.set_auto_scale(True)
+                    with request.stage("read"):
+                        array = variable[indices]
+                request.add(bytes_read=array.nbytes,
+                            bytes_returned=array.nbytes)
+            return array
+
+        with stats.record(method, self.filename, self.ncvar) as request:
+            partial = self._reduce(pool, indices, request)
+            request.add(bytes_returned=sum(
+                values.nbytes for values in partial.values()))
+
+        logger.debug("%s partial 'coming from storage': %s", method, partial)
+        return partial
+
+    def _reduce(self, pool, indices, request):
+        """Return the partial result of *active_method* over a subspace.
+
+        The work done is counted in *request*, an
+        `activestorage.stats.RequestStats`.
+
+        """
+        metadata = pool.metadata(self.filename, self.ncvar, self.group)
+
+        # Missing data are found inside the reduction kernel, rather
+        # than by reading a masked array. Packed data are reduced as
+        # the stored integers (whose missing values are stored values
+        # too), and the partial result unpacked at the end.
+        packing = metadata.packing
+        missing = metadata.missing if self.mask else None
+        if packing is None:
+            return self._reduce_stored(pool, metadata, indices,
+                                       self.active_method, missing, request)
+
+        partial = self._reduce_stored(
+            pool, metadata, indices,
+            packing.packed_operation(self.active_method), missing, request)
+        return packing.unpack_partial(partial, self.active_method)
+
+    def _reduce_stored(self, pool, metadata, indices, method, missing,
+                       request):
+        """Return the partial result of *method* over the stored values.
+
+        """
+
+        plan = plan_selection(metadata.shape, metadata.chunk_shape, indices,
+                              dtype=metadata.dtype, filters=metadata.filters)
+        axis = normalise_axis(
+            self.active_axis, len(plan.out_shape),
+            subspace_dimensions(metadata.dimensions, plan.indices))
+        shape = tuple(1 if i in axis else n
+                      for i, n in enumerate(plan.out_shape))
+
+        weights = self.active_weights
+        if weights is not None:
+            # The weights of the subspace: a view of them, unless they
+            # are indexed by sequences of integers
+            weights = np.ma.filled(weights, 0)
+            weights = orthogonal_index(
+                np.broadcast_to(weights, metadata.shape), plan.indices)
+
+        layout = self.storage_layout()
+        if layout is not None:
+            # Read, decode and reduce the raw stored chunks in
+            # parallel, bypassing libnetcdf
+            layout.attach(plan)
+            if self.active_client is not None and weights is None:
+                request.route = "server"
+                return self.active_client.reduce_chunks(
+                    self.filename, layout, plan, method, axis,
+                    missing=missing, stats=request)
+
+            request.route = "chunks"
+            return reduce_chunks(self.filename, layout, plan, method, axis,
+                                 missing=missing,
+                                 max_workers=self.max_workers,
+                                 weights=weights, executor=self.executor,
+                                 stats=request)
+
+        # Reduce each storage chunk as it is read: whole chunks come
+        # straight off the disk and only the edge chunks of the
+        # selection need a sub-selection
+        request.route = "netcdf"
+        partial = None
+        weighted = weights is not None
+        with pool.dataset(self.filename) as netcdf:
+            with netcdf_lock:
+                variable = self._variable(netcdf)
+            for chunk in plan:
+                with request.stage("read"), netcdf_lock:
+                    # other threads may change the flags between reads
+                    variable.set_auto_maskandscale(False)
+                    data = variable[chunk.array_selection]
+                chunk_weights = None
+                if weighted:
+                    chunk_weights = orthogonal_index(weights,
+                                                     chunk.out_selection)
+                if partial is None:
+                    partial = empty_partial(
+                        method, shape, weighted_dtype(data.dtype, weights),
+                        weighted=weighted)
+                with request.stage("reduce"):
+                    merge_into(partial,
+                               partial_reduce(data, method, axis,
+                                              missing=missing,
+                                              weights=chunk_weights),
+                               method, chunk.out_index(axis))
+                # libnetcdf only tells us the decoded size
+                request.add(bytes_read=data.nbytes,
+                            bytes_decompressed=data.nbytes,
+                            elements=data.size)
+
+            if partial is None:
+                partial = empty_partial(
+                    method, shape, weighted_dtype(variable.dtype, weights),
+                    weighted=weighted)
+
+        return partial
+
+    def __repr__(self):
+        """Returns a printable representation of the `NetCDFArray`.
+
+        x.__repr__() is logically equivalent to repr(x)
+
+        """
+        return str(self)
+
+    def __str__(self):
+        """Returns a string version of the `NetCDFArray` object.
+
+        x.__str__() is logically equivalent to str(x)
+
+        """
+        return (
+            f"<{self.__class__.__name__}{self.shape}: "
+            f"file={self.filename} variable={self.ncvar}>"
+        )
+
+    def _variable(self, netcdf):
+        """Return the `netCDF4.Variable` from an open dataset.
+
+        Traverses the group structure, if there is one (CF>=1.8).
+
+        """
+        return find_variable(netcdf, self.ncvar, self.group)
+
+    def storage_layout(self):
+        """Return the layout of the variable's stored chunks.
+
+        The chunk index is read once per process, and again only if
+        the file changes (see `activestorage.handles.DatasetPool`).
+
+        :Returns:
+
+            `StorageLayout` or `None`
+                `None` if the stored chunks can't be read directly, in
+                which case data are read with `netCDF4`.
+
+        """
+        return dataset_pool().storage_layout(
+            self.filename, self.ncvar, self.group
+        )
+
+    def missing_values(self):
+        """Return the missing data conventions of the variable.
+
+        The netCDF attributes are read once per process, and again
+        only if the file changes.
+
+        :Returns:
+
+            `MissingValues` or `None`
+                `None` if the variable has no missing data.
+
+        """
+        return dataset_pool().metadata(
+            self.filename, self.ncvar, self.group
+        ).missing
+
+    def plan(self, indices=Ellipsis):
+        """Return the storage chunks touched by a subspace of the array.
+
+        :Parameters:
+
+            indices: optional
+                The subspace, as would be given to `__getitem__`. By
+                default the whole array.
+
+        :Returns:
+
+            `ChunkPlan`
+
+        **Examples:**
+
+        >>> plan = a.plan((slice(0, 6), ..., slice(0, 100)))  # doctest: +SKIP
+        >>> len(plan.full_chunks), len(plan.partial_chunks)  # doctest: +SKIP
+        (1, 1)
+
+        """
+        metadata = dataset_pool().metadata(
+            self.filename, self.ncvar, self.group
+        )
+        return plan_selection(metadata.shape, metadata.chunk_shape, indices,
+                              dtype=metadata.dtype, filters=metadata.filters)
+
+    def close(self):
+        """Close the `netCDF4.Dataset` for the file containing the data.
+
+        .. versionadded:: (cfdm) 1.7.0
+
+        :Returns:
+
+            `None`
+
+        **Examples:**
+
+        >>> a.close()  # doctest: +SKIP
+
+        """
+        netcdf = getattr(self, "netcdf", None)
+        if netcdf is None:
+            return
+
+        del self.netcdf
+
+    def open(self):
+        """Returns an open `netCDF4.Dataset` for the array's file.
+
+        .. versionadded:: (cfdm) 1.7.0
+
+        :Returns:
+
+            `netCDF4.Dataset`
+
+        **Examples:**
+
+        >>> netcdf = a.open()  # doctest: +SKIP
+        >>> variable = netcdf.variables[a.ncvar()]  # doctest: +SKIP
+        >>> variable.getncattr('standard_name')  # doctest: +SKIP
+        'eastward_wind'
+
+        """
+        netcdf = getattr(self, "netcdf", None)
+        if netcdf is None:
+            try:
+                netcdf = netCDF4.Dataset(self.filename, "r")
+            except RuntimeError as error:
+                raise RuntimeError(f"{error}: {self.filename}")
+
+            self.netcdf = netcdf
+
+        return netcdf
@@ -0,0 +1,366 @@
+"""
+Map an index into a netCDF variable on to the storage chunks it touches.
+
+A `ChunkPlan` lists, for every storage chunk that intersects a
+selection, which part of the chunk is selected and whether the chunk
+is wholly covered. Whole chunks can be reduced as they come off the
+disk; only the edge chunks need a sub-selection.
+
+>>> plan = plan_selection((6, 8, 16), (3, 8, 8),
+...                       (slice(0, 6), slice(0, 8), slice(0, 12)))
+>>> plan
+<ChunkPlan: 4 chunks (2 full, 2 partial) of (3, 8, 8) for shape (6, 8, 16)>
+>>> [c.coords for c in plan.partial_chunks]
+[(0, 0, 1), (1, 0, 1)]
+>>> plan.partial_chunks[0].selection
+(slice(0, 3, 1), slice(0, 8, 1), slice(0, 4, 1))
+"""
+import itertools
+from numbers import Integral
+
+import numpy as np
+
+
+def normalise_indices(indices, shape):
+    """
+    Return ``indices`` as one normalised index per dimension.
+
+    Each element of the returned tuple is either a `slice` with
+    non-negative start, stop and a positive step, a one dimensional
+    integer numpy array, or an `int` (a dimension that is dropped from
+    the result, as with numpy indexing).
+
+    >>> normalise_indices((Ellipsis, 3), (4, 5, 6))
+    (slice(0, 4, 1), slice(0, 5, 1), 3)
+    >>> normalise_indices(slice(None, None, -2), (5,))
+    (array([4, 2, 0]),)
+    """
+    if not isinstance(indices, tuple):
+        indices = (indices,)
+
+    n_ellipsis = sum(index is Ellipsis for index in indices)
+    if n_ellipsis > 1:
+        raise IndexError("An index can only have a single ellipsis ('...')")
+    if n_ellipsis:
+        i = next(i for i, index in enumerate(indices) if index is Ellipsis)
+        fill = (slice(None),) * (len(shape) - len(indices) + 1)
+        indices = indices[:i] + fill + indices[i + 1:]
+    if len(indices) > len(shape):
+        raise IndexError(f"Too many indices for shape {tuple(shape)}")
+    indices = indices + (slice(None),) * (len(shape) - len(indices))
+
+    normalised = []
+    for index, size in zip(indices, shape):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(size)
+            if step < 0:
+                index = np.arange(start, stop, step)
+            else:
+                index = slice(start, max(start, stop), step)
+        elif isinstance(index, Integral):
+            if not -size <= index < size:
+                raise IndexError(f"Index {index} is out of bounds for "
+                                 f"dimension size {size}")
+            index = int(index) % size
+        else:
+            index = np.asanyarray(index)
+            if index.dtype == bool:
+                index = np.flatnonzero(index)
+            if index.ndim != 1 or index.dtype.kind not in 'iu':
+                raise IndexError(f"Unsupported index {index!r}")
+            if index.size and not (-size <= index.min()
+                                   and index.max() < size):
+                raise IndexError(f"Index {index} is out of bounds for "
+                                 f"dimension size {size}")
+            index = index % size
+        normalised.append(index)
+
+    return tuple(normalised)
+
+
+def index_size(index):
+    """
+    Return the number of elements selected by one normalised index.
+
+    ``index`` is one of the indices made by `normalise_indices`.
+
+    >>> index_size(slice(2, 9, 3)), index_size(4), index_size(np.arange(5))
+    (3, 1, 5)
+    """
+    if isinstance(index, slice):
+        return len(range(index.start, index.stop, index.step))
+    if isinstance(index, int):
+        return 1
+    return index.size
+
+
+def subspace_dimensions(dimensions, indices):
+    """
+    Return the names of the dimensions of a subspace.
+
+    ``indices`` are normalised (see `normalise_indices`), and the
+    dimensions dropped by integer indices are left out.
+
+    >>> subspace_dimensions(('time', 'lat', 'lon'),
+    ...                     (slice(0, 4, 1), 3, slice(0, 6, 1)))
+    ('time', 'lon')
+    """
+    if dimensions is None:
+        return None
+    return tuple(name for name, index in zip(dimensions, indices)
+                 if not isinstance(index, int))
+
+
+def _covers(local, n):
+    """Whether a chunk-relative index selects all ``n`` chunk elements."""
+    if isinstance(local, slice):
+        return local.step == 1 and local.stop - local.start == n
+    if isinstance(local, int):
+        return n == 1
+    return np.unique(local).size == n
+
+
+def intersect(index, lo, hi):
+    """
+    Intersect one normalised index with the chunk extent ``[lo, hi)``.
+
+    ``index`` is one of the indices made by `normalise_indices`, and
+    the extent may be that of any block along its dimension (a storage
+    chunk, or a file of an aggregation).
+
+    Returns a ``(local, out)`` pair: the selection relative to the
+    chunk and the positions it occupies in the selection's output
+    (None for an integer index, which drops its dimension), or
+    ``None`` if nothing in the chunk is selected.
+
+    >>> intersect(slice(1, 20, 3), 8, 16)
+    (slice(2, 6, 3), slice(3, 5, None))
+    >>> intersect(np.array([3, 9, 12]), 8, 16)
+    (array([1, 4]), array([1, 2]))
+    >>> intersect(5, 8, 16) is None
+    True
+    """
+    if isinstance(index, int):
+        if lo <= index < hi:
+            return index - lo, None
+        return None
+
+    if isinstance(index, slice):
+        start, stop, step = index.start, index.stop, index.step
+        first = start if lo <= start else start - (start - lo) // step * step
+        last = min(stop, hi)
+        if first >= last:
+            return None
+        n = len(range(first, last, step))
+        out_start = (first - start) // step
+        return (slice(first - lo, first - lo + (n - 1) * step + 1, step),
+                slice(out_start, out_start + n))
+
+    positions = np.flatnonzero((index >= lo) & (index < hi))
+    if not positions.size:
+        return None
+    return index[positions] - lo, positions
+
+
+class ChunkSelection:
+    """The part of one storage chunk touched by a selection."""
+
+    def __init__(self, coords, extent, selection, out_selection, full,
+                 offset=None, size=None):
+        """
+        Parameters
+        ----------
+        coords: tuple of int, position of the chunk in the chunk grid
+        extent: tuple of slice, the chunk's extent in the whole array,
+            clipped to the array shape for chunks on its edges
+        selection: tuple, the selected part of the chunk, relative to
+            the start of the chunk (see `normalise_indices`)
+        out_selection: tuple, where the selected values go in the
+            (unreduced) result of the whole selection
+        full: bool, whether every element of the chunk is selected
+        offset: int, byte offset of the stored chunk, if known
+        size: int, stored (possibly compressed) size in bytes, if known
+        """
+        self.coords = coords
+        self.extent = extent
+        self.selection = selection
+        self.out_selection = out_selection
+        self.full = full
+        self.offset = offset
+        self.size = size
+
+    @property
+    def shape(self):
+        """Shape of the chunk, clipped to the array shape."""
+        return tuple(s.stop - s.start for s in self.extent)
+
+    @property
+    def array_selection(self):
+        """The selected part of the chunk in whole-array coordinates."""
+        selection = []
+        for index, e in zip(self.selection, self.extent):
+            if isinstance(index, slice):
+                index = slice(index.start + e.start, index.stop + e.start,
+                              index.step)
+            elif self.full and not isinstance(index, int):
+                # the whole chunk is selected, so don't use fancy indexing
+                index = e
+            else:
+                index = index + e.start
+            selection.append(index)
+        return tuple(selection)
+
+    def out_index(self, axis=()):
+        """
+        Index of the chunk's part of the (partial) result of a selection.
+
+        Axes in ``axis`` have been reduced to size 1, so are selected
+        whole.
+        """
+        index = [slice(None) if i in axis else o
+                 for i, o in enumerate(self.out_selection)]
+        if all(isinstance(i, slice) for i in index):
+            return tuple(index)
+        return np.ix_(*[np.arange(i.start or 0, i.stop or 1)
+                        if isinstance(i, slice) else i for i in index])
+
+    @property
+    def nselected(self):
+        """Number of elements of the chunk that are selected."""
+        return int(np.prod([index_size(index)
+                            for index in self.selection]))
+
+    def __repr__(self):
+        kind = 'full' if self.full else 'partial'
+        return f"<ChunkSelection {self.coords}: {kind}>"
+
+
+class ChunkPlan:
+    """
+    The storage chunks touched by a selection of a chunked array.
+
+    Iterating over a plan yields its `ChunkSelection` objects in
+    storage (C) order of the chunk grid.
+    """
+
+    def __init__(self, shape, chunk_shape, indices, chunks, dtype=None,
+                 filters=None):
+        """
+        Parameters
+        ----------
+        shape: tuple of int, shape of the whole array
+        chunk_shape: tuple of int, shape of a storage chunk (the whole
+            array shape for contiguous storage)
+        indices: tuple, the normalised selection (`normalise_indices`)
+        chunks: list of `ChunkSelection`
+        dtype: numpy dtype of the stored data, if known
+        filters: dict of the storage filters (as returned by
+            ``netCDF4.Variable.filters``), if known
+        """
+        self.shape = tuple(shape)
+        self.chunk_shape = tuple(chunk_shape)
+        self.indices = indices
+        self.chunks = chunks
+        self.dtype = dtype
+        self.filters = filters
+
+    @classmethod
+    def from_variable(cls, variable, indices=Ellipsis):
+        """
+        Plan a selection of a `netCDF4.Variable`.
+
+        The chunk layout and filters are read from the variable's
+        metadata; no data are read.
+        """
+        chunking = variable.chunking()
+        shape = variable.shape
+        if chunking is None or chunking == 'contiguous':
+            # netCDF3 files return None, and are never chunked
+            chunk_shape = shape
+        else:
+            chunk_shape = tuple(chunking)
+        return plan_selection(shape, chunk_shape, indices,
+                              dtype=variable.dtype,
+                              filters=variable.filters())
+
+    @property
+    def contiguous(self):
+        """True if the array is stored as a single contiguous block."""
+        return self.chunk_shape == self.shape
+
+    @property
+    def out_shape(self):
+        """Shape of the (unreduced) result of the selection."""
+        return tuple(index_size(index) for index in self.indices
+                     if not isinstance(index, int))
+
+    @property
+    def full_chunks(self):
+        """The chunks that are wholly selected."""
+        return [chunk for chunk in self.chunks if chunk.full]
+
+    @property
+    def partial_chunks(self):
+        """The chunks that are only partly selected."""
+        return [chunk for chunk in self.chunks if not chunk.full]
+
+    @property
+    def nselected(self):
+        """Total number of selected elements."""
+        return sum(chunk.nselected for chunk in self.chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __repr__(self):
+        nfull = len(self.full_chunks)
+        return (f"<{self.__class__.__name__}: {len(self)} chunks "
+                f"({nfull} full, {len(self) - nfull} partial) of "
+                f"{self.chunk_shape} for shape {self.shape}>")
+
+
+def plan_selection(shape, chunk_shape, indices=Ellipsis, dtype=None,
+                   filters=None):
+    """
+    Return the `ChunkPlan` for ``indices`` into a chunked array.
+
+    Parameters
+    ----------
+    shape: tuple of int, shape of the whole array
+    chunk_shape: tuple of int, shape of a storage chunk
+    indices: anything accepted by `normalise_indices`
+    dtype, filters: recorded on the plan, see `ChunkPlan`
+    """
+    indices = normalise_indices(indices, shape)
+
+    per_dim = []
+    for index, size, csize in zip(indices, shape, chunk_shape):
+        touched = []
+        for c in range(-(-size // csize)):
+            lo, hi = c * csize, min((c + 1) * csize, size)
+            hit = intersect(index, lo, hi)
+            if hit is not None:
+                local, out = hit
+                full = _covers(local, hi - lo)
+                touched.append((c, slice(lo, hi), local, out, full))
+        per_dim.append(touched)
+
+    chunks = []
+    for combination in itertools.product(*per_dim):
+        if not combination:
+            # a scalar variable is a single, wholly selected, chunk
+            chunks.append(ChunkSelection((), (), (), (), True))
+            continue
+        coords, extent, local, out, full = zip(*combination)
+        chunks.append(ChunkSelection(
+            coords=coords,
+            extent=extent,
+            selection=local,
+            out_selection=tuple(o for o in out if o is not None),
+            full=all(full)))
+
+    return ChunkPlan(shape, chunk_shape, indices, chunks, dtype=dtype,
+                     filters=filters)
@@ -0,0 +1,339 @@
+"""
+Choose, for each request, whether to reduce next to the data.
+
+Reducing next to the data (a `NetCDFArray` with an active method)
+returns only the partial result, but each request has a fixed cost: a
+round trip to an active storage server, or starting workers that read
+and reduce chunks in parallel. Reading a selection and reducing it
+here (``load(..., active=False)``) has no fixed cost, but moves every
+stored byte of the chunks it touches and decodes them on one core.
+So offloading tiny selections costs more than it saves, and reading
+huge ones here saturates the network.
+
+A `Planner` estimates the time each way would take, from the cached
+metadata of the variable (which chunks are touched and their stored,
+compressed, sizes) and a `CostModel` of the bandwidth, latency and
+decoding throughput of the machines, and chooses the quicker:
+
+>>> decision = default_planner().plan('tas.nc', 'tas', 'max')  # doctest: +SKIP
+>>> decision  # doctest: +SKIP
+<Decision: active (chunks): 2 ms against 31 ms to reduce locally; ...>
+
+``load(..., active='auto')`` asks the `default_planner`, and tells it
+how long the chosen way then took, so estimates are corrected by
+measured throughput as requests are answered. The planner's recent
+decisions, with their reasons, are kept in `Planner.decisions`.
+"""
+import logging
+import math
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+from activestorage.handles import dataset_pool
+from activestorage.plan import plan_selection, subspace_dimensions
+from activestorage.reductions import (
+    field_dtype,
+    field_shape,
+    normalise_axis,
+    partial_fields,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CostModel:
+    """What data movement and decoding cost, in bytes per second."""
+
+    def __init__(self, bandwidth=1e9, latency=1e-3, decode_rate=5e8,
+                 disk_rate=2e9, workers=None, storage_workers=4,
+                 storage_load=0., startup=2e-3, task_overhead=1e-4):
+        """
+        Parameters
+        ----------
+        bandwidth: float, bytes per second between the storage and here
+        latency: float, seconds per round trip to the storage
+        decode_rate: float, bytes per second that one core decompresses
+            and reduces
+        disk_rate: float, bytes per second that the storage reads its
+            disks, next to the data
+        workers: int, the cores reducing chunks here, by default the
+            number of CPUs
+        storage_workers: int, the cores of an active storage server
+        storage_load: float, the fraction of the server's cores that are
+            busy with other work, between 0 and 1
+        startup: float, seconds to start an active reduction: to
+            start workers, or for a server to take a request
+        task_overhead: float, seconds to schedule the reduction of one
+            chunk
+        """
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.decode_rate = decode_rate
+        self.disk_rate = disk_rate
+        self.workers = workers or os.cpu_count() or 1
+        self.storage_workers = storage_workers
+        self.storage_load = storage_load
+        self.startup = startup
+        self.task_overhead = task_overhead
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: "
+                f"bandwidth={self.bandwidth:.3g} latency={self.latency:.3g} "
+                f"decode_rate={self.decode_rate:.3g} "
+                f"storage_load={self.storage_load}>")
+
+    def local(self, work):
+        """Seconds to read ``work`` here, through libnetcdf, and reduce it."""
+        return (self.latency + work.stored / self.bandwidth
+                + work.decoded / self.decode_rate)
+
+    def active(self, work, route, batch_size=1):
+        """
+        Seconds to reduce ``work`` by ``route``.
+
+        ``route`` is that of `NetCDFArray`: ``'server'`` (on an active
+        storage server, with ``batch_size`` chunks per round trip),
+        ``'chunks'`` (stored chunks read and reduced here in parallel)
+        or ``'netcdf'`` (chunks read by libnetcdf one at a time).
+        """
+        if route == 'server':
+            cores = self.storage_workers * (1 - self.storage_load)
+            if cores <= 0:
+                return math.inf
+            return (self.startup
+                    + math.ceil(work.chunks / batch_size) * self.latency
+                    + work.stored / self.disk_rate
+                    + work.decoded / (self.decode_rate * cores)
+                    + work.returned / self.bandwidth)
+        if route == 'chunks':
+            cores = max(1, min(self.workers, work.chunks))
+            return (self.startup + self.latency
+                    + work.stored / self.bandwidth
+                    + work.chunks * self.task_overhead
+                    + work.decoded / (self.decode_rate * cores))
+        return self.local(work)
+
+
+class Work:
+    """What a request has to read and decode, and what it returns."""
+
+    def __init__(self, chunks, full, stored, decoded, returned):
+        """
+        Parameters
+        ----------
+        chunks: int, the number of storage chunks touched
+        full: int, how many of them are wholly selected
+        stored: int, bytes stored for the touched chunks (compressed)
+        decoded: int, bytes of the touched chunks once decoded
+        returned: int, bytes of the partial result
+        """
+        self.chunks = chunks
+        self.full = full
+        self.stored = stored
+        self.decoded = decoded
+        self.returned = returned
+
+    @classmethod
+    def from_plan(cls, plan, layout, op, axis, weighted=False):
+        """
+        Return the work of reducing a `ChunkPlan` over ``axis``.
+
+        ``layout`` (a `StorageLayout`, or None if the chunks can't be
+        read directly) gives the stored sizes of chunks; without it
+        they're taken to be uncompressed.
+        """
+        itemsize = np.dtype(plan.dtype).itemsize
+        decoded = stored = 0
+        for chunk in plan:
+            nbytes = int(np.prod(chunk.shape)) * itemsize
+            decoded += nbytes
+            if layout is None:
+                stored += nbytes
+            else:
+                # chunks that were never written aren't read at all
+                stored += layout.chunks.get(chunk.coords, (0, 0))[1]
+
+        cells = int(np.prod([1 if i in axis else n
+                             for i, n in enumerate(plan.out_shape)]))
+        returned = sum(
+            cells * int(np.prod(field_shape(op, field)))
+            * field_dtype(field, plan.dtype).itemsize
+            for field in partial_fields(op, weighted))
+        return cls(len(plan), len(plan.full_chunks), stored, decoded,
+                   returned)
+
+    def __repr__(self):
+        return (f"{self.chunks} chunks ({self.full} full), "
+                f"{self.stored} bytes stored, {self.decoded} decoded, "
+                f"{self.returned} returned")
+
+
+class Decision:
+    """The way a `Planner` chose to answer a request, and why."""
+
+    def __init__(self, active, route, estimates, work, modelled=None):
+        """
+        Parameters
+        ----------
+        active: bool, whether to reduce next to the data
+        route: str, the way chosen: a `NetCDFArray` route, or
+            ``'read'`` to read the selection and reduce it here
+        estimates: dict, the estimated seconds of the ``'active'`` and
+            ``'local'`` ways
+        work: `Work`, what the request reads and returns
+        modelled: float, the estimate of the chosen way before the
+            `Planner`'s correction
+        """
+        self.active = active
+        self.route = route
+        self.estimates = estimates
+        self.work = work
+        self.modelled = modelled
+        #: How long the chosen way took, once it has been measured
+        self.elapsed = None
+
+    @property
+    def reason(self):
+        """Why the way was chosen, in words."""
+        chosen, other = ('active', 'local') if self.active \
+            else ('local', 'active')
+        return (f"{_seconds(self.estimates[chosen])} against "
+                f"{_seconds(self.estimates[other])} to reduce "
+                f"{'locally' if self.active else 'next to the data'}; "
+                f"{self.work!r}")
+
+    def __repr__(self):
+        way = f"active ({self.route})" if self.active else "local"
+        return f"<{self.__class__.__name__}: {way}: {self.reason}>"
+
+
+def _seconds(seconds):
+    if seconds == math.inf:
+        return "never"
+    return f"{seconds * 1e3:.3g} ms"
+
+
+class Planner:
+    """
+    Chooses whether each request is reduced next to the data.
+
+    Estimates come from a `CostModel`, corrected by a factor per route
+    that follows the ratio of measured to estimated time (see
+    `observe`).
+    """
+
+    def __init__(self, model=None, smoothing=0.3, max_decisions=1000):
+        """
+        Parameters
+        ----------
+        model: `CostModel`, by default one with the default parameters
+        smoothing: float, the weight of each new measurement in the
+            corrections, between 0 and 1
+        max_decisions: int, the number of recent decisions to keep
+        """
+        self.model = CostModel() if model is None else model
+        self.smoothing = smoothing
+        #: The ratio of measured to estimated time, for each route
+        self.corrections = {}
+        #: The most recent `Decision` objects
+        self.decisions = deque(maxlen=max_decisions)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {self.model!r} "
+                f"corrections={self.corrections}>")
+
+    def decide(self, work, route, batch_size=1):
+        """
+        Return the `Decision` for ``work``.
+
+        Parameters
+        ----------
+        work: `Work`, what the request reads and returns
+        route: str, the route of `NetCDFArray` for the variable, see
+            `CostModel.active`
+        batch_size: int, the chunks sent to a server per round trip
+        """
+        modelled = {'active': self.model.active(work, route, batch_size),
+                    'local': self.model.local(work)}
+        with self._lock:
+            estimates = {
+                'active': modelled['active']
+                * self.corrections.get(route, 1.),
+                'local': modelled['local'] * self.corrections.get('read', 1.),
+            }
+            active = estimates['active'] <= estimates['local']
+            decision = Decision(
+                active, route if active else 'read', estimates, work,
+                modelled['active' if active else 'local'])
+            self.decisions.append(decision)
+        logger.debug("%r", decision)
+        return decision
+
+    def plan(self, filename, ncvar, op, indices=Ellipsis, axis=None,
+             group=None, active_client=None, weighted=False):
+        """
+        Decide how to answer a reduction of a subspace of a variable.
+
+        The variable's metadata and storage layout are read once and
+        cached (see `activestorage.handles.DatasetPool`), and no data
+        are read.
+
+        Parameters
+        ----------
+        filename, ncvar, op, indices, axis, group: as for
+            `activestorage.active.load`; ``axis`` may name dimensions
+        active_client: `activestorage.client.ActiveStorageClient`, the
+            server that active reductions would be sent to, if any
+        weighted: bool, whether the reduction is weighted
+
+        Returns
+        -------
+        `Decision`
+        """
+        pool = dataset_pool()
+        metadata = pool.metadata(filename, ncvar, group)
+        plan = plan_selection(metadata.shape, metadata.chunk_shape, indices,
+                              dtype=metadata.dtype)
+        axis = normalise_axis(
+            axis, len(plan.out_shape),
+            subspace_dimensions(metadata.dimensions, plan.indices))
+        layout = pool.storage_layout(filename, ncvar, group)
+        work = Work.from_plan(plan, layout, op, axis, weighted)
+        if layout is None:
+            route, batch_size = 'netcdf', 1
+        elif active_client is not None and not weighted:
+            route, batch_size = 'server', active_client.batch_size
+        else:
+            route, batch_size = 'chunks', 1
+        return self.decide(work, route, batch_size)
+
+    def observe(self, decision, elapsed):
+        """
+        Correct the estimates of a route by how long it took.
+
+        Parameters
+        ----------
+        decision: `Decision`, as returned by `plan`
+        elapsed: float, the seconds taken to answer it the chosen way
+        """
+        decision.elapsed = elapsed
+        estimate = decision.modelled
+        if not estimate or estimate <= 0 or not math.isfinite(estimate):
+            return
+        with self._lock:
+            correction = self.corrections.get(decision.route, 1.)
+            self.corrections[decision.route] = (
+                (1 - self.smoothing) * correction
+                + self.smoothing * elapsed / estimate)
+
+
+_planner = Planner()
+
+
+def default_planner():
+    """Return the process-wide `Planner`."""
+    return _planner
@@ -0,0 +1,284 @@
+"""
+Encoding of reduction requests and partial results for the wire.
+
+Requests and responses are documents of dicts, lists, strings,
+numbers, ``None``, booleans, bytes and numpy arrays, sent in a compact
+binary format (`dumps`, `loads`):
+
+- a header of the magic bytes ``b'ASW'`` and a format version byte;
+- then the document, each value a one byte tag followed by its
+  payload: nothing for ``None``, ``True`` and ``False``; a
+  little-endian int64 or float64 for numbers; a uint32 length and the
+  bytes for strings (UTF-8) and bytes; a uint32 count and the items
+  for lists, and for dicts, whose keys are strings;
+- arrays are their dtype string, ndim, shape (uint64s) and then the
+  raw values, padded to start on a multiple of 8 bytes.
+
+Arrays (the fields of partial results) are decoded as read-only views
+of the received bytes, without copying them. Only numeric and boolean
+arrays are allowed, and nothing is ever unpickled, so decoding a
+document can't run code.
+
+>>> import numpy as np
+>>> partial = {'max': np.array([[3.5]], dtype='f4'), 'count': np.array([[4]])}
+>>> decoded = loads(dumps({'partial': encode_partial(partial)}))
+>>> decode_partial(decoded['partial'])['max']
+array([[3.5]], dtype=float32)
+
+For debugging by hand, `loads` also accepts JSON documents (without
+arrays).
+"""
+import json
+import struct
+
+import numpy as np
+
+from activestorage.reductions import MissingValues
+
+#: The first bytes of every document
+MAGIC = b'ASW'
+
+#: The version of the format written by `dumps`
+VERSION = 1
+
+#: The HTTP ``Content-Type`` of documents
+CONTENT_TYPE = 'application/x-activestorage'
+
+#: The kinds of dtype allowed in arrays: no objects, strings or voids
+ARRAY_KINDS = 'biufc'
+
+_INT64 = struct.Struct('<q')
+_FLOAT64 = struct.Struct('<d')
+_UINT32 = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+
+
+def _write(out, value):
+    """Append the encoding of one value to a bytearray."""
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, np.ndarray):
+        _write_array(out, value)
+    elif isinstance(value, np.generic):
+        _write(out, value.item())
+    elif isinstance(value, int):
+        if -2**63 <= value < 2**63:
+            out += b'i'
+            out += _INT64.pack(value)
+        else:
+            _write_bytes(out, b'n', str(value).encode('ascii'))
+    elif isinstance(value, float):
+        out += b'd'
+        out += _FLOAT64.pack(value)
+    elif isinstance(value, str):
+        _write_bytes(out, b's', value.encode('utf-8'))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        _write_bytes(out, b'b', bytes(value))
+    elif isinstance(value, (list, tuple)):
+        out += b'l'
+        out += _UINT32.pack(len(value))
+        for item in value:
+            _write(out, item)
+    elif isinstance(value, dict):
+        out += b'm'
+        out += _UINT32.pack(len(value))
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise TypeError(f"Document keys must be str, not {key!r}")
+            _write_bytes(out, b's', key.encode('utf-8'))
+            _write(out, item)
+    else:
+        raise TypeError(f"Can't encode {type(value).__name__} {value!r}")
+
+
+def _write_bytes(out, tag, data):
+    out += tag
+    out += _UINT32.pack(len(data))
+    out += data
+
+
+def _write_array(out, array):
+    if array.dtype.kind not in ARRAY_KINDS:
+        raise TypeError(f"Can't encode an array of dtype {array.dtype}")
+    _write_bytes(out, b'a', array.dtype.str.encode('ascii'))
+    out += bytes([array.ndim])
+    for n in array.shape:
+        out += _UINT64.pack(n)
+    out += bytes(-len(out) % 8)
+    out += np.ascontiguousarray(array).data
+
+
+def dumps(document):
+    """Serialise a request or response document."""
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    _write(out, document)
+    return bytes(out)
+
+
+class _Reader:
+    """Decodes the values of a document from a buffer, in order."""
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def _unpack(self, fmt):
+        value, = fmt.unpack_from(self.buffer, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def _bytes(self):
+        size = self._unpack(_UINT32)
+        start, self.offset = self.offset, self.offset + size
+        if self.offset > len(self.buffer):
+            raise ValueError("Truncated document")
+        return self.buffer[start:self.offset]
+
+    def read(self):
+        tag = self.buffer[self.offset:self.offset + 1].tobytes()
+        self.offset += 1
+        if tag == b'N':
+            return None
+        if tag == b'T':
+            return True
+        if tag == b'F':
+            return False
+        if tag == b'i':
+            return self._unpack(_INT64)
+        if tag == b'd':
+            return self._unpack(_FLOAT64)
+        if tag == b'n':
+            return int(self._bytes().tobytes())
+        if tag == b's':
+            return str(self._bytes(), 'utf-8')
+        if tag == b'b':
+            return self._bytes().tobytes()
+        if tag == b'l':
+            return [self.read() for _ in range(self._unpack(_UINT32))]
+        if tag == b'm':
+            count = self._unpack(_UINT32)
+            document = {}
+            for _ in range(count):
+                if self.buffer[self.offset:self.offset + 1] != b's':
+                    raise ValueError("Document keys must be strings")
+                self.offset += 1
+                key = str(self._bytes(), 'utf-8')
+                document[key] = self.read()
+            return document
+        if tag == b'a':
+            return self._array()
+        raise ValueError(f"Unknown tag {tag!r} at byte {self.offset - 1}")
+
+    def _array(self):
+        dtype = np.dtype(str(self._bytes(), 'ascii'))
+        if dtype.kind not in ARRAY_KINDS:
+            raise ValueError(f"Arrays of dtype {dtype} are not allowed")
+        ndim = self.buffer[self.offset]
+        self.offset += 1
+        shape = tuple(self._unpack(_UINT64) for _ in range(ndim))
+        self.offset += -self.offset % 8
+        count = int(np.prod(shape))
+        array = np.frombuffer(self.buffer, dtype=dtype, count=count,
+                              offset=self.offset)
+        self.offset += array.nbytes
+        return array.reshape(shape)
+
+
+def loads(data):
+    """
+    Deserialise a request or response document.
+
+    Arrays are read-only views of ``data``.
+
+    Raises
+    ------
+    ValueError: if ``data`` isn't a document of a known version
+    """
+    buffer = memoryview(data).cast('B')
+    if buffer[:1] == b'{':
+        return json.loads(buffer.tobytes())
+    if buffer[:3] != MAGIC:
+        raise ValueError("Not an active storage document")
+    if len(buffer) < 4 or buffer[3] != VERSION:
+        raise ValueError(f"Unsupported document version "
+                         f"{buffer[3] if len(buffer) > 3 else None}, "
+                         f"expected {VERSION}")
+    try:
+        return _Reader(buffer, 4).read()
+    except (struct.error, IndexError) as error:
+        raise ValueError(f"Truncated document: {error}") from None
+
+
+def encode_array(array):
+    """Return an array as it's put in a document."""
+    return np.asarray(array)
+
+
+def decode_array(encoded):
+    """Return the numpy array of a document (see `encode_array`)."""
+    return np.asarray(encoded)
+
+
+def encode_partial(partial):
+    """Return a partial result as it's put in a document."""
+    return {field: encode_array(values) for field, values in partial.items()}
+
+
+def decode_partial(encoded):
+    """Return the partial result of a document (see `encode_partial`)."""
+    return {field: decode_array(values) for field, values in encoded.items()}
+
+
+def encode_missing(missing):
+    """Return a document description of a `MissingValues`, or None."""
+    if not missing:
+        return None
+    return {name: None if value is None else np.asarray(value).tolist()
+            for name, value in (('fill_value', missing.fill_value),
+                                ('missing_value', missing.missing_value),
+                                ('valid_min', missing.valid_min),
+                                ('valid_max', missing.valid_max))}
+
+
+def decode_missing(encoded):
+    """Return the `MissingValues` described by `encode_missing`."""
+    if not encoded:
+        return None
+    return MissingValues(**encoded)
+
+
+def encode_selection(selection):
+    """
+    Return a JSON-able description of a normalised index.
+
+    Slices become ``[start, stop, step]`` lists, integers stay as they
+    are and integer arrays become ``{"index": [...]}``.
+
+    >>> encode_selection((slice(0, 3, 1), 2, np.array([0, 4])))
+    [[0, 3, 1], 2, {'index': [0, 4]}]
+    """
+    encoded = []
+    for index in selection:
+        if isinstance(index, slice):
+            index = [index.start, index.stop, index.step]
+        elif isinstance(index, np.ndarray):
+            index = {'index': index.tolist()}
+        encoded.append(index)
+    return encoded
+
+
+def decode_selection(encoded):
+    """Return the index described by `encode_selection`."""
+    selection = []
+    for index in encoded:
+        if isinstance(index, list):
+            index = slice(*index)
+        elif isinstance(index, dict):
+            index = np.array(index['index'], dtype=int)
+        selection.append(index)
+    return tuple(selection)
@@ -0,0 +1,262 @@
+"""
+Scheduling of many byte range reads as few large ones.
+
+A selection of stored data needs many byte ranges: the rows of a
+hyperslab of a contiguous array, or the stored chunks of a chunked
+one. On spinning disks and object stores each read costs a seek or a
+request, which can take longer than reading the bytes in between, so
+the ranges are sorted by offset and those less than a gap apart are
+merged (`coalesce`) and read at once, up to a size that bounds the
+memory a read takes. The bytes of each range are then picked out of
+the merged reads without copying them (`read_ranges`).
+
+>>> starts, stops, group = coalesce([4096, 0, 100], [96, 50, 50], gap=64)
+>>> starts.tolist(), stops.tolist(), group.tolist()
+([0, 4096], [150, 4192], [1, 0, 0])
+"""
+import os
+
+import numpy as np
+
+from activestorage import stats as _stats
+
+#: Ranges of a file less than this many bytes apart are read at once
+DEFAULT_GAP = 256 * 2**10
+
+#: The most bytes that ranges are merged into
+DEFAULT_MAX_SIZE = 8 * 2**20
+
+
+def coalesce(offsets, sizes, gap=DEFAULT_GAP, max_size=None):
+    """
+    Merge byte ranges that are at most ``gap`` bytes apart.
+
+    Ranges that overlap or touch are merged too, unless ``max_size``
+    stops them.
+
+    Parameters
+    ----------
+    offsets, sizes: sequences of int, the ranges, in any order
+    gap: int, the largest hole between ranges that is read through
+    max_size: int, the largest merged range, in bytes, or None for no
+        limit; larger ranges are still read whole, on their own
+
+    Returns
+    -------
+    ``(starts, stops)`` int64 numpy arrays of the merged ranges, sorted
+    by offset, and ``group``, the index of the merged range holding
+    each of the given ranges.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64).ravel()
+    sizes = np.asarray(sizes, dtype=np.int64).ravel()
+    if not offsets.size:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.intp)
+
+    order = np.argsort(offsets, kind='stable')
+    lo = offsets[order]
+    ends = lo + sizes[order]
+    hi = np.maximum.accumulate(ends)
+    new = np.empty(lo.size, dtype=bool)
+    new[0] = True
+    new[1:] = lo[1:] - hi[:-1] > gap
+    if max_size is not None:
+        _split(lo, ends, new, max_size)
+    first = np.flatnonzero(new)
+
+    group = np.empty(lo.size, dtype=np.intp)
+    group[order] = np.cumsum(new) - 1
+    return lo[first], np.maximum.reduceat(ends, first), group
+
+
+def _split(lo, ends, new, max_size):
+    """Start new merged ranges where they would grow past ``max_size``."""
+    starts = np.flatnonzero(new)
+    stops = np.append(starts[1:], lo.size)
+    for first, stop in zip(starts.tolist(), stops.tolist()):
+        # only the merged ranges that are too large need a look
+        if ends[first:stop].max() - lo[first] <= max_size:
+            continue
+        begin = lo[first]
+        end = ends[first]
+        for k in range(first + 1, stop):
+            end = max(end, ends[k])
+            if end - begin > max_size:
+                new[k] = True
+                begin, end = lo[k], ends[k]
+
+
+def _positions(index):
+    """The positions selected by one index of an orthogonal selection."""
+    if isinstance(index, slice):
+        return np.arange(index.start, index.stop, index.step)
+    return np.atleast_1d(np.asarray(index, dtype=np.int64))
+
+
+def selection_rows(offset, shape, selection, itemsize):
+    """
+    Return the byte ranges of a selection of a contiguous array.
+
+    A row is the run of selected elements along the last dimension,
+    which is one byte range if the selection along it is a slice of
+    step 1; otherwise each selected element is a row of its own.
+
+    Parameters
+    ----------
+    offset: int, byte offset of the first element of the C-ordered array
+    shape: sequence of int, shape of the whole array
+    selection: tuple of slices (of positive step), integers and integer
+        arrays, one per dimension, as made by
+        `activestorage.plan.normalise_indices`
+    itemsize: int, bytes per element
+
+    Returns
+    -------
+    The byte offset of each row, as an int64 numpy array in the C order
+    of the selection, and the number of elements in a row.
+
+    >>> rows, per_row = selection_rows(0, (4, 5), (slice(1, 4, 2),
+    ...                                slice(0, 3, 1)), 4)
+    >>> rows.tolist(), per_row
+    ([20, 60], 3)
+    """
+    strides = np.cumprod((1,) + tuple(shape[:0:-1]))[::-1] * itemsize
+    rows = np.array(offset, dtype=np.int64)
+    for index, stride in zip(selection[:-1], strides[:-1]):
+        rows = np.add.outer(rows, _positions(index) * stride)
+    last = selection[-1]
+    if isinstance(last, slice) and last.step == 1:
+        per_row = len(range(last.start, last.stop))
+        rows = rows + last.start * itemsize
+    else:
+        per_row = 1
+        rows = np.add.outer(rows, _positions(last) * itemsize)
+    return rows.ravel(), per_row
+
+
+def gather_rows(buffers, starts, group, rows, per_row, out):
+    """
+    Copy the rows of a selection out of the merged reads of its ranges.
+
+    Parameters
+    ----------
+    buffers: the bytes of each merged range starting at ``starts``
+    starts, group: as returned by `coalesce` for the ``rows``
+    rows, per_row: as returned by `selection_rows`
+    out: numpy array of ``rows.size * per_row`` elements, of the dtype
+        of the values, that the rows are copied into in order
+    """
+    out = out.reshape(rows.size, per_row)
+    order = np.argsort(group, kind='stable')
+    bounds = np.searchsorted(group[order], np.arange(len(buffers) + 1))
+    for g, buffer in enumerate(buffers):
+        members = order[bounds[g]:bounds[g + 1]]
+        values = np.frombuffer(buffer, dtype=out.dtype)
+        index = ((rows[members] - starts[g]) // out.itemsize)[:, None] \
+            + np.arange(per_row)
+        out[members] = values[index]
+
+
+def read_into(fd, buffer, offset):
+    """
+    Fill a writable buffer with the bytes of a file from ``offset``.
+
+    Reads straight into ``buffer`` with ``os.preadv`` where the
+    platform has it, rather than into a new bytes object.
+
+    Raises
+    ------
+    EOFError: if the file ends first
+    """
+    view = memoryview(buffer).cast('B')
+    done = 0
+    while done < len(view):
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [view[done:]], offset + done)
+        else:
+            data = os.pread(fd, len(view) - done, offset + done)
+            n = len(data)
+            view[done:done + n] = data
+        if not n:
+            raise EOFError(f"Asked for {len(view)} bytes at byte {offset} "
+                           f"but only {done} could be read")
+        done += n
+    return done
+
+
+def read_ranges(f, offsets, sizes, gap=DEFAULT_GAP, max_size=DEFAULT_MAX_SIZE,
+                stats=_stats.NULL):
+    """
+    Read the bytes of many ranges of a file, in few reads.
+
+    The merged ranges are read one at a time, so no more than one is
+    held in memory unless the caller keeps the views of its ranges.
+
+    Parameters
+    ----------
+    f: open binary file, or its file descriptor
+    offsets, sizes: sequences of int, the ranges
+    gap, max_size: int, see `coalesce`
+    stats: `activestorage.stats.RequestStats`, where the bytes read
+        (including the holes read through) and the read time are
+        counted
+
+    Yields
+    ------
+    ``(k, view)`` for each range, in file order: its index in
+    ``offsets`` and a read-only memoryview of its bytes, which shares
+    the buffer of its merged read
+    """
+    fd = f if isinstance(f, int) else f.fileno()
+    offsets = np.asarray(offsets, dtype=np.int64).ravel()
+    sizes = np.asarray(sizes, dtype=np.int64).ravel()
+    starts, stops, group = coalesce(offsets, sizes, gap, max_size)
+    order = np.lexsort((offsets, group))
+    bounds = np.searchsorted(group[order], np.arange(starts.size + 1))
+    for g, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+        buffer = bytearray(stop - start)
+        with stats.stage('read'):
+            read_into(fd, buffer, start)
+        stats.add(bytes_read=stop - start)
+        buffer = memoryview(buffer).toreadonly()
+        for k in order[bounds[g]:bounds[g + 1]].tolist():
+            offset = int(offsets[k]) - start
+            yield k, buffer[offset:offset + int(sizes[k])]
+
+
+def read_rows(f, rows, per_row, dtype, gap=DEFAULT_GAP,
+              max_size=DEFAULT_MAX_SIZE, stats=_stats.NULL):
+    """
+    Read the rows of a selection of a contiguous array, in few reads.
+
+    The merged ranges of the rows are read one at a time, so no more
+    than one is held in memory besides the result.
+
+    Parameters
+    ----------
+    f: open binary file, or its file descriptor
+    rows, per_row: as returned by `selection_rows`
+    dtype: numpy dtype of the values
+    gap, max_size: int, see `coalesce`
+    stats: `activestorage.stats.RequestStats`, as for `read_ranges`
+
+    Returns
+    -------
+    numpy array of shape ``(rows.size, per_row)``, the rows in order
+    """
+    fd = f if isinstance(f, int) else f.fileno()
+    dtype = np.dtype(dtype)
+    out = np.empty((rows.size, per_row), dtype=dtype)
+    starts, stops, group = coalesce(
+        rows, np.full(rows.size, per_row * dtype.itemsize), gap, max_size)
+    order = np.argsort(group, kind='stable')
+    bounds = np.searchsorted(group[order], np.arange(starts.size + 1))
+    for g, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+        values = np.empty((stop - start) // dtype.itemsize, dtype=dtype)
+        with stats.stage('read'):
+            read_into(fd, values, start)
+        stats.add(bytes_read=stop - start)
+        members = order[bounds[g]:bounds[g + 1]]
+        out[members] = values[((rows[members] - start) // dtype.itemsize)
+                              [:, None] + np.arange(per_row)]
+    return out
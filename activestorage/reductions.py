@@ -0,0 +1,846 @@
+"""Vectorised reduction engine for active storage reads.
+
+Bytes read from storage are viewed in place as a numpy array (no
+unpacking into Python objects) and reduced with numpy's vectorised
+kernels.
+
+>>> import numpy as np
+>>> data = np.arange(6, dtype='f4').tobytes()
+>>> float(reduce_bytes(data, 'f4', 'mean'))
+2.5
+
+Reductions that are split over chunks (or files, or workers) return
+*partial* results instead: dicts of arrays that can be merged in any
+order and grouping, then finalised into the answer.
+
+>>> x = np.arange(6.)
+>>> parts = [partial_reduce(x[:4], 'mean'), partial_reduce(x[4:], 'mean')]
+>>> finalise(merge_partials(parts, 'mean'), 'mean').item()
+2.5
+
+Reductions may be weighted, for instance by cell area, with weights
+that broadcast against the data. Values with zero weight are left out
+altogether, so a land-sea mask is a set of 0/1 weights.
+
+>>> weights = np.array([1., 1., 2., 2., 0., 0.])
+>>> finalise(partial_reduce(x, 'mean', weights=weights), 'mean').item()
+1.8333333333333333
+>>> finalise(partial_reduce(x, 'max', weights=weights), 'max').item()
+3.0
+
+The variance, standard deviation, skewness and kurtosis are found in
+one pass too. Their partial results hold the count, mean and central
+moment sums of each part, accumulated in float64, which are merged
+with the pairwise update of Chan et al. (generalised to higher
+moments by Pebay) rather than from raw power sums, so they stay
+accurate however far the mean is from zero.
+
+>>> y = 1e6 + np.arange(6, dtype='f4')
+>>> parts = [partial_reduce(y[:1], 'var'), partial_reduce(y[1:], 'var')]
+>>> finalise(merge_partials(parts, 'var'), 'var').item()
+2.9166666666666665
+
+Percentiles, histograms and threshold counts are `SKETCHES`:
+operations that take arguments, given in the operation's name. Their
+partial results (see `activestorage.sketches`) are of a fixed size per
+result element, however much data went into them.
+
+>>> z = np.arange(101.)
+>>> print(round(reduce_array(z, 'quantile(0.95)'), 6))
+95.45
+>>> reduce_array(z, 'histogram(0, 100, 4)')
+array([25, 25, 25, 26])
+>>> int(reduce_array(z, 'count_above(90)'))
+10
+"""
+import re
+
+import numpy as np
+
+from activestorage import sketches
+
+#: The reduction operations understood by the engine
+OPERATIONS = ('sum', 'mean', 'min', 'max', 'count', 'var', 'std', 'skew',
+              'kurt')
+
+#: The operations computed from central moments. Like ``numpy.var``
+#: and ``scipy.stats``, the variance is that of the population (ddof
+#: 0), the skewness is the biased Fisher-Pearson coefficient and the
+#: kurtosis is Fisher's (excess) kurtosis.
+MOMENTS = ('var', 'std', 'skew', 'kurt')
+
+#: The fields of the partial results of `MOMENTS` besides the count
+#: (and weight): the mean, and the sums of the 2nd to 4th powers of
+#: deviations from it
+MOMENT_FIELDS = ('mean', 'm2', 'm3', 'm4')
+
+#: The operations that take arguments, written ``'name(arg, ...)'``,
+#: and their arguments:
+#:
+#: ``'histogram(lo, hi, bins)'``
+#:     the counts of values in ``bins`` equal bins from ``lo`` to
+#:     ``hi``, as for ``numpy.histogram``
+#: ``'quantile(q)'``
+#:     the ``q`` quantile (0 to 1), to within a small fraction of a
+#:     percent of rank, from a t-digest (see `activestorage.sketches`).
+#:     Quantiles of a few values are exact, and interpolated as by
+#:     ``numpy.quantile(..., method='hazen')``; weighted quantiles are
+#:     weighted.
+#: ``'count_above(threshold)'``, ``'count_below(threshold)'``
+#:     the exact number of values greater (less) than ``threshold``
+SKETCHES = {
+    'histogram': ('lo', 'hi', 'bins'),
+    'quantile': ('q',),
+    'count_above': ('threshold',),
+    'count_below': ('threshold',),
+}
+
+#: The operations whose partial results' fields are merged together,
+#: rather than each with its `MERGE` ufunc
+JOINT = MOMENTS + ('quantile',)
+
+#: The fields of the mergeable partial result of each operation. The
+#: count of contributing values is always kept, so that reductions
+#: over nothing (e.g. all missing data) can be recognised.
+PARTIALS = {
+    'sum': ('sum', 'count'),
+    'mean': ('sum', 'count'),
+    'min': ('min', 'count'),
+    'max': ('max', 'count'),
+    'count': ('count',),
+    'var': ('mean', 'm2', 'count'),
+    'std': ('mean', 'm2', 'count'),
+    'skew': ('mean', 'm2', 'm3', 'count'),
+    'kurt': ('mean', 'm2', 'm3', 'm4', 'count'),
+    'histogram': ('histogram', 'count'),
+    'quantile': ('centroids', 'centroid_weights', 'min', 'max', 'count'),
+    'count_above': ('hits', 'count'),
+    'count_below': ('hits', 'count'),
+}
+
+#: The extra fields of weighted partial results
+WEIGHTED_PARTIALS = {
+    'sum': ('weight',),
+    'mean': ('weight',),
+    'var': ('weight',),
+    'std': ('weight',),
+    'skew': ('weight',),
+    'kurt': ('weight',),
+}
+
+#: The ufunc that merges each field of two partial results, for the
+#: operations other than `JOINT` ones
+MERGE = {
+    'sum': np.add,
+    'count': np.add,
+    'weight': np.add,
+    'min': np.minimum,
+    'max': np.maximum,
+    'histogram': np.add,
+    'hits': np.add,
+}
+
+
+def as_array(buffer, dtype, count=-1, offset=0):
+    """
+    Return a zero-copy numpy view of ``buffer``.
+
+    Parameters
+    ----------
+    buffer: bytes-like, raw data as read from storage
+    dtype: numpy dtype (or anything ``numpy.dtype`` accepts) of the data
+    count: int, number of elements to view, -1 for all of them
+    offset: int, byte offset into ``buffer`` of the first element
+    """
+    return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+
+
+def parse_operation(op):
+    """
+    Split an operation into its name and arguments.
+
+    >>> parse_operation('histogram(0, 40, 20)')
+    ('histogram', (0.0, 40.0, 20))
+    >>> parse_operation('max')
+    ('max', ())
+    """
+    match = re.fullmatch(r'\s*(\w+)\s*(?:\((.*)\))?\s*', str(op))
+    if match is None:
+        return op, ()
+    name, args = match.groups()
+    if args is None:
+        return name, ()
+    try:
+        args = tuple(float(arg) for arg in args.split(','))
+    except ValueError:
+        raise ValueError(f"Invalid arguments of operation {op!r}") from None
+    if name == 'histogram' and len(args) == 3:
+        args = args[:2] + (int(args[2]),)
+    return name, args
+
+
+def operation_name(op):
+    """The name of an operation, without its arguments."""
+    return parse_operation(op)[0]
+
+
+def check_operation(op):
+    """
+    Raise ``NotImplementedError`` if ``op`` is not a known operation.
+
+    ``ValueError`` is raised if the arguments of one of `SKETCHES` are
+    wrong.
+    """
+    name, args = parse_operation(op)
+    if name not in OPERATIONS and name not in SKETCHES:
+        raise NotImplementedError(
+            f"Operation {op!r} is not supported; use one of {OPERATIONS} "
+            f"or {tuple(SKETCHES)}")
+    expected = SKETCHES.get(name, ())
+    if len(args) != len(expected):
+        raise ValueError(
+            f"Operation {name!r} takes the arguments {expected}, "
+            f"not {args}")
+    if name == 'histogram' and not (args[0] < args[1] and args[2] > 0):
+        raise ValueError(f"Invalid histogram bins in {op!r}")
+    if name == 'quantile' and not 0 <= args[0] <= 1:
+        raise ValueError(f"The quantile of {op!r} isn't between 0 and 1")
+
+
+class MissingValues:
+    """
+    The netCDF missing data conventions of a variable.
+
+    Values equal to the fill value or to any of the missing values, or
+    outside the valid range, are ignored by reductions. The test is
+    made in the reduction kernel itself, block by block, so neither a
+    masked array nor a full size mask is ever made.
+
+    >>> missing = MissingValues(fill_value=-999., valid_max=100.)
+    >>> missing.valid(np.array([1., -999., 200., 3.]))
+    array([ True, False, False,  True])
+    """
+
+    def __init__(self, fill_value=None, missing_value=None, valid_min=None,
+                 valid_max=None):
+        """
+        Parameters
+        ----------
+        fill_value: scalar, the ``_FillValue``
+        missing_value: scalar or sequence, the ``missing_value`` (s)
+        valid_min: scalar, values less than this are missing
+        valid_max: scalar, values greater than this are missing
+        """
+        values = []
+        for value in (fill_value, missing_value):
+            if value is not None:
+                values.extend(np.ravel(value).tolist())
+        self.fill_value = fill_value
+        self.missing_value = missing_value
+        self.valid_min = valid_min
+        self.valid_max = valid_max
+        self._values = [v for v in dict.fromkeys(values) if v == v]
+        self._nan = any(v != v for v in values)
+
+    @classmethod
+    def from_variable(cls, variable):
+        """
+        Read the missing data attributes of a `netCDF4.Variable`.
+
+        As with ``netCDF4``'s own masking, the netCDF default fill
+        value is used if there is no ``_FillValue`` (except for byte
+        types), and ``valid_range`` is used if ``valid_min`` or
+        ``valid_max`` are not set.
+
+        Returns ``None`` if the variable has no missing data.
+        """
+        attrs = {name: variable.getncattr(name)
+                 for name in variable.ncattrs()}
+        default_fill = None
+        if variable.dtype.itemsize > 1:
+            # the default fill value, or None if filling is disabled
+            default_fill = variable.get_fill_value()
+        return cls.from_attributes(attrs, default_fill)
+
+    @classmethod
+    def from_attributes(cls, attrs, default_fill=None):
+        """
+        Read the missing data conventions from a dict of attributes.
+
+        ``default_fill`` is used if there is no ``_FillValue``. Single
+        element array attributes (as read by h5py) are taken as
+        scalars.
+
+        Returns ``None`` if there are no missing data.
+
+        >>> MissingValues.from_attributes({'valid_range': [0., 10.]})
+        <MissingValues: fill_value=None missing_value=None valid_min=0.0 \
+valid_max=10.0>
+        """
+        def scalar(value):
+            if value is not None and np.size(value) == 1:
+                return np.ravel(value)[0]
+            return value
+
+        fill_value = scalar(attrs.get('_FillValue'))
+        if fill_value is None:
+            fill_value = default_fill
+        valid_min = scalar(attrs.get('valid_min'))
+        valid_max = scalar(attrs.get('valid_max'))
+        if 'valid_range' in attrs:
+            vmin, vmax = np.ravel(attrs['valid_range'])
+            valid_min = vmin if valid_min is None else valid_min
+            valid_max = vmax if valid_max is None else valid_max
+
+        missing = cls(fill_value, attrs.get('missing_value'), valid_min,
+                      valid_max)
+        return missing if missing else None
+
+    def __bool__(self):
+        return bool(self._values or self._nan or self.valid_min is not None
+                    or self.valid_max is not None)
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: fill_value={self.fill_value} "
+                f"missing_value={self.missing_value} "
+                f"valid_min={self.valid_min} valid_max={self.valid_max}>")
+
+    def valid(self, data):
+        """Return the boolean array that is False where data are missing."""
+        valid = np.ones(data.shape, dtype=bool)
+        for value in self._values:
+            valid &= data != value
+        if self._nan:
+            valid &= ~np.isnan(data)
+        if self.valid_min is not None:
+            valid &= data >= self.valid_min
+        if self.valid_max is not None:
+            valid &= data <= self.valid_max
+        return valid
+
+
+#: Number of elements tested for missing values at a time, which keeps
+#: the temporary mask small enough to stay in cache
+BLOCK_SIZE = 1 << 16
+
+
+def reduce_array(array, op, missing=None, return_count=False):
+    """
+    Apply the reduction ``op`` to every element of ``array``.
+
+    Parameters
+    ----------
+    array: numpy array of any numeric dtype
+    op: str, one of ``OPERATIONS``
+    missing: `MissingValues`, the values to ignore, if any
+    return_count: bool, also return the number of values reduced
+
+    Returns
+    -------
+    numpy scalar (an ``int`` for ``count``), or a ``(result, count)``
+    tuple if ``return_count`` is set. The result is masked if there
+    were no values to reduce because they were all missing.
+    """
+    check_operation(op)
+    array = np.asanyarray(array)
+    if missing or np.ma.isMaskedArray(array) or return_count:
+        partial = partial_reduce(array, op, missing=missing)
+        result = finalise(partial, op)[(0,) * array.ndim]
+        if return_count:
+            return result, int(partial['count'].item())
+        return result
+    if op == 'count':
+        return array.size
+    if op == 'sum':
+        return np.sum(array)
+    if op == 'mean':
+        return np.mean(array)
+    if op == 'min':
+        return np.min(array)
+    if op == 'max':
+        return np.max(array)
+    return finalise(partial_reduce(array, op), op)[(0,) * array.ndim]
+
+
+def reduce_bytes(buffer, dtype, op, missing=None):
+    """
+    Apply the reduction ``op`` to raw bytes holding ``dtype`` values.
+
+    Parameters
+    ----------
+    buffer: bytes-like, raw data as read from storage
+    dtype: numpy dtype of the values in ``buffer``
+    op: str, one of ``OPERATIONS``
+    missing: `MissingValues`, the values to ignore, if any
+    """
+    return reduce_array(as_array(buffer, dtype), op, missing=missing)
+
+
+def normalise_axis(axis, ndim, dimensions=None):
+    """
+    Return ``axis`` as a sorted tuple of non-negative ints.
+
+    Axes may also be given by name, if ``dimensions`` names the
+    dimensions of the array being reduced.
+
+    >>> normalise_axis(-1, 3)
+    (2,)
+    >>> normalise_axis(None, 2)
+    (0, 1)
+    >>> normalise_axis(['lon', 'time'], 3, ('time', 'lat', 'lon'))
+    (0, 2)
+    """
+    if axis is None:
+        return tuple(range(ndim))
+    if not isinstance(axis, (tuple, list)):
+        axis = (axis,)
+    if any(isinstance(a, str) for a in axis):
+        if dimensions is None:
+            raise ValueError(f"Can't find the axes {axis} by name")
+        unknown = [a for a in axis
+                   if isinstance(a, str) and a not in dimensions]
+        if unknown:
+            raise ValueError(f"No dimensions {unknown} in {dimensions}")
+        axis = tuple(dimensions.index(a) if isinstance(a, str) else a
+                     for a in axis)
+    axis = tuple(sorted(a % ndim if -ndim <= a < ndim else a for a in axis))
+    if any(not 0 <= a < ndim for a in axis) or len(set(axis)) != len(axis):
+        raise ValueError(f"Invalid axis {axis} for {ndim} dimensions")
+    return axis
+
+
+def partial_fields(op, weighted=False):
+    """The fields of the partial result of ``op``, maybe weighted."""
+    name = operation_name(op)
+    if weighted:
+        return PARTIALS[name] + WEIGHTED_PARTIALS.get(name, ())
+    return PARTIALS[name]
+
+
+def field_shape(op, field):
+    """
+    The trailing shape of a field of the partial result of ``op``.
+
+    Fields have one value per result element, except those of
+    histograms (one per bin) and digests (one per centroid).
+    """
+    if field == 'histogram':
+        return (parse_operation(op)[1][2],)
+    if field in ('centroids', 'centroid_weights'):
+        return (sketches.DIGEST_SIZE,)
+    return ()
+
+
+def field_dtype(field, dtype):
+    """The dtype of a partial result field for data of type ``dtype``."""
+    if field in ('count', 'histogram', 'hits'):
+        return np.dtype(np.intp)
+    if field in ('centroids', 'centroid_weights'):
+        return np.dtype(np.float64)
+    if field in ('sum', 'weight'):
+        return np.sum(np.zeros(0, dtype=dtype)).dtype
+    if field in MOMENT_FIELDS:
+        return np.result_type(dtype, np.float64)
+    return np.dtype(dtype)
+
+
+def identity(field, dtype):
+    """The value of a field of the partial result over no values."""
+    dtype = field_dtype(field, dtype)
+    if field in ('sum', 'count', 'weight', 'histogram', 'hits',
+                 'centroids', 'centroid_weights') or field in MOMENT_FIELDS:
+        return dtype.type(0)
+    if dtype.kind == 'f':
+        return dtype.type(np.inf if field == 'min' else -np.inf)
+    info = np.iinfo(dtype)
+    return info.max if field == 'min' else info.min
+
+
+def result_dtype(op, dtype):
+    """The dtype of the finalised result of ``op`` over ``dtype`` data."""
+    op = operation_name(op)
+    if op in ('count', 'histogram', 'count_above', 'count_below'):
+        return np.dtype(np.intp)
+    if op == 'mean':
+        return np.mean(np.zeros(1, dtype=dtype)).dtype
+    if op in MOMENTS or op == 'quantile':
+        return np.result_type(dtype, np.float64)
+    return field_dtype(op, dtype)
+
+
+def empty_partial(op, shape, dtype, weighted=False):
+    """
+    Return a partial result of ``shape`` that holds no values yet.
+
+    For a weighted reduction, ``dtype`` is that of the data times the
+    weights.
+    """
+    return {field: np.full(tuple(shape) + field_shape(op, field),
+                           identity(field, dtype),
+                           dtype=field_dtype(field, dtype))
+            for field in partial_fields(op, weighted)}
+
+
+def weighted_dtype(dtype, weights):
+    """The dtype of data of type ``dtype`` times ``weights``."""
+    if weights is None:
+        return np.dtype(dtype)
+    return np.result_type(dtype, np.asanyarray(weights).dtype)
+
+
+def working_set(op, weighted=False):
+    """
+    Bound the temporary memory of reducing a block of data.
+
+    These are upper bounds of what `partial_reduce`, followed by
+    `merge_into`, allocates besides the data and the target partial
+    result, as measured with ``tracemalloc``. The moments cast the
+    data to float64 and take powers of the deviations; digests sort
+    each result element's values, and merging digests sorts their
+    centroids.
+
+    Returns
+    -------
+    ``(per_value, per_element)``: the bytes per value of the block, and
+    per element of its partial result
+    """
+    name = operation_name(op)
+    fields = sum(field_dtype(field, np.float64).itemsize
+                 * int(np.prod(field_shape(op, field)))
+                 for field in partial_fields(op, weighted))
+    if op in MOMENTS:
+        per_value, per_element = 8 * len(PARTIALS[op]), 8 * fields
+    elif name == 'quantile':
+        per_value, per_element = 96, 16 * fields
+    elif name == 'histogram':
+        per_value, per_element = 48, 3 * fields
+    else:
+        per_value, per_element = 2, 4 * fields
+    if weighted:
+        # the weights' mask, and the data times the weights
+        per_value += 10
+    return per_value, per_element
+
+
+def partial_reduce(array, op, axis=None, missing=None, weights=None):
+    """
+    Return the partial result of ``op`` over ``axis`` of ``array``.
+
+    Masked elements of a masked array, and elements that are missing
+    according to ``missing``, are ignored. Reduced axes are kept with
+    size 1, so partial results of neighbouring blocks can be laid side
+    by side and merged along those axes.
+
+    Parameters
+    ----------
+    array: numpy (or numpy masked) array
+    op: str, one of ``OPERATIONS``
+    axis: int, tuple of int or None (all axes), the axes to reduce
+    missing: `MissingValues`, the values to ignore, if any
+    weights: numpy array that broadcasts against ``array``, the
+        weights of a weighted sum or mean. Elements with zero weight
+        are ignored by every operation.
+
+    Returns
+    -------
+    dict mapping the field names in ``partial_fields(op, weighted)``
+    to arrays
+    """
+    check_operation(op)
+    array = np.asanyarray(array)
+    axis = normalise_axis(axis, array.ndim)
+    if weights is not None:
+        weights = np.broadcast_to(weights, array.shape)
+
+    mask = np.ma.getmask(array)
+    if mask is not np.ma.nomask:
+        return _partial(np.ma.getdata(array), op, axis, ~mask, weights)
+    # a masked array with nothing masked
+    array = np.ma.getdata(array)
+    if not missing:
+        return _partial(array, op, axis, None, weights)
+    if array.ndim == 0:
+        return _partial(array, op, axis, missing.valid(array), weights)
+
+    # Find the missing values a slab (along the first axis) at a time
+    step = max(1, BLOCK_SIZE * array.shape[0] // max(array.size, 1))
+    shape = tuple(1 if i in axis else n for i, n in enumerate(array.shape))
+    partial = empty_partial(op, shape, weighted_dtype(array.dtype, weights),
+                            weighted=weights is not None)
+    for i in range(0, array.shape[0], step):
+        slab = array[i:i + step]
+        slab_weights = None if weights is None else weights[i:i + step]
+        index = slice(None) if 0 in axis else slice(i, i + step)
+        merge_into(partial, _partial(slab, op, axis, missing.valid(slab),
+                                     slab_weights),
+                   op, index)
+    return partial
+
+
+def _partial(array, op, axis, valid, weights=None):
+    """The partial result of the elements of ``array`` that are valid."""
+    shape = tuple(1 if i in axis else n for i, n in enumerate(array.shape))
+    if weights is not None:
+        nonzero = np.asarray(weights != 0)
+        valid = nonzero if valid is None else valid & nonzero
+    if valid is None:
+        n = int(np.prod([array.shape[i] for i in axis]))
+        count = np.full(shape, n, dtype=np.intp)
+        where = True
+    else:
+        count = np.sum(valid, axis=axis, keepdims=True, dtype=np.intp)
+        where = valid
+
+    if op in MOMENTS:
+        return _moments(array, op, axis, where, count, weights)
+    name, args = parse_operation(op)
+    if name in SKETCHES:
+        return _sketch(array, name, args, axis, valid, count, weights)
+
+    partial = {}
+    for field in partial_fields(op, weights is not None):
+        if field == 'count':
+            partial[field] = count
+        elif field == 'weight':
+            partial[field] = np.sum(weights, axis=axis, keepdims=True,
+                                    where=where)
+        elif field == 'sum':
+            values = array if weights is None else array * weights
+            partial[field] = np.sum(values, axis=axis, keepdims=True,
+                                    where=where)
+        else:
+            partial[field] = MERGE[field].reduce(
+                array, axis=axis, keepdims=True, where=where,
+                initial=identity(field, array.dtype))
+    return partial
+
+
+def _moments(array, op, axis, where, count, weights=None):
+    """
+    The partial result of one of `MOMENTS` over a block of data.
+
+    The block is in memory, so its mean is found first and the
+    deviations from it summed in a second, exact, pass over the block.
+    """
+    array = array.astype(field_dtype('m2', array.dtype), copy=False)
+    if weights is None:
+        weight = count
+        total = np.sum(array, axis=axis, keepdims=True, where=where)
+    else:
+        weight = np.sum(weights, axis=axis, keepdims=True, where=where,
+                        dtype=array.dtype)
+        total = np.sum(array * weights, axis=axis, keepdims=True,
+                       where=where)
+    mean = np.divide(total, weight, out=np.zeros_like(total),
+                     where=weight != 0)
+
+    partial = {'mean': mean}
+    # missing values can overflow, but aren't summed
+    with np.errstate(over='ignore', invalid='ignore'):
+        deviation = array - mean
+        power = deviation
+        for field in MOMENT_FIELDS[1:]:
+            if field not in PARTIALS[op]:
+                break
+            power = power * deviation
+            values = power if weights is None else power * weights
+            partial[field] = np.sum(values, axis=axis, keepdims=True,
+                                    where=where)
+    partial['count'] = count
+    if weights is not None:
+        partial['weight'] = weight
+    return partial
+
+
+def _cells(array, axis):
+    """
+    Lay the values of each result element along a last axis.
+
+    The reduced axes of ``array`` are moved to the end and flattened.
+    """
+    kept = [i for i in range(array.ndim) if i not in axis]
+    return array.transpose(kept + list(axis)).reshape(
+        [array.shape[i] for i in kept] + [-1])
+
+
+def _sketch(array, name, args, axis, valid, count, weights=None):
+    """The partial result of one of `SKETCHES` over a block of data."""
+    shape = count.shape
+    where = True if valid is None else valid
+    if name in ('count_above', 'count_below'):
+        compare = np.greater if name == 'count_above' else np.less
+        with np.errstate(invalid='ignore'):
+            hits = np.sum(compare(array, args[0]), axis=axis, keepdims=True,
+                          where=where, dtype=np.intp)
+        return {'hits': hits, 'count': count}
+
+    if name == 'histogram':
+        lo, hi, bins = args
+        if valid is not None:
+            valid = _cells(np.broadcast_to(valid, array.shape), axis)
+        counts = sketches.histogram(_cells(array, axis), valid, lo, hi, bins)
+        return {'histogram': counts.reshape(shape + (bins,)),
+                'count': count}
+
+    # quantile: weighted, with the invalid values given no weight
+    weights = np.ones(array.shape) if weights is None else weights
+    if valid is not None:
+        weights = np.where(valid, weights, 0)
+    centroids, centroid_weights = sketches.digest(_cells(array, axis),
+                                                  _cells(weights, axis))
+    size = (sketches.DIGEST_SIZE,)
+    partial = {'centroids': centroids.reshape(shape + size),
+               'centroid_weights': centroid_weights.reshape(shape + size)}
+    for field in ('min', 'max'):
+        partial[field] = MERGE[field].reduce(
+            array, axis=axis, keepdims=True, where=where,
+            initial=identity(field, array.dtype))
+    partial['count'] = count
+    return partial
+
+
+def _reduce_digest(partial, axis):
+    """Merge the digest partial results laid side by side along ``axis``."""
+    centroids, weights = sketches.merge_digests(
+        partial['centroids'], partial['centroid_weights'], axis)
+    merged = {'centroids': centroids, 'centroid_weights': weights}
+    for field in ('min', 'max', 'count'):
+        merged[field] = MERGE[field].reduce(partial[field], axis=axis,
+                                            keepdims=True)
+    return merged
+
+
+def _reduce_moments(partial, axis):
+    """
+    Merge the moment partial results laid side by side along ``axis``.
+
+    Each part's central moment sums are shifted to the merged mean
+    with the binomial expansion of ``(x - mean_i + delta_i) ** p``.
+    """
+    count = partial['count']
+    weight = partial.get('weight', count)
+    total = np.sum(weight, axis=axis, keepdims=True,
+                   dtype=partial['mean'].dtype)
+    mean = np.sum(weight * partial['mean'], axis=axis, keepdims=True)
+    mean = np.divide(mean, total, out=np.zeros_like(mean),
+                     where=total != 0)
+    delta = partial['mean'] - mean
+
+    merged = {'mean': mean}
+    m2 = partial['m2']
+    merged['m2'] = np.sum(m2 + weight * delta**2, axis=axis, keepdims=True)
+    if 'm3' in partial:
+        m3 = partial['m3']
+        merged['m3'] = np.sum(m3 + 3 * delta * m2 + weight * delta**3,
+                              axis=axis, keepdims=True)
+    if 'm4' in partial:
+        merged['m4'] = np.sum(partial['m4'] + 4 * delta * m3
+                              + 6 * delta**2 * m2 + weight * delta**4,
+                              axis=axis, keepdims=True)
+    merged['count'] = np.sum(count, axis=axis, keepdims=True)
+    if 'weight' in partial:
+        merged['weight'] = total.astype(partial['weight'].dtype)
+    return merged
+
+
+def _merge_joint(partials, op):
+    """Merge `JOINT` partial results that all have the same shape."""
+    stacked = {field: np.stack([partial[field] for partial in partials])
+               for field in partials[0]}
+    return {field: values[0] for field, values in
+            reduce_partial(stacked, op, axis=(0,)).items()}
+
+
+def reduce_partial(partial, op, axis=None):
+    """
+    Merge the partial results laid side by side along ``axis``.
+
+    This is how a partial result assembled from many blocks (e.g. by
+    concatenation) is collapsed; the reduced axes are kept with size 1.
+    """
+    if op in MOMENTS:
+        return _reduce_moments(partial, axis)
+    if operation_name(op) == 'quantile':
+        if axis is None:
+            axis = tuple(range(partial['count'].ndim))
+        return _reduce_digest(partial, normalise_axis(
+            axis, partial['count'].ndim))
+    return {field: MERGE[field].reduce(values, axis=axis, keepdims=True)
+            for field, values in partial.items()}
+
+
+def merge_partials(partials, op):
+    """Merge a sequence of partial results that all have the same shape."""
+    partials = list(partials)
+    if not partials:
+        raise ValueError(f"No partial results of {op!r} to merge")
+    if operation_name(op) in JOINT:
+        return _merge_joint(partials, op) if len(partials) > 1 \
+            else dict(partials[0])
+    merged = dict(partials[0])
+    for partial in partials[1:]:
+        for field in merged:
+            merged[field] = MERGE[field](merged[field], partial[field])
+    return merged
+
+
+def merge_into(target, partial, op, index):
+    """Merge ``partial`` into the part ``index`` of ``target``, in place."""
+    if operation_name(op) in JOINT:
+        region = {field: values[index] for field, values in target.items()}
+        for field, values in _merge_joint([region, partial], op).items():
+            target[field][index] = values
+        return
+    for field in target:
+        target[field][index] = MERGE[field](target[field][index],
+                                            partial[field])
+
+
+def finalise(partial, op):
+    """
+    Turn a (fully merged) partial result into the result of ``op``.
+
+    Results with no contributing values (e.g. the maximum of all
+    missing data) are masked. The mean of a weighted partial result is
+    the weighted mean.
+    """
+    check_operation(op)
+    name, args = parse_operation(op)
+    count = np.asanyarray(partial['count'])
+    if op == 'count':
+        return count
+    if name == 'histogram':
+        return np.asanyarray(partial['histogram'])
+    if name in ('count_above', 'count_below'):
+        return np.asanyarray(partial['hits'])
+    if op in MOMENTS:
+        result = _finalise_moments(partial, op)
+    elif name == 'quantile':
+        result = sketches.digest_quantile(
+            partial['centroids'], partial['centroid_weights'],
+            partial['min'], partial['max'], args[0])
+    elif op == 'mean':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total = np.asanyarray(partial['sum'])
+            result = np.true_divide(total, partial.get('weight', count),
+                                    dtype=result_dtype(op, total.dtype))
+    else:
+        result = np.asanyarray(partial[op])
+    if np.any(count == 0):
+        result = np.ma.masked_where(count == 0, result)
+    return result
+
+
+def _finalise_moments(partial, op):
+    """The result of one of `MOMENTS` from its merged partial result."""
+    m2 = partial['m2']
+    weight = partial.get('weight', partial['count'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = m2 / weight
+        if op == 'var':
+            return var
+        if op == 'std':
+            return np.sqrt(var)
+        if op == 'skew':
+            return partial['m3'] / weight / var**1.5
+        return partial['m4'] / weight / var**2 - 3
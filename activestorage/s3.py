@@ -0,0 +1,626 @@
+"""
+Concurrent byte-range reads of netCDF4 files in an S3 object store.
+
+`S3Reader` keeps a pool of keep-alive HTTP connections to the store
+and reads byte ranges with ``GET`` requests carrying a ``Range``
+header, many at a time but never more than ``max_concurrency`` in
+flight. It works with any S3-compatible store that accepts path-style
+addresses (``{endpoint}/{bucket}/{key}``); requests are signed with
+AWS Signature Version 4 when credentials are given.
+
+The chunk index of a netCDF4 variable is read through `S3File`, a
+file-like view of an object that h5py can open, and then only the
+chunks that a selection needs are fetched, concurrently, and decoded
+and reduced as they arrive:
+
+>>> reader = S3Reader('http://localhost:9000')  # doctest: +SKIP
+>>> partial = reader.reduce('bucket', 'tas.nc', 'tas', 'max',
+...                         indices=(slice(0, 12),))  # doctest: +SKIP
+>>> finalise(partial, 'max')  # doctest: +SKIP
+array([[[310.2]]], dtype=float32)
+
+The blocking methods run the reads on an event loop in a background
+thread, so they may be called from any thread (for instance dask
+workers) and all share the same connections. The coroutines
+(`S3Reader.get_range` and friends) may instead be awaited directly,
+but the two styles should not be mixed on one reader.
+"""
+import asyncio
+import datetime
+import hashlib
+import hmac
+import io
+import logging
+import ssl
+import threading
+from collections import OrderedDict
+from urllib.parse import quote, urlsplit
+
+import h5py
+import netCDF4
+import numpy as np
+
+from activestorage import stats as _stats
+from activestorage.chunks import StorageLayout, orthogonal_index
+from activestorage.decoding import Packing
+from activestorage.plan import plan_selection
+from activestorage.ranges import coalesce, gather_rows, selection_rows
+from activestorage.reductions import (
+    MissingValues,
+    empty_partial,
+    merge_into,
+    normalise_axis,
+    partial_reduce,
+)
+
+logger = logging.getLogger(__name__)
+
+#: SHA256 of an empty payload, as sent with GET and HEAD requests
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+class ObjectStoreError(OSError):
+    """The object store refused or failed a request."""
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+def sign_v4(method, host, path, headers, access_key, secret_key,
+            region='us-east-1', now=None, service='s3'):
+    """
+    Return ``headers`` with an AWS Signature Version 4 added.
+
+    Parameters
+    ----------
+    method: str, the HTTP method
+    host: str, the ``Host`` header (including any non-default port)
+    path: str, the URI-encoded path of the request (no query string)
+    headers: dict, the other headers to sign, e.g. ``Range``
+    access_key, secret_key: str, the credentials
+    region: str, the region of the store
+    now: `datetime.datetime` in UTC, by default the current time
+
+    Returns
+    -------
+    dict, the signed headers plus ``x-amz-date``,
+    ``x-amz-content-sha256`` and ``Authorization``
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = amz_date[:8]
+
+    headers = {name.lower(): str(value).strip()
+               for name, value in headers.items()}
+    headers.update({'host': host, 'x-amz-date': amz_date,
+                    'x-amz-content-sha256': EMPTY_SHA256})
+    names = sorted(headers)
+    signed_headers = ';'.join(names)
+    canonical = '\n'.join([
+        method, path, '',
+        ''.join(f"{name}:{headers[name]}\n" for name in names),
+        signed_headers, EMPTY_SHA256,
+    ])
+
+    scope = f"{date}/{region}/{service}/aws4_request"
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical.encode('utf-8')).hexdigest(),
+    ])
+    key = _hmac(f"AWS4{secret_key}".encode('utf-8'), date)
+    for part in (region, service, 'aws4_request'):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode('utf-8'),
+                         hashlib.sha256).hexdigest()
+
+    headers['authorization'] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}")
+    del headers['host']
+    return headers
+
+
+class S3Reader:
+    """
+    Read byte ranges of objects over a pool of HTTP connections.
+
+    At most ``max_concurrency`` requests are in flight at once, and so
+    at most that many connections are opened; idle connections are
+    kept for the next request.
+    """
+
+    def __init__(self, endpoint_url, max_concurrency=16, access_key=None,
+                 secret_key=None, region='us-east-1', timeout=60,
+                 gap=1 << 20, max_request=16 << 20):
+        """
+        Parameters
+        ----------
+        endpoint_url: str, e.g. ``'https://s3.eu-west-2.amazonaws.com'``
+        max_concurrency: int, the most requests in flight at once
+        access_key, secret_key: str, credentials to sign requests with;
+            requests are anonymous if these are not given
+        region: str, the region that signatures are made for
+        timeout: float, seconds to wait for any one response
+        gap: int, ranges of an object at most this many bytes apart
+            are fetched in one request (see
+            `activestorage.ranges.coalesce`)
+        max_request: int, the most bytes that ranges are merged into,
+            so that large reads are still fetched concurrently
+        """
+        parts = urlsplit(endpoint_url)
+        self.endpoint_url = endpoint_url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.max_concurrency = max_concurrency
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+        self.gap = gap
+        self.max_request = max_request
+        self.connections_opened = 0
+        self._idle = []
+        self._semaphore = None
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._layouts = {}
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}: {self.endpoint_url}>"
+
+    @property
+    def _host_header(self):
+        default = 443 if self.scheme == 'https' else 80
+        if self.port == default:
+            return self.host
+        return f"{self.host}:{self.port}"
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    async def _connection(self):
+        """Return an idle connection, or open a new one."""
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        context = ssl.create_default_context() \
+            if self.scheme == 'https' else None
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=context)
+        self.connections_opened += 1
+        return reader, writer, False
+
+    @staticmethod
+    async def _response(reader, method):
+        """Read a response; return its status, headers and body."""
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if method == 'HEAD' or status in (204, 304):
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    # the trailer section, up to a blank line
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    break
+                parts.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(parts)
+        else:
+            body = await reader.readexactly(
+                int(headers.get('content-length', 0)))
+        return status, headers, body
+
+    async def _request(self, method, bucket, key, headers=None):
+        """Make one request, retrying once on a stale pooled connection."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        path = quote(f"/{bucket}/{key}", safe='/~')
+        headers = dict(headers or {})
+        if self.access_key is not None:
+            headers = sign_v4(method, self._host_header, path, headers,
+                              self.access_key, self.secret_key, self.region)
+        head = ''.join(
+            [f"{method} {path} HTTP/1.1\r\n",
+             f"Host: {self._host_header}\r\n"]
+            + [f"{name}: {value}\r\n" for name, value in headers.items()]
+            + ['\r\n']).encode('latin-1')
+
+        async with self._semaphore:
+            while True:
+                reader, writer, reused = await self._connection()
+                try:
+                    writer.write(head)
+                    await writer.drain()
+                    status, response_headers, body = await asyncio.wait_for(
+                        self._response(reader, method), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        # the server closed an idle connection
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                break
+
+        if response_headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+
+        if status == 404:
+            raise FileNotFoundError(f"No such object {bucket}/{key}")
+        if status >= 300:
+            raise ObjectStoreError(
+                f"{method} {bucket}/{key} answered {status}: "
+                f"{body[:200].decode('utf-8', 'replace')}")
+        return response_headers, body
+
+    async def get_range(self, bucket, key, offset, size):
+        """Return ``size`` bytes of an object from byte ``offset``."""
+        if size <= 0:
+            return b''
+        _, body = await self._request(
+            'GET', bucket, key,
+            {'Range': f"bytes={offset}-{offset + size - 1}"})
+        if len(body) != size:
+            raise ObjectStoreError(
+                f"Asked for {size} bytes at byte {offset} of {bucket}/{key}"
+                f" but got {len(body)}")
+        return body
+
+    async def get_ranges(self, bucket, key, ranges):
+        """
+        Return the bytes of each ``(offset, size)`` range.
+
+        Ranges near each other are fetched in one request (see
+        `coalesce`), and the requests are made concurrently. The bytes
+        of each range are returned as a memoryview of its request's.
+        """
+        offsets = [offset for offset, _ in ranges]
+        sizes = [size for _, size in ranges]
+        starts, stops, group = coalesce(offsets, sizes, self.gap,
+                                        self.max_request)
+        bodies = await asyncio.gather(
+            *(self.get_range(bucket, key, start, stop - start)
+              for start, stop in zip(starts.tolist(), stops.tolist())))
+        bodies = [memoryview(body) for body in bodies]
+        return [bodies[g][offset - start:offset - start + size]
+                for g, start, offset, size in zip(
+                    group.tolist(), starts[group].tolist(), offsets, sizes)]
+
+    async def get_size(self, bucket, key):
+        """Return the size of an object in bytes."""
+        headers, _ = await self._request('HEAD', bucket, key)
+        return int(headers['content-length'])
+
+    async def aclose(self):
+        """Close the idle connections."""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    # ------------------------------------------------------------------
+    # Blocking interface
+    # ------------------------------------------------------------------
+    def _run(self, coroutine):
+        """Run a coroutine on the reader's event loop and wait for it."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def read_range(self, bucket, key, offset, size):
+        """Blocking `get_range`."""
+        return self._run(self.get_range(bucket, key, offset, size))
+
+    def read_ranges(self, bucket, key, ranges):
+        """Blocking `get_ranges`."""
+        return self._run(self.get_ranges(bucket, key, ranges))
+
+    def size(self, bucket, key):
+        """Blocking `get_size`."""
+        return self._run(self.get_size(bucket, key))
+
+    def open(self, bucket, key, block_size=1 << 18):
+        """Return a read-only `S3File` of an object."""
+        return S3File(self, bucket, key, block_size=block_size)
+
+    def close(self):
+        """Close the connections and stop the event loop."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+
+    # ------------------------------------------------------------------
+    # Reductions
+    # ------------------------------------------------------------------
+    def variable_metadata(self, bucket, key, ncvar, group=None):
+        """
+        Return the `StorageLayout`, `MissingValues` and `Packing` of a
+        variable (the packing is None if it isn't packed).
+
+        They are read (through an `S3File`) only the first time.
+        """
+        cache_key = (bucket, key, ncvar, tuple(group or ()))
+        if cache_key not in self._layouts:
+            path = '/'.join(list(group or ()) + [ncvar])
+            with self.open(bucket, key) as f:
+                layout = StorageLayout.from_file(f, ncvar, group)
+                with h5py.File(f, 'r') as h5:
+                    dataset = h5[path]
+                    default_fill = None
+                    if dataset.dtype.itemsize > 1:
+                        default_fill = netCDF4.default_fillvals.get(
+                            dataset.dtype.str[1:])
+                    attrs = dict(dataset.attrs)
+                    missing = MissingValues.from_attributes(attrs,
+                                                            default_fill)
+                    packing = Packing.from_attributes(attrs)
+            if layout is None:
+                raise ObjectStoreError(
+                    f"Can't read the chunks of {ncvar} in {bucket}/{key}")
+            self._layouts[cache_key] = (layout, missing, packing)
+        return self._layouts[cache_key]
+
+    async def reduce_chunks(self, bucket, key, layout, plan, op, axis,
+                            missing=None, stats=_stats.NULL):
+        """
+        Fetch and reduce the chunks of a plan, concurrently.
+
+        Stored chunks near each other in the object are fetched in one
+        request (see `get_ranges`), and each chunk is decoded and
+        reduced in a worker thread as soon as its bytes arrive, while
+        the other requests are in flight. Only the rows of the
+        selection of a contiguous, unfiltered variable are fetched,
+        rather than the whole variable.
+
+        See `activestorage.chunks.reduce_chunks` for the arguments and
+        the returned partial result.
+        """
+        shape = tuple(1 if i in axis else n
+                      for i, n in enumerate(plan.out_shape))
+        partial = empty_partial(op, shape, layout.dtype)
+        chunk_shape = layout.shape if layout.contiguous else layout.chunk_shape
+
+        def reduce_chunk(chunk, raw, filter_mask):
+            if raw is None:
+                data = np.full(chunk_shape, layout.fill_value,
+                               dtype=layout.dtype)
+            else:
+                with stats.stage('decode'):
+                    data = layout.decode(raw, filter_mask)
+                stats.add(bytes_decompressed=len(data))
+                data = np.frombuffer(data, dtype=layout.dtype).reshape(
+                    chunk_shape)
+            data = data[tuple(slice(0, n) for n in chunk.shape)]
+            return reduce_selected(orthogonal_index(data, chunk.selection))
+
+        def reduce_selected(data):
+            with stats.stage('reduce'):
+                chunk_partial = partial_reduce(data, op, axis,
+                                               missing=missing)
+            stats.add(elements=data.size)
+            return chunk_partial
+
+        async def fetch(start, stop):
+            with stats.stage('read'):
+                body = await self.get_range(bucket, key, start, stop - start)
+            stats.add(bytes_read=len(body))
+            return body
+
+        async def fetch_and_reduce(members, start, stop):
+            # neighbouring chunks come in one response
+            body = memoryview(await fetch(start, stop))
+
+            def reduce_members():
+                return [(chunk, reduce_chunk(
+                    chunk, body[offset - start:offset - start + size],
+                    filter_mask))
+                    for chunk, (offset, size, filter_mask) in members]
+
+            return await asyncio.to_thread(reduce_members)
+
+        async def fetch_and_reduce_rows(chunk, offset):
+            itemsize = layout.dtype.itemsize
+            rows, per_row = selection_rows(offset, layout.shape,
+                                           chunk.selection, itemsize)
+            starts, stops, group = coalesce(
+                rows, np.full(rows.size, per_row * itemsize), self.gap,
+                self.max_request)
+            bodies = await asyncio.gather(
+                *map(fetch, starts.tolist(), stops.tolist()))
+
+            def gather_and_reduce():
+                data = np.empty(rows.size * per_row, dtype=layout.dtype)
+                gather_rows(bodies, starts, group, rows, per_row, data)
+                # an integer index selects one position, then drops its axis
+                data = data.reshape(
+                    [len(range(index.start, index.stop, index.step))
+                     if isinstance(index, slice) else np.size(index)
+                     for index in chunk.selection])
+                data = data[tuple(
+                    slice(None) if isinstance(index, slice) or np.ndim(index)
+                    else 0 for index in chunk.selection)]
+                return [(chunk, reduce_selected(data))]
+
+            return await asyncio.to_thread(gather_and_reduce)
+
+        async def fill_and_reduce(chunk):
+            # chunks that were never written hold the fill value
+            return await asyncio.to_thread(
+                lambda: [(chunk, reduce_chunk(chunk, None, 0))])
+
+        chunks = list(plan)
+        stored = [(chunk, layout.chunks[chunk.coords]) for chunk in chunks
+                  if chunk.coords in layout.chunks]
+        tasks = [fill_and_reduce(chunk) for chunk in chunks
+                 if chunk.coords not in layout.chunks]
+        if layout.contiguous and not layout.filters and stored:
+            (chunk, (offset, _, _)), = stored
+            tasks.append(fetch_and_reduce_rows(chunk, offset))
+        else:
+            starts, stops, group = coalesce(
+                [offset for _, (offset, _, _) in stored],
+                [size for _, (_, size, _) in stored],
+                self.gap, self.max_request)
+            members = [[] for _ in range(starts.size)]
+            for member, g in zip(stored, group.tolist()):
+                members[g].append(member)
+            tasks.extend(map(fetch_and_reduce, members, starts.tolist(),
+                             stops.tolist()))
+
+        for reduced in await asyncio.gather(*tasks):
+            for chunk, chunk_partial in reduced:
+                merge_into(partial, chunk_partial, op, chunk.out_index(axis))
+        return partial
+
+    def reduce(self, bucket, key, ncvar, op, indices=Ellipsis, axis=None,
+               group=None, mask=True):
+        """
+        Return the partial result of ``op`` over a subspace of a variable.
+
+        Parameters
+        ----------
+        bucket, key: str, the netCDF4 object
+        ncvar: str, the netCDF variable
+        op: str, one of ``activestorage.reductions.OPERATIONS``
+        indices: the subspace, as for `activestorage.plan.plan_selection`
+        axis: int, tuple of int or None (all axes), the axes of the
+            subspace to reduce
+        group: sequence of str, the variable's group, as for
+            `activestorage.netcdf_array.NetCDFArray`
+        mask: bool, whether to ignore missing data
+
+        Returns
+        -------
+        dict, the partial result (see
+        `activestorage.reductions.partial_reduce`)
+        """
+        layout, missing, packing = self.variable_metadata(bucket, key,
+                                                          ncvar, group)
+        chunk_shape = layout.shape if layout.contiguous else layout.chunk_shape
+        plan = plan_selection(layout.shape, chunk_shape, indices,
+                              dtype=layout.dtype)
+        axis = normalise_axis(axis, len(plan.out_shape))
+        with _stats.record(op, f"s3://{bucket}/{key}", ncvar,
+                           route='s3') as request:
+            stored = op if packing is None else packing.packed_operation(op)
+            partial = self._run(self.reduce_chunks(
+                bucket, key, layout, plan, stored, axis,
+                missing=missing if mask else None, stats=request))
+            if packing is not None:
+                partial = packing.unpack_partial(partial, op)
+            request.add(bytes_returned=sum(
+                values.nbytes for values in partial.values()))
+        return partial
+
+
+class S3File(io.RawIOBase):
+    """
+    A read-only, seekable file of an object in an S3 store.
+
+    Reads are made in blocks of ``block_size`` bytes, and the most
+    recently used blocks are kept, so that the many small reads of the
+    HDF5 library (when reading metadata) make few requests.
+    """
+
+    def __init__(self, reader, bucket, key, block_size=1 << 18,
+                 max_blocks=64):
+        """
+        Parameters
+        ----------
+        reader: `S3Reader`
+        bucket, key: str, the object
+        block_size: int, the size of each ranged read
+        max_blocks: int, the number of blocks kept
+        """
+        super().__init__()
+        self.reader = reader
+        self.bucket = bucket
+        self.key = key
+        self.name = f"s3://{bucket}/{key}"
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.size = reader.size(bucket, key)
+        self._position = 0
+        self._blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        start = self._position
+        stop = min(start + len(buffer), self.size)
+        if stop <= start:
+            return 0
+
+        numbers = range(start // self.block_size,
+                        (stop - 1) // self.block_size + 1)
+        missing = [n for n in numbers if n not in self._blocks]
+        if missing:
+            ranges = [(n * self.block_size,
+                       min(self.block_size, self.size - n * self.block_size))
+                      for n in missing]
+            for n, data in zip(missing, self.reader.read_ranges(
+                    self.bucket, self.key, ranges)):
+                self._blocks[n] = data
+
+        view = memoryview(buffer)
+        written = 0
+        for n in numbers:
+            self._blocks.move_to_end(n)
+            block = self._blocks[n]
+            lo = max(start, n * self.block_size) - n * self.block_size
+            hi = min(stop, (n + 1) * self.block_size) - n * self.block_size
+            view[written:written + hi - lo] = block[lo:hi]
+            written += hi - lo
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+        self._position = stop
+        return written
@@ -0,0 +1,294 @@
+"""
+A local stand-in for an active storage server.
+
+The server reduces byte ranges, hyperslabs of contiguous arrays or
+lists of stored chunks of files under its root directory with the
+vectorised engine, and returns partial results. Run it with::
+
+    python -m activestorage.server --root /path/to/data --port 8000
+
+and point an `activestorage.client.ActiveStorageClient` at it. Each
+response carries the server-side cost of the request (bytes read from
+disk and CPU time), so the active round trip can be measured against a
+local read on one machine.
+
+Requests are ``POST``-ed to ``/reduce`` as ``{"requests": [...]}`` and
+answered with ``{"results": [...]}``, one result per request, both
+encoded by `activestorage.protocol.dumps`; a document with a bad
+request is answered with status 400, and one that fails otherwise
+with 500. A request is a dict with the keys
+
+``path``
+    The file, relative to the server root (or absolute, but inside it).
+``dtype``
+    The numpy dtype string of the stored values, e.g. ``"<f4"``.
+``op``
+    One of ``activestorage.reductions.OPERATIONS``.
+``missing``
+    Optional, see `activestorage.protocol.encode_missing`.
+``axis``
+    Optional list of axes to reduce, all of them by default.
+
+and then one of
+
+``offset`` and ``size``
+    A contiguous byte range.
+``offset``, ``shape`` and optionally ``start``, ``count``, ``stride``
+    A hyperslab of the contiguous array at ``offset`` (see
+    `activestorage.storage.read_hyperslab`).
+``offset``, ``shape`` and ``selection``
+    An orthogonal selection (see
+    `activestorage.protocol.encode_selection`) of the contiguous array
+    at ``offset``, which may have integer array indices. Only the rows
+    of the selection (see `activestorage.ranges.selection_rows`) are
+    read, and the axes of integer indices are dropped.
+``chunks``, ``chunk_shape`` and optionally ``filters`` and ``merge``
+    Stored chunks, each a dict with ``offset``, ``size``,
+    ``filter_mask`` and ``selection``. The partial results of the
+    chunks are merged, unless ``merge`` is false, when the result has
+    ``partials``, the partial result of each chunk in order, rather
+    than a ``partial``.
+"""
+import argparse
+import logging
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+from activestorage import protocol
+from activestorage.chunks import StorageLayout, orthogonal_index
+from activestorage.reductions import (
+    as_array,
+    merge_partials,
+    partial_reduce,
+)
+from activestorage.ranges import read_ranges, read_rows, selection_rows
+from activestorage.stats import RequestStats
+from activestorage.storage import read_bytes, read_hyperslab
+
+logger = logging.getLogger(__name__)
+
+
+def resolve(root, path):
+    """Return ``path`` as an absolute path, refusing paths outside root."""
+    root = Path(root).resolve()
+    resolved = (root / path).resolve()
+    if resolved != root and root not in resolved.parents:
+        raise PermissionError(f"{path} is outside the server root {root}")
+    return resolved
+
+
+def _reduce_chunks(f, request, dtype, op, axis, missing):
+    """Reduce the selected part of each stored chunk of a request."""
+    chunk_shape = tuple(request['chunk_shape'])
+    filters = [(code, tuple(values))
+               for code, values in request.get('filters', [])]
+    layout = StorageLayout(dtype, chunk_shape, chunk_shape, filters, {})
+    chunks = request['chunks']
+    # neighbouring chunks are read together, a bounded amount at a time
+    stats = RequestStats()
+    partials = [None] * len(chunks)
+    counts = dict.fromkeys(('bytes_decompressed', 'elements'), 0)
+    for k, raw in read_ranges(f, [chunk['offset'] for chunk in chunks],
+                              [chunk['size'] for chunk in chunks],
+                              stats=stats):
+        chunk = chunks[k]
+        data = layout.decode(raw, chunk.get('filter_mask', 0))
+        counts['bytes_decompressed'] += len(data)
+        data = np.frombuffer(data, dtype=dtype).reshape(chunk_shape)
+        data = orthogonal_index(
+            data, protocol.decode_selection(chunk['selection']))
+        counts['elements'] += data.size
+        partials[k] = partial_reduce(data, op, axis, missing=missing)
+    counts['bytes_read'] = stats.bytes_read
+    if not request.get('merge', True):
+        return partials, counts
+    return merge_partials(partials, op), counts
+
+
+def _reduce_rows(f, request, dtype, op, axis, missing):
+    """Reduce an orthogonal selection of a contiguous array."""
+    shape = request['shape']
+    selection = protocol.decode_selection(request['selection'])
+    if len(selection) != len(shape):
+        raise IndexError(f"Selection {request['selection']} of an array "
+                         f"of shape {shape}")
+    sizes = []
+    for index, n in zip(selection, shape):
+        if isinstance(index, slice):
+            positions = np.arange(index.start, index.stop, index.step)
+        else:
+            positions = np.atleast_1d(index)
+        if positions.size and not 0 <= positions.min() <= positions.max() < n:
+            raise IndexError(f"Index {index} is out of bounds for size {n}")
+        sizes.append(positions.size)
+
+    stats = RequestStats()
+    rows, per_row = selection_rows(request['offset'], shape, selection,
+                                   dtype.itemsize)
+    data = read_rows(f, rows, per_row, dtype, stats=stats)
+    # an integer index selects one position, then drops its axis
+    data = data.reshape(sizes)[tuple(
+        slice(None) if isinstance(index, slice) or np.ndim(index) else 0
+        for index in selection)]
+    partial = partial_reduce(data, op, axis, missing=missing)
+    return partial, {'bytes_read': stats.bytes_read,
+                     'bytes_decompressed': data.nbytes,
+                     'elements': data.size}
+
+
+def execute(request, root):
+    """
+    Carry out one reduction request.
+
+    Returns a ``(partial, counts)`` tuple, where ``counts`` is a dict
+    of the ``bytes_read``, ``bytes_decompressed`` and ``elements``
+    reduced, and ``partial`` is a list of partial results for chunks
+    that aren't merged.
+    """
+    path = resolve(root, request['path'])
+    dtype = np.dtype(request['dtype'])
+    op = request['op']
+    axis = request.get('axis')
+    missing = protocol.decode_missing(request.get('missing'))
+
+    with open(path, 'rb') as f:
+        if 'chunks' in request:
+            return _reduce_chunks(f, request, dtype, op, axis, missing)
+
+        if 'selection' in request:
+            return _reduce_rows(f, request, dtype, op, axis, missing)
+
+        if 'shape' in request:
+            stats = RequestStats()
+            data = read_hyperslab(f, request['offset'], request['shape'],
+                                  request.get('start'), request.get('count'),
+                                  request.get('stride'), dtype,
+                                  request=stats)
+            partial = partial_reduce(data, op, axis, missing=missing)
+            return partial, {'bytes_read': stats.bytes_read,
+                             'bytes_decompressed': data.nbytes,
+                             'elements': data.size}
+
+        raw = read_bytes(f, request['offset'], request['size'])
+        data = as_array(raw, dtype)
+        partial = partial_reduce(data, op, axis, missing=missing)
+        return partial, {'bytes_read': len(raw),
+                         'bytes_decompressed': len(raw),
+                         'elements': data.size}
+
+
+class ReductionHandler(BaseHTTPRequestHandler):
+    """Answer ``POST /reduce`` requests."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        """Reduce every request of the posted document."""
+        if self.path != '/reduce':
+            self.send_error(404, f"No such endpoint {self.path}")
+            return
+
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        try:
+            requests = protocol.loads(body)['requests']
+            results = []
+            for request in requests:
+                start, cpu = time.perf_counter(), time.thread_time()
+                partial, counts = execute(request, self.server.root)
+                result = {'stats': dict(
+                    counts,
+                    cpu_time=time.thread_time() - cpu,
+                    elapsed=time.perf_counter() - start,
+                )}
+                if isinstance(partial, list):
+                    result['partials'] = [protocol.encode_partial(p)
+                                          for p in partial]
+                else:
+                    result['partial'] = protocol.encode_partial(partial)
+                results.append(result)
+        except PermissionError as error:
+            self.send_error(403, str(error))
+            return
+        except (KeyError, ValueError, TypeError, IndexError, OSError,
+                EOFError, NotImplementedError, zlib.error) as error:
+            logger.exception("Bad request")
+            self.send_error(400, f"{type(error).__name__}: {error}")
+            return
+        except Exception as error:
+            # answer rather than drop the connection
+            logger.exception("Failed request")
+            self.send_error(500, f"{type(error).__name__}: {error}")
+            return
+
+        response = protocol.dumps({'results': results})
+        self.send_response(200)
+        self.send_header('Content-Type', protocol.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        """Log requests with `logging` rather than to stderr."""
+        logger.debug(format, *args)
+
+
+class ActiveStorageServer(ThreadingHTTPServer):
+    """A threaded HTTP server that reduces data under ``root``."""
+
+    daemon_threads = True
+
+    def __init__(self, address=('localhost', 0), root='.'):
+        """
+        Parameters
+        ----------
+        address: ``(host, port)`` tuple, port 0 picks a free port
+        root: the directory whose files may be reduced
+        """
+        super().__init__(address, ReductionHandler)
+        self.root = Path(root).resolve()
+
+    @property
+    def url(self):
+        """The URL that clients should connect to."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background (daemon) thread and return it."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop serving and release the socket."""
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    """Run a server until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--root', default='.',
+                        help="directory whose files may be reduced")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    server = ActiveStorageServer((args.host, args.port), args.root)
+    logger.info("Serving %s at %s", server.root, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
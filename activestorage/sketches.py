@@ -0,0 +1,184 @@
+"""
+Mergeable sketches of the distribution of data, for percentiles.
+
+A sketch summarises the values of each *cell* of a reduction (each
+element of its result) in a fixed number of numbers, whatever the
+number of values, and sketches of the same cells can be merged. The
+functions here work on many cells at once: their arguments have the
+cells along every axis but the last.
+
+`histogram` counts values in fixed bins. A digest (`digest`,
+`merge_digests`, `digest_quantile`) is a t-digest: the values, sorted,
+are summarised by `DIGEST_SIZE` centroids (the mean and weight of a run
+of neighbouring values) that are smaller near the tails, so quantiles
+are found to within a small fraction of a percent of rank, and more
+closely still near 0 and 1.
+
+>>> import numpy as np
+>>> x = np.arange(1000.)[None]
+>>> centroids, weights = digest(x, np.ones_like(x))
+>>> centroids.shape
+(1, 100)
+>>> float(digest_quantile(centroids, weights, x.min(-1), x.max(-1), 0.5)[0])
+499.5
+"""
+import numpy as np
+
+#: The number of centroids of a digest
+DIGEST_SIZE = 100
+
+
+def histogram(x, valid, lo, hi, bins):
+    """
+    Count the valid values of each cell in ``bins`` equal bins.
+
+    As for ``numpy.histogram``, the bins span ``lo`` to ``hi``, the last
+    bin includes ``hi`` and values outside the range aren't counted.
+
+    Parameters
+    ----------
+    x: numpy array, with the values of each cell along the last axis
+    valid: boolean numpy array, or None if every value is valid
+    lo, hi: the range of the bins
+    bins: int, the number of bins
+
+    Returns
+    -------
+    numpy array of ``x.shape[:-1] + (bins,)`` counts
+    """
+    cells = x.shape[:-1]
+    x = x.reshape(-1, x.shape[-1])
+    with np.errstate(invalid='ignore'):
+        inside = (x >= lo) & (x <= hi)
+        if valid is not None:
+            inside &= valid.reshape(x.shape)
+        position = (x[inside].astype(np.float64) - lo) * (bins / (hi - lo))
+    index = np.minimum(position.astype(np.intp), bins - 1)
+    index += np.nonzero(inside)[0] * bins
+    counts = np.bincount(index, minlength=x.shape[0] * bins)
+    return counts.reshape(cells + (bins,))
+
+
+def _scale(q):
+    """The t-digest k1 scale function, from quantile to centroid."""
+    return DIGEST_SIZE * (np.arcsin(2 * q - 1) / np.pi + 0.5)
+
+
+def digest(x, weights):
+    """
+    Return the digests of the values of each cell.
+
+    Parameters
+    ----------
+    x: numpy array, with the values of each cell along the last axis
+    weights: numpy array like ``x``, the weight of each value; values
+        with zero weight (e.g. missing data) are left out
+
+    Returns
+    -------
+    The centroids and their weights: two float64 numpy arrays of shape
+    ``x.shape[:-1] + (DIGEST_SIZE,)``. Unused centroids have zero
+    weight.
+    """
+    cells = x.shape[:-1]
+    x = x.reshape(-1, x.shape[-1]).astype(np.float64)
+    weights = np.broadcast_to(weights, cells + x.shape[-1:])
+    weights = weights.reshape(x.shape).astype(np.float64)
+
+    # sort each cell's values, with the unused ones last
+    used = weights > 0
+    order = np.argsort(np.where(used, x, np.inf), axis=-1, kind='stable')
+    x = np.take_along_axis(x, order, -1)
+    weights = np.take_along_axis(weights, order, -1)
+    used = np.take_along_axis(used, order, -1)
+    x[~used] = 0
+
+    # the quantile of the middle of each value gives its centroid
+    cumulative = np.cumsum(weights, axis=-1)
+    total = cumulative[:, -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = (cumulative - weights / 2) / total
+    q = np.nan_to_num(np.clip(q, 0, 1))
+    index = np.clip(_scale(q).astype(np.intp), 0, DIGEST_SIZE - 1)
+    index += np.arange(x.shape[0])[:, None] * DIGEST_SIZE
+
+    size = x.shape[0] * DIGEST_SIZE
+    weight = np.bincount(index.ravel(), weights.ravel(), minlength=size)
+    total = np.bincount(index.ravel(), (weights * x).ravel(), minlength=size)
+    centroids = np.divide(total, weight, out=np.zeros(size),
+                          where=weight > 0)
+    return (centroids.reshape(cells + (DIGEST_SIZE,)),
+            weight.reshape(cells + (DIGEST_SIZE,)))
+
+
+def merge_digests(centroids, weights, axis):
+    """
+    Merge the digests of cells laid side by side along ``axis``.
+
+    ``axis`` are the axes of the cells (not the last, centroid, axis);
+    they are kept with size 1.
+    """
+    ndim = centroids.ndim
+    kept = [i for i in range(ndim - 1) if i not in axis]
+    order = kept + list(axis) + [ndim - 1]
+    shape = tuple(1 if i in axis else n
+                  for i, n in enumerate(centroids.shape[:-1]))
+    cells = [centroids.shape[i] for i in kept]
+    centroids = centroids.transpose(order).reshape(cells + [-1])
+    weights = weights.transpose(order).reshape(cells + [-1])
+    centroids, weights = digest(centroids, weights)
+    return (centroids.reshape(shape + (DIGEST_SIZE,)),
+            weights.reshape(shape + (DIGEST_SIZE,)))
+
+
+def digest_quantile(centroids, weights, minimum, maximum, q):
+    """
+    Return the ``q`` quantile of the values of each cell.
+
+    Centroids are taken to stand at the middle of their weight, with
+    the least and greatest values at either end, and quantiles are
+    interpolated linearly between them. For values of unit weight
+    that have a centroid each, this is ``numpy.quantile``'s ``'hazen'``
+    method.
+
+    Parameters
+    ----------
+    centroids, weights: the digests, as returned by `digest`
+    minimum, maximum: numpy arrays of the least and greatest value of
+        each cell
+    q: float, the quantile, between 0 and 1
+
+    Returns
+    -------
+    float64 numpy array of ``centroids.shape[:-1]``, NaN for cells
+    with no values
+    """
+    used = weights > 0
+    order = np.argsort(np.where(used, centroids, np.inf), axis=-1,
+                       kind='stable')
+    centroids = np.take_along_axis(centroids, order, -1)
+    weights = np.take_along_axis(weights, order, -1)
+    used = np.take_along_axis(used, order, -1)
+
+    cumulative = np.cumsum(weights, axis=-1)
+    total = cumulative[..., -1:]
+    minimum = np.asarray(minimum, dtype=np.float64)[..., None]
+    maximum = np.asarray(maximum, dtype=np.float64)[..., None]
+    # unused centroids go at the top, with no weight
+    values = np.where(used, centroids, maximum)
+    positions = np.concatenate(
+        [np.zeros_like(total), cumulative - weights / 2, total], axis=-1)
+    values = np.concatenate([minimum, values, maximum], axis=-1)
+
+    target = q * total
+    upper = np.sum(positions <= target, axis=-1, keepdims=True)
+    upper = np.clip(upper, 1, positions.shape[-1] - 1)
+    lower = upper - 1
+    p0 = np.take_along_axis(positions, lower, -1)
+    p1 = np.take_along_axis(positions, upper, -1)
+    v0 = np.take_along_axis(values, lower, -1)
+    v1 = np.take_along_axis(values, upper, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(p1 > p0, (target - p0) / (p1 - p0), 0)
+        result = v0 + fraction * (v1 - v0)
+    return np.where(total > 0, result, np.nan)[..., 0]
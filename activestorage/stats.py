@@ -0,0 +1,232 @@
+"""
+Counts of the data moved by each active storage request.
+
+Every reduction request (a `NetCDFArray` subspace, a `do_operation`
+call, a `load` answered from the cache, ...) is recorded as a
+`RequestStats`: the bytes read from storage, the bytes they were
+decompressed to, the bytes returned to the client, the number of
+elements reduced, and the time spent in each stage. The ratio of bytes
+read to bytes returned is the data movement saved by reducing next to
+the data; requests whose ratio is near 1 moved everything.
+
+The records of recent requests are kept by the process-wide
+`collector`:
+
+>>> collector().reset()
+>>> with record('max', 'tas.nc', 'tas', route='example') as stats:
+...     stats.add(bytes_read=4000, bytes_returned=16, elements=1000)
+>>> collector().requests[-1].reduction_ratio
+250.0
+>>> collector().summary()['example']['bytes_read']
+4000
+
+and, once `log_to` has been called, written as JSON lines to a file or
+stream (through the ``activestorage.stats`` logger).
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+#: The counters of a request
+COUNTERS = ('bytes_read', 'bytes_decompressed', 'bytes_returned',
+            'elements')
+
+
+class RequestStats:
+    """What one request read, returned and spent its time on."""
+
+    def __init__(self, op=None, filename=None, variable=None, route=None):
+        """
+        Parameters
+        ----------
+        op: str, the reduction operation
+        filename: str, the file
+        variable: str, the variable, if any
+        route: str, how the request was answered, e.g. ``'chunks'``
+            (raw chunks read here), ``'netcdf'`` (read through
+            libnetcdf), ``'server'`` (an active storage server),
+            ``'cache'`` or ``'read'`` (data returned unreduced)
+        """
+        self.op = op
+        self.filename = filename
+        self.variable = variable
+        self.route = route
+        self.bytes_read = 0
+        self.bytes_decompressed = 0
+        self.bytes_returned = 0
+        self.elements = 0
+        self.timings = {}
+        self.start = time.time()
+        self.elapsed = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        """Add to the counters, e.g. ``add(bytes_read=4096)``."""
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + int(value))
+
+    def add_time(self, name, seconds):
+        """Add to the time spent in stage ``name``."""
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """Add the time spent in the context to stage ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    @property
+    def reduction_ratio(self):
+        """Bytes read per byte returned, None if nothing was returned."""
+        if not self.bytes_returned:
+            return None
+        return self.bytes_read / self.bytes_returned
+
+    def as_dict(self):
+        """Return the record as a JSON-able dict."""
+        record = {name: getattr(self, name) for name in
+                  ('op', 'filename', 'variable', 'route', 'start', 'elapsed')
+                  + COUNTERS}
+        record['reduction_ratio'] = self.reduction_ratio
+        record['timings'] = dict(self.timings)
+        if self.error is not None:
+            record['error'] = self.error
+        return record
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {self.op} {self.route} "
+                f"read={self.bytes_read} returned={self.bytes_returned}>")
+
+
+class _NullStats:
+    """Accepts counts and timings, and keeps none of them."""
+
+    def add(self, **counts):
+        pass
+
+    def add_time(self, name, seconds):
+        pass
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+
+#: Stand-in for a `RequestStats` when a request isn't being recorded
+NULL = _NullStats()
+
+
+class Collector:
+    """The `RequestStats` of the most recent requests."""
+
+    def __init__(self, max_requests=10000):
+        """
+        Parameters
+        ----------
+        max_requests: int, the number of requests to keep
+        """
+        self.requests = deque(maxlen=max_requests)
+        self._lock = threading.Lock()
+
+    def add(self, stats):
+        """Keep the record of a finished request."""
+        with self._lock:
+            self.requests.append(stats)
+
+    def reset(self):
+        """Forget every request."""
+        with self._lock:
+            self.requests.clear()
+
+    def summary(self, by='route'):
+        """
+        Return the totals of the kept requests, grouped by an attribute.
+
+        Parameters
+        ----------
+        by: str, the `RequestStats` attribute to group by, e.g.
+            ``'route'``, ``'op'`` or ``'filename'``
+
+        Returns
+        -------
+        dict mapping each group to its number of requests, counters,
+        time and timings, and overall reduction ratio
+        """
+        with self._lock:
+            requests = list(self.requests)
+
+        groups = {}
+        for stats in requests:
+            total = groups.setdefault(getattr(stats, by), dict(
+                {name: 0 for name in COUNTERS},
+                requests=0, elapsed=0., timings={}))
+            total['requests'] += 1
+            total['elapsed'] += stats.elapsed or 0.
+            for name in COUNTERS:
+                total[name] += getattr(stats, name)
+            for name, value in stats.timings.items():
+                total['timings'][name] = total['timings'].get(name, 0.) \
+                    + value
+
+        for total in groups.values():
+            total['reduction_ratio'] = (
+                total['bytes_read'] / total['bytes_returned']
+                if total['bytes_returned'] else None)
+        return groups
+
+
+_collector = Collector()
+
+
+def collector():
+    """Return the process-wide `Collector`."""
+    return _collector
+
+
+@contextmanager
+def record(op, filename, variable=None, route=None):
+    """
+    Record a request in the `collector` (and the log, if enabled).
+
+    Yields the `RequestStats` to count the request's work in.
+    """
+    stats = RequestStats(op, filename, variable, route)
+    start = time.perf_counter()
+    try:
+        yield stats
+    except BaseException as error:
+        stats.error = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        stats.elapsed = time.perf_counter() - start
+        _collector.add(stats)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(stats.as_dict(), default=str))
+
+
+def log_to(filename=None, stream=None):
+    """
+    Write a JSON line for every request to a file or stream.
+
+    Returns the `logging.Handler`, which can be removed from the
+    ``activestorage.stats`` logger to stop.
+    """
+    if filename is not None:
+        handler = logging.FileHandler(filename)
+    else:
+        handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return handler
@@ -0,0 +1,359 @@
+"""
+Read (and reduce) raw values from files that may live on active storage.
+
+The active path stands in for what an active storage appliance would
+do: read the bytes next to the disk and only ship back the reduction.
+Both paths share the vectorised engine in `activestorage.reductions`,
+so they agree to the last bit.
+"""
+import logging
+import os
+
+import numpy as np
+
+from activestorage import stats
+from activestorage.ranges import (
+    DEFAULT_GAP,
+    DEFAULT_MAX_SIZE,
+    coalesce,
+    read_into,
+    selection_rows,
+)
+from activestorage.reductions import reduce_array, reduce_bytes
+
+logger = logging.getLogger(__name__)
+
+#: Default on-disk type, a native 32 bit float (``struct`` format 'f')
+DEFAULT_DTYPE = np.dtype('f4')
+
+
+def raw_write(f, list_of_floats, dtype=DEFAULT_DTYPE):
+    """ Does what it says on the tin, assume f open for binary writing"""
+    f.write(np.asarray(list_of_floats, dtype=dtype).tobytes())
+
+
+def read_bytes(f, i, nbytes):
+    """Read exactly ``nbytes`` from open file f starting at byte <i>."""
+    f.seek(i, 0)
+    data = f.read(nbytes)
+    if len(data) != nbytes:
+        raise EOFError(f"Asked for {nbytes} bytes at byte {i} "
+                       f"but only {len(data)} could be read")
+    return data
+
+
+def standard_read(f, i, j, dtype=DEFAULT_DTYPE):
+    """
+    From open file f, read floats from byte position <i> to byte position <j>.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    n = j - i
+    assert n % itemsize == 0
+    data = read_bytes(f, i, n)
+    return np.frombuffer(data, dtype=dtype).tolist()
+
+
+def hyperslab(shape, start=None, count=None, stride=None):
+    """
+    Return the tuple of slices selecting a netCDF-style hyperslab.
+
+    Parameters
+    ----------
+    shape: sequence of int, shape of the whole (contiguous) array
+    start: sequence of int, first index along each dimension, 0 by default
+    count: sequence of int, number of elements selected along each
+        dimension, by default everything from ``start`` to the end
+    stride: sequence of int, step along each dimension, 1 by default
+
+    >>> hyperslab((10, 4), start=(1, 0), count=(3, 2), stride=(2, 3))
+    (slice(1, 6, 2), slice(0, 4, 3))
+    """
+    ndim = len(shape)
+    start = (0,) * ndim if start is None else tuple(start)
+    stride = (1,) * ndim if stride is None else tuple(stride)
+    if count is None:
+        count = tuple(-(-(n - s) // st)
+                      for n, s, st in zip(shape, start, stride))
+    if not len(start) == len(count) == len(stride) == ndim:
+        raise ValueError("start, count and stride must have one entry "
+                         f"per dimension of shape {tuple(shape)}")
+
+    slices = []
+    for n, s, c, st in zip(shape, start, count, stride):
+        if st < 1 or s < 0 or c < 0 or (c and s + (c - 1) * st >= n):
+            raise IndexError(f"Hyperslab start={s} count={c} stride={st} "
+                             f"is out of bounds for dimension size {n}")
+        slices.append(slice(s, s + (c - 1) * st + 1 if c else s, st))
+    return tuple(slices)
+
+
+def memmap_hyperslab(f, i, shape, start=None, count=None, stride=None,
+                     dtype=DEFAULT_DTYPE):
+    """
+    Return a view of a hyperslab of the C-ordered array at byte <i> of f.
+
+    The file is memory mapped, so elements are only paged in as the
+    view is reduced, and elements that are strided over are never
+    copied (whole pages are still read by the operating system).
+
+    Parameters
+    ----------
+    f: open binary file (or file name) holding the array
+    i: int, byte offset of the first element of the array
+    shape: sequence of int, shape of the whole contiguous array
+    start, count, stride: the selection, see `hyperslab`
+    dtype: numpy dtype of the array
+    """
+    slices = hyperslab(shape, start, count, stride)
+    mapped = np.memmap(f, dtype=dtype, mode='r', offset=i,
+                       shape=tuple(shape))
+    return np.asarray(mapped[slices])
+
+
+def read_hyperslab(f, i, shape, start=None, count=None, stride=None,
+                   dtype=DEFAULT_DTYPE, gap=DEFAULT_GAP,
+                   max_size=DEFAULT_MAX_SIZE, request=stats.NULL):
+    """
+    Read a hyperslab of the C-ordered array at byte <i> of f.
+
+    Each row of the hyperslab (the span of the array along its last
+    dimension from the first to the last selected element) is a byte
+    range of the file. The ranges are merged where they are less than
+    <gap> bytes apart, into reads of at most <max_size> bytes (see
+    `activestorage.ranges.coalesce`), so a hyperslab of thousands of
+    rows takes a few reads rather than a seek and a read per row.
+
+    Merged ranges without holes are read straight into the result, as
+    are the rows of others with ``os.preadv`` where they are few
+    enough, and the holes are read into scratch space. Otherwise, or
+    when the last dimension is strided, the merged range is read into
+    a buffer and the selected elements are copied out of strided views
+    of it, so at most <max_size> bytes are read beyond the result.
+    Rows longer than that with a stride are memory mapped (see
+    `memmap_hyperslab`).
+
+    Parameters
+    ----------
+    f: open binary file holding the array
+    i: int, byte offset of the first element of the array
+    shape: sequence of int, shape of the whole contiguous array
+    start, count, stride: the selection, see `hyperslab`
+    dtype: numpy dtype of the array
+    gap, max_size: int, see `activestorage.ranges.coalesce`
+    request: `activestorage.stats.RequestStats`, where the bytes read
+        (including those between the rows) and read time are counted
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryFile() as f:
+    ...     raw_write(f, range(20))
+    ...     f.flush()
+    ...     read_hyperslab(f, 0, (4, 5), start=(1, 1), stride=(2, 2))
+    array([[ 6.,  8.],
+           [16., 18.]], dtype=float32)
+    """
+    dtype = np.dtype(dtype)
+    itemsize = dtype.itemsize
+    slices = hyperslab(shape, start, count, stride)
+    selected = np.empty([len(range(s.start, s.stop, s.step))
+                         for s in slices], dtype=dtype)
+    if not selected.size:
+        return selected
+
+    # each row spans the last dimension from its first selected element
+    # to its last, of which every step-th is selected
+    last = slices[-1]
+    step = last.step
+    rows, span = selection_rows(
+        i, shape, slices[:-1] + (slice(last.start, last.stop, 1),), itemsize)
+    row_bytes = span * itemsize
+    starts, stops, group = coalesce(rows, np.full(rows.size, row_bytes), gap,
+                                    max_size)
+    # the rows are in file order, so each merged range is a run of rows
+    bounds = np.append(np.searchsorted(group, np.arange(starts.size)),
+                       rows.size).tolist()
+
+    fd = f.fileno()
+    out = memoryview(selected.reshape(-1)).cast('B')
+    grid = selected.reshape(-1, selected.shape[-1])
+    outer = selected.shape[:-1]
+    # the byte steps between selected rows along each outer dimension
+    strides = np.cumprod((1,) + tuple(shape[:0:-1]))[::-1] * itemsize
+    outer_strides = tuple(int(n) * s.step
+                          for n, s in zip(strides[:-1], slices[:-1]))
+    scratch = None
+    iov_max = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 0
+    with request.stage('read'):
+        for lo, hi, begin, end in zip(bounds[:-1], bounds[1:],
+                                      starts.tolist(), stops.tolist()):
+            if step == 1 and end - begin == (hi - lo) * row_bytes:
+                # the rows touch, so are read in place
+                read_into(fd, out[lo * row_bytes:hi * row_bytes], begin)
+                continue
+
+            if step == 1 and hasattr(os, 'preadv') \
+                    and 2 * (hi - lo) <= iov_max:
+                # scatter the rows into place, and the holes into scratch
+                if scratch is None:
+                    scratch = memoryview(bytearray(gap))
+                buffers = []
+                position = begin
+                for row, offset in zip(range(lo, hi), rows[lo:hi].tolist()):
+                    if offset > position:
+                        buffers.append(scratch[:offset - position])
+                    buffers.append(out[row * row_bytes:(row + 1) * row_bytes])
+                    position = offset + row_bytes
+                if os.preadv(fd, buffers, begin) == end - begin:
+                    continue
+
+            if end - begin > max_size:
+                # one strided row, too long to buffer
+                grid[lo] = memmap_hyperslab(f, begin, (span,),
+                                            stride=(step,), dtype=dtype)
+                continue
+
+            buffer = np.empty(end - begin, dtype=np.uint8)
+            read_into(fd, buffer, begin)
+            for first, block in _blocks(lo, hi, outer):
+                offset = int(rows[np.ravel_multi_index(first, outer)
+                                  if outer else 0]) - begin
+                view = np.lib.stride_tricks.as_strided(
+                    buffer[offset:].view(dtype),
+                    shape=block + selected.shape[-1:],
+                    strides=outer_strides + (step * itemsize,),
+                    writeable=False)
+                selected[tuple(slice(j, j + n) for j, n in zip(first, block))
+                         ] = view
+    request.add(bytes_read=int(np.sum(stops - starts)))
+    return selected
+
+
+def _blocks(lo, hi, shape):
+    """
+    Split the C-ordered positions ``lo`` to ``hi`` of a grid into blocks.
+
+    Yields the first index and the shape of each block, at most two
+    for each dimension, in order.
+
+    >>> list(_blocks(3, 11, (3, 4)))
+    [((0, 3), (1, 1)), ((1, 0), (1, 4)), ((2, 0), (1, 3))]
+    """
+    if lo >= hi:
+        return
+    if not shape:
+        yield (), ()
+        return
+    inner = int(np.prod(shape[1:], dtype=np.int64))
+    # the whole positions of the first dimension, if any
+    first, stop = -(-lo // inner), hi // inner
+    if first < stop:
+        yield from _blocks(lo, first * inner, shape)
+        yield (first,) + (0,) * (len(shape) - 1), \
+            (stop - first,) + tuple(shape[1:])
+        yield from _blocks(stop * inner, hi, shape)
+        return
+
+    j = lo // inner
+    if (hi - 1) // inner > j:
+        # the end of one position and the start of the next
+        yield from _blocks(lo, (j + 1) * inner, shape)
+        yield from _blocks((j + 1) * inner, hi, shape)
+        return
+    for index, block in _blocks(lo - j * inner, hi - j * inner, shape[1:]):
+        yield (j,) + index, (1,) + block
+
+
+def _selection(f, i, n, dtype, shape, start, count, stride, request):
+    """Return the elements to reduce, as bytes or an array."""
+    if shape is None:
+        nbytes = n * np.dtype(dtype).itemsize
+        with request.stage('read'):
+            data = read_bytes(f, i, nbytes)
+        request.add(bytes_read=nbytes)
+        return data
+
+    data = read_hyperslab(f, i, shape, start, count, stride, dtype,
+                          request=request)
+    if n is not None and n != data.size:
+        raise ValueError(f"Hyperslab selects {data.size} elements, not {n}")
+    return data
+
+
+def _reduce(data, dtype, op, missing):
+    """Reduce bytes or an already viewed array."""
+    if isinstance(data, np.ndarray):
+        return reduce_array(data, op, missing=missing)
+    return reduce_bytes(data, dtype, op, missing=missing)
+
+
+def mock_active_read_operation(f, i, n, op='mean', dtype=DEFAULT_DTYPE,
+                               shape=None, start=None, count=None,
+                               stride=None, missing=None,
+                               request=stats.NULL):
+    """
+    Return <op> applied to <n> floats starting at the <i>th byte of file <f>
+
+    If <shape> is given the floats are the hyperslab described by
+    <start>, <count> and <stride> of the contiguous array of that shape
+    starting at byte <i> (see `read_hyperslab`), and <n> may be None.
+    Values that are <missing> (a `MissingValues`) are ignored. The
+    bytes read are counted in <request>.
+    """
+    data = _selection(f, i, n, dtype, shape, start, count, stride, request)
+    logger.debug("Mocking active %s", op)
+    return _reduce(data, dtype, op, missing)
+
+
+def do_operation(f, i, n, op, dtype=DEFAULT_DTYPE, shape=None, start=None,
+                 count=None, stride=None, missing=None):
+    """
+    do an operation on f, and if f is on active storage,
+    which needs to be an attribute of f, then use active
+    read operations, otherwise do ordinary operations.
+
+    Pass <shape> (and optionally <start>, <count>, <stride>) to operate
+    on a strided hyperslab instead of <n> contiguous values, and
+    <missing> (a `MissingValues`) to ignore missing data.
+
+    If f also has an ``active_client`` attribute (an
+    `activestorage.client.ActiveStorageClient`) then the operation is
+    sent to that active storage server, otherwise it is mocked.
+    """
+    if shape is None:
+        elements = n
+    else:
+        elements = int(np.prod([len(range(s.start, s.stop, s.step)) for s in
+                                hyperslab(shape, start, count, stride)]))
+    nbytes = elements * np.dtype(dtype).itemsize
+
+    client = getattr(f, 'active_client', None)
+    if f.is_active and client is not None:
+        route = 'server'
+    else:
+        route = 'mock' if f.is_active else 'local'
+
+    with stats.record(op, getattr(f, 'name', None), route=route) as request:
+        if route == 'server':
+            path = os.path.abspath(f.name)
+            if shape is None:
+                result = client.reduce_range(path, i, nbytes, dtype, op,
+                                             missing=missing, stats=request)
+            else:
+                result = client.reduce_hyperslab(
+                    path, i, shape, dtype, op, start=start, count=count,
+                    stride=stride, missing=missing, stats=request)
+        elif route == 'mock':
+            result = mock_active_read_operation(f, i, n, op, dtype=dtype,
+                                                shape=shape, start=start,
+                                                count=count, stride=stride,
+                                                missing=missing,
+                                                request=request)
+            request.add(bytes_returned=np.asarray(result).nbytes)
+        else:
+            # everything is shipped back to be reduced here
+            data = _selection(f, i, n, dtype, shape, start, count, stride,
+                              request)
+            with request.stage('reduce'):
+                result = _reduce(data, dtype, op, missing)
+            request.add(bytes_returned=nbytes)
+        request.add(bytes_decompressed=nbytes, elements=elements)
+    return result
@@ -0,0 +1,403 @@
+"""
+Read and reduce a netCDF variable in slabs that fit a memory budget.
+
+Rather than reading a whole variable (``variables['tas'][:]``), a
+`SlabReader` reads a subspace one slab at a time along its leading
+axis (usually time), with each slab made of whole storage chunks
+where the budget allows:
+
+>>> reader = SlabReader('thetao.nc', 'thetao',
+...                     max_memory=2 * 2**30)  # doctest: +SKIP
+>>> for index, slab in reader:  # doctest: +SKIP
+...     plot(slab)
+>>> reader.reduce('mean', axis=(1, 2, 3))  # doctest: +SKIP
+
+The next slab is read in a background thread while the current one is
+used, so at most two slabs are held at once; both fit in
+``max_memory``. Reductions (`SlabReader.partial`, `SlabReader.reduce`)
+merge the partial result of each slab into a running partial result
+(see `activestorage.reductions`), so every operation, weighted or not,
+is fed incrementally and the answer is the same as for the whole
+variable at once. Their slabs are sized for the operation: the running
+partial result and the temporary memory of the reduction, which each
+slab is reduced in blocks to bound, fit in ``max_memory`` too.
+"""
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from activestorage import stats
+from activestorage.chunks import orthogonal_index
+from activestorage.handles import dataset_pool, find_variable, netcdf_lock
+from activestorage.plan import (
+    index_size,
+    normalise_indices,
+    subspace_dimensions,
+)
+from activestorage.reductions import (
+    check_operation,
+    empty_partial,
+    finalise,
+    merge_into,
+    normalise_axis,
+    partial_reduce,
+    weighted_dtype,
+    working_set,
+)
+
+logger = logging.getLogger(__name__)
+
+#: The default memory budget of a `SlabReader`, in bytes
+DEFAULT_MEMORY = 256 * 2**20
+
+#: The number of slabs held at once
+BUFFERS = 2
+
+#: The fewest bytes that the reduction of a block of a slab may take
+MIN_BLOCK = 64 * 2**10
+
+
+def _blocks(shape, axis, limit, per_value, per_element):
+    """
+    Split an array into blocks whose reduction fits in ``limit`` bytes.
+
+    The reduction over ``axis`` of a block takes ``per_value`` bytes
+    per value and ``per_element`` per element of its partial result
+    (see `activestorage.reductions.working_set`). Blocks are at least
+    one value.
+
+    Yields the index of each block, a tuple of slices, in C order.
+    """
+    # splitting the kept axes shrinks the partial results too, and
+    # splitting the reduced axes means more merges, so they come last
+    block = list(shape)
+    for i in sorted(range(len(shape)), key=lambda i: i in axis):
+        values = int(np.prod(block))
+        elements = int(np.prod([b for j, b in enumerate(block)
+                                if j not in axis]))
+        if values * per_value + elements * per_element <= limit:
+            break
+        # the values and partial result elements of one step along i
+        n = shape[i]
+        values //= n
+        if i in axis:
+            step = (limit - elements * per_element) // (values * per_value)
+        else:
+            elements //= n
+            step = limit // (values * per_value + elements * per_element)
+        block[i] = int(min(n, max(1, step)))
+        if step >= 1:
+            break
+
+    for start in itertools.product(*[range(0, n, b)
+                                     for n, b in zip(shape, block)]):
+        yield tuple(slice(s, min(s + b, n))
+                    for s, b, n in zip(start, block, shape))
+
+
+class SlabReader:
+    """
+    A subspace of a netCDF variable, read in slabs along its leading axis.
+
+    The leading axis is the first dimension of the subspace (that isn't
+    dropped by an integer index).
+    """
+
+    def __init__(self, filename, ncvar, indices=Ellipsis, group=None,
+                 mask=True, max_memory=DEFAULT_MEMORY):
+        """
+        Parameters
+        ----------
+        filename: str, the netCDF file
+        ncvar: str, the netCDF variable
+        indices: the subspace, by default the whole variable
+        group: sequence of str, the variable's group, as for
+            `NetCDFArray`
+        mask: bool, whether missing data are masked (or ignored, by
+            reductions)
+        max_memory: int, the bytes that the slabs being read and used
+            may take between them, with the partial result and the
+            temporary memory of a reduction. A slab is at least one
+            element of the leading axis thick, whatever the budget.
+        """
+        self.filename = filename
+        self.ncvar = ncvar
+        self.group = group
+        self.mask = mask
+        self.max_memory = max_memory
+
+        metadata = dataset_pool().metadata(filename, ncvar, group)
+        self.metadata = metadata
+        self.indices = normalise_indices(indices, metadata.shape)
+        self.shape = tuple(index_size(index) for index in self.indices
+                           if not isinstance(index, int))
+        if not self.shape:
+            raise ValueError("Can't stream a single element")
+        self.dimensions = subspace_dimensions(metadata.dimensions,
+                                              self.indices)
+        #: The dimension of the variable that slabs are taken along
+        self.dim = next(i for i, index in enumerate(self.indices)
+                        if not isinstance(index, int))
+
+        # unpacked data are floats, and masks take a byte per element
+        itemsize = 8 if metadata.packed else metadata.dtype.itemsize
+        row = int(np.prod(self.shape[1:])) * (itemsize + bool(mask))
+        rows = max(1, max_memory // (BUFFERS * max(row, 1)))
+        if rows * row * BUFFERS > max_memory:
+            logger.warning("A slab of %s %s is %d bytes, more than half "
+                           "the memory budget of %d bytes", filename, ncvar,
+                           row, max_memory)
+        self.slabs = self._slabs(rows)
+
+    def _slabs(self, rows):
+        """
+        Split the leading axis into slabs of at most ``rows``.
+
+        Slabs end at storage chunk boundaries where they can, so that
+        no chunk is read (and decompressed) twice.
+
+        Returns a list of ``(start, stop)`` positions along the leading
+        axis of the subspace.
+        """
+        index = self.indices[self.dim]
+        if isinstance(index, slice):
+            positions = np.arange(index.start, index.stop, index.step)
+        else:
+            positions = index
+        chunks = positions // self.metadata.chunk_shape[self.dim]
+
+        # runs of positions in the same storage chunk
+        breaks = np.flatnonzero(np.diff(chunks)) + 1
+        runs = zip(np.concatenate([[0], breaks]),
+                   np.concatenate([breaks, [len(positions)]]))
+
+        slabs = []
+        start = stop = 0
+        for run_start, run_stop in runs:
+            run_start, run_stop = int(run_start), int(run_stop)
+            if run_stop - start > rows and stop > start:
+                slabs.append((start, stop))
+                start = stop
+            # a run longer than a slab is split
+            while run_stop - start > rows:
+                slabs.append((start, start + rows))
+                start += rows
+            stop = run_stop
+        if stop > start:
+            slabs.append((start, stop))
+        return slabs
+
+    def __len__(self):
+        return len(self.slabs)
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {self.ncvar} {self.shape} "
+                f"in {len(self)} slabs>")
+
+    def _slab_indices(self, start, stop):
+        """The variable's indices of one slab."""
+        index = self.indices[self.dim]
+        if isinstance(index, slice):
+            index = slice(index.start + start * index.step,
+                          index.start + stop * index.step, index.step)
+        else:
+            index = index[start:stop]
+        return self.indices[:self.dim] + (index,) + self.indices[self.dim + 1:]
+
+    def _read(self, start, stop, decode):
+        with dataset_pool().dataset(self.filename) as netcdf, netcdf_lock:
+            variable = find_variable(netcdf, self.ncvar, self.group)
+            # the handle is shared, so set both flags every time
+            if decode:
+                variable.set_auto_mask(self.mask)
+                variable.set_auto_scale(True)
+            else:
+                variable.set_auto_maskandscale(False)
+            return variable[self._slab_indices(start, stop)]
+
+    def _stream(self, decode, slabs=None):
+        """
+        Yield ``(start, stop, data)`` for each slab, reading ahead.
+
+        If ``decode`` is False the slabs are the stored values, neither
+        masked nor unpacked. ``slabs`` are ``(start, stop)`` positions
+        along the leading axis, by default `slabs`.
+
+        A thread reads the next slab while the current one is used;
+        it waits for a slab to be given up before reading another, so
+        at most `BUFFERS` are held at once.
+        """
+        positions = self.slabs if slabs is None else slabs
+        slabs = queue.Queue()
+        free = threading.Semaphore(BUFFERS)
+        done = threading.Event()
+
+        def read():
+            try:
+                for start, stop in positions:
+                    free.acquire()
+                    if done.is_set():
+                        return
+                    slabs.put((start, stop,
+                               self._read(start, stop, decode)))
+            except BaseException as error:
+                slabs.put(error)
+
+        reader = threading.Thread(target=read, daemon=True,
+                                  name="activestorage-slab-reader")
+        reader.start()
+        try:
+            for _ in positions:
+                slab = slabs.get()
+                if isinstance(slab, BaseException):
+                    raise slab
+                yield slab
+                del slab
+                free.release()
+        finally:
+            done.set()
+            free.release()
+            reader.join()
+
+    def __iter__(self):
+        """
+        Yield ``(index, data)`` for each slab.
+
+        ``index`` is the slab's part of the subspace, so the slabs can
+        be put together with ``result[index] = data``.
+        """
+        slabs = self._stream(True)
+        try:
+            for start, stop, data in slabs:
+                yield (slice(start, stop),), data
+        finally:
+            slabs.close()
+
+    def partial(self, op, axis=None, weights=None):
+        """
+        Return the partial result of a reduction of the subspace.
+
+        Parameters
+        ----------
+        op: str, one of ``activestorage.reductions.OPERATIONS``
+        axis: int, tuple of int or None (all axes), the axes of the
+            subspace to reduce, by position or dimension name
+        weights: numpy array that broadcasts against the whole
+            variable, as for ``NetCDFArray.active_weights``
+
+        Returns
+        -------
+        dict, as returned by `activestorage.reductions.partial_reduce`
+        """
+        check_operation(op)
+        axis = normalise_axis(axis, len(self.shape), self.dimensions)
+        shape = tuple(1 if i in axis else n for i, n in enumerate(self.shape))
+        metadata = self.metadata
+        if weights is not None:
+            weights = np.broadcast_to(np.ma.filled(weights, 0),
+                                      metadata.shape)
+
+        # As for NetCDFArray, missing data are found inside the
+        # reduction kernel, and packed data are reduced as stored
+        missing = metadata.missing if self.mask else None
+        packing = metadata.packing
+        stored = op if packing is None else packing.packed_operation(op)
+        partial = empty_partial(
+            stored, shape, weighted_dtype(metadata.dtype, weights),
+            weighted=weights is not None)
+        slabs, limit = self._budget(stored, axis, weights, partial)
+        per_value, per_element = working_set(stored, weights is not None)
+        with stats.record(op, self.filename, self.ncvar,
+                          route="stream") as request:
+            slabs = self._stream(False, slabs)
+            try:
+                waiting = time.perf_counter()
+                for start, stop, data in slabs:
+                    # only the first slab isn't read ahead
+                    request.add_time("read", time.perf_counter() - waiting)
+                    slab_weights = None
+                    if weights is not None:
+                        slab_weights = orthogonal_index(
+                            weights, self._slab_indices(start, stop))
+                    with request.stage("reduce"):
+                        for block in _blocks(data.shape, axis, limit,
+                                             per_value, per_element):
+                            block_weights = None
+                            if slab_weights is not None:
+                                block_weights = slab_weights[block]
+                            index = tuple(
+                                slice(None) if i in axis
+                                else slice(b.start + start, b.stop + start)
+                                if i == 0 else b
+                                for i, b in enumerate(block))
+                            merge_into(partial,
+                                       partial_reduce(data[block], stored,
+                                                      axis, missing=missing,
+                                                      weights=block_weights),
+                                       stored, index)
+                    request.add(bytes_read=data.nbytes,
+                                bytes_decompressed=data.nbytes,
+                                elements=data.size)
+                    del data, slab_weights
+                    waiting = time.perf_counter()
+            finally:
+                slabs.close()
+            if packing is not None:
+                partial = packing.unpack_partial(partial, op)
+            request.add(bytes_returned=sum(
+                values.nbytes for values in partial.values()))
+        return partial
+
+    def _budget(self, op, axis, weights, partial):
+        """
+        Share the memory budget out for a reduction.
+
+        The running partial result comes first. What is left is shared
+        between the slabs being read and used (with their weights) and
+        the reduction of one block of a slab, whose
+        temporary memory is bounded by `working_set`; a block may take
+        `MIN_BLOCK` bytes, whatever the budget.
+
+        Returns
+        -------
+        The slabs, as for `_slabs`, and the bytes that the reduction of
+        a block may take
+        """
+        available = self.max_memory - sum(
+            values.nbytes for values in partial.values())
+        if available <= 0:
+            logger.warning("The partial result of %s over %s %s is more "
+                           "than the memory budget of %d bytes", op,
+                           self.filename, self.ncvar, self.max_memory)
+        limit = max(MIN_BLOCK, available // (BUFFERS + 1))
+        # netCDF4 copies what it reads, so a slab being read takes
+        # twice its size
+        values = int(np.prod(self.shape[1:]))
+        row = values * (BUFFERS + 1) * self.metadata.dtype.itemsize
+        if weights is not None:
+            row += values * weights.dtype.itemsize
+        rows = max(1, (available - limit) // max(row, 1))
+        return self._slabs(rows), limit
+
+    def reduce(self, op, axis=None, weights=None):
+        """
+        Return a reduction of the subspace.
+
+        Parameters are as for `partial`.
+
+        Returns
+        -------
+        numpy array (masked where there were no valid data), or a
+        scalar if every axis is reduced
+        """
+        result = finalise(self.partial(op, axis, weights), op)
+        axis = normalise_axis(axis, len(self.shape), self.dimensions)
+        result = result.reshape([n for i, n in enumerate(result.shape)
+                                 if i not in axis])
+        if not result.ndim:
+            return result[()]
+        return result
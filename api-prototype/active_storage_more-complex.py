@@ -8,6 +8,8 @@ import os
 import dask.array as da
 from S3netCDF4._s3netCDF4 import s3Dataset as Dataset
 
+from activestorage.active import load as active_load
+
 
 # file specifier
 root = "/home/valeriu/climate_data/cmip5/output1"
@@ -23,28 +25,24 @@ def load_storage_data(filepath, var):
     return my_data
 
 
-def get_local_operation(filepath, var, operation, mask=False):
+def get_local_operation(filepath, var, operation, mask=False,
+                        axis=("lat", "lon")):
     """
     Simulate computations INSIDE active storage.
 
-    This is a toy and doesn't necessarily refelect
-    what's the hap there, inside the Black Box.
+    The reduction over ``axis`` (by default one value per time step)
+    is done by vectorised kernels over whole storage chunks, whose
+    partial results are merged into one reduced array, rather than by
+    one ``max`` per time step.
     """
-    data = load_storage_data(filepath, var)
+    weights = None
     if mask:
-        if isinstance(mask, str):  # eg areacello
-            mask = load_storage_data(maskpath, mask)  # mask IS the var
-        elif isinstance(mask, S3netCDF4._s3netCDF4.s3Dataset):
-            mask = mask
-
-    chunks = data.chunks
-    if operation == "max":
-        op_result = [
-            data[i, :, :].max() - mask[i, :, :]
-            for i in range(sum(chunks[0]))
-        ]
-
-    return op_result
+        # eg areacello: the mask IS the var, and masked points have
+        # no weight
+        weights = (maskpath, mask) if isinstance(mask, str) else mask
+
+    return active_load(filepath, var, operation, axis=axis,
+                       weights=weights)
 
 
 def datastore(filepath, var, internal_mask=False, external_mask=None):
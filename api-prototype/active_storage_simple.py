@@ -4,6 +4,8 @@ Minimal code that illustrates the active storage principle in API.
 import os
 from S3netCDF4._s3netCDF4 import s3Dataset as Dataset
 
+from activestorage.active import load as active_load
+
 
 # file specifier
 root = "/home/valeriu/climate_data/cmip5/output1"
@@ -22,20 +24,17 @@ def load_storage_data(filepath, var, slices):
         return ValueError('Slices must be either ":" or a two member list.')
 
 
-def active_storage_operation(filepath, var, operation, slices):
+def active_storage_operation(filepath, var, operation, slices, axis=None):
     """
     Simulate computations INSIDE active storage.
 
-    This is a toy and doesn't necessarily refelect
-    what's the hap there, inside the Black Box.
+    ``axis`` (positions or dimension names) is reduced, all axes by
+    default: e.g. ``axis="time"`` for a time mean field or
+    ``axis="lon"`` for a zonal (time, lat) maximum.
     """
-    data = load_storage_data(filepath, var, slices)
-    if operation == "max":
-        op_result = data.max()
-    if operation == "min":
-        op_result = data.min()  # and so on ...
-
-    return op_result
+    indices = slice(None) if slices == ":" else slice(*slices)
+    return active_load(filepath, var, operation, indices=indices,
+                       axis=axis)
 
 
 def load(filepath, var, slices, active=False, operation=None):
@@ -2,71 +2,19 @@
 # Boiler plate code for playing with active storage reads
 
 import pathlib
-import struct
 import tempfile
 import unittest
 # from array import array
 
-# FIXME: Add striding examples. We might want to consider
-# using numpy mmap at that point.
-# FIXME: Add example with missing data
-# FIXME: Add other datatypes than 32 bit floats
-# FIXME: Add other operations (full set = sum, mean, count, min, max)
-# FIXME: Make sure that the byte representation is consistent with
-# netcdf byte representations
-# nd/or think about what we need to tell active storage about float format.
+from activestorage.storage import (
+    do_operation,
+    raw_write,
+    standard_read,
+)
 
-
-def raw_write(f, list_of_floats):
-    """ Does what it says on the tin, assume f open for binary writing"""
-    data = struct.pack('f' * len(list_of_floats), *list_of_floats)
-    f.write(data)
-
-
-def standard_read(f, i, j):
-    """
-    From open file f, read floats from byte position <i> to byte position <j>.
-    """
-    f.seek(i, 0)
-    n = j - i
-    assert n % 4 == 0
-    nn = int(n / 4)
-    bytes = f.read(n)
-    floats = struct.unpack('f' * nn, bytes)
-    return list(floats)
-
-
-def mock_active_read_operation(f, i, n, op='mean'):
-    """
-    Return <op> applied to <n> floats starting at the <i>th byte of file <f>
-    """
-    f.seek(i, 0)
-    nbytes = n * 4
-    bytes = f.read(nbytes)
-    floats = struct.unpack('f' * n, bytes)
-    print('Mocking active ', op)
-    if 'mean':
-        return sum(floats) / n
-    else:
-        raise NotImplementedError
-
-
-def do_operation(f, i, n, op):
-    """
-    do an operation on f, and if f is on active storage,
-    which needs to be an attribute of f, then use active
-    read operations, otherwise do ordinary operations.
-    """
-    if f.is_active:
-        return mock_active_read_operation(f, i, n, op)
-    else:
-        j = i + 4 * n
-        floats = standard_read(f, i, j)
-        if op == 'mean':
-            mean = sum(floats) / n
-            return mean
-        else:
-            raise NotImplementedError
+# The on-disk representation is given by a numpy dtype, byte order
+# included: netCDF classic files are big-endian ('>f4'), netCDF4 files
+# are usually native. See activestorage.decoding for packed data.
 
 
 class TestActive(unittest.TestCase):
@@ -91,6 +39,17 @@ class TestActive(unittest.TestCase):
             inputdata = standard_read(f, 0, 48)
         self.assertEqual(self.data, inputdata)
 
+    def test_big_endian(self):
+        """ Big-endian data (as in netCDF classic files) read the same"""
+        bigfile = self.dummydir / 'big.data'
+        with open(bigfile, 'wb') as f:
+            raw_write(f, self.data, dtype='>f4')
+        with open(bigfile, 'rb') as f:
+            self.assertEqual(self.data, standard_read(f, 0, 48, dtype='>f4'))
+            f.is_active = True
+            self.assertEqual(do_operation(f, 8, 4, 'max', dtype='>f4'),
+                             max(self.data[2:6]))
+
     def test_compare_active(self):
         """
         Test we get the same result with normal active and mocked active.
@@ -0,0 +1,76 @@
+"""
+Scaling of the parallel chunk decompression pipeline with threads.
+
+Run as a script, e.g.::
+
+    python benchmarks/bench_decompression.py --shape 120 180 360
+
+It writes a deflate + shuffle compressed netCDF4 file, then reports
+the time for a full ``max`` over it through libnetcdf (serially) and
+through `activestorage.chunks.reduce_chunks` with increasing numbers of
+threads.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import netCDF4
+import numpy as np
+
+from activestorage.chunks import StorageLayout, reduce_chunks
+from activestorage.plan import ChunkPlan
+
+
+def write_file(filename, shape, chunks):
+    """Write a compressed float32 variable 'tas' of the given shape."""
+    with netCDF4.Dataset(filename, 'w') as ds:
+        dims = [f'd{i}' for i in range(len(shape))]
+        for dim, size in zip(dims, shape):
+            ds.createDimension(dim, size)
+        var = ds.createVariable('tas', 'f4', dims, zlib=True, shuffle=True,
+                                chunksizes=chunks)
+        rng = np.random.default_rng(0)
+        for i in range(shape[0]):
+            var[i] = 250 + 50 * rng.random(shape[1:], dtype='f4')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shape', type=int, nargs=3, default=[60, 180, 360])
+    parser.add_argument('--chunks', type=int, nargs=3, default=[1, 180, 360])
+    parser.add_argument('--max-threads', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.nc')
+        write_file(filename, args.shape, args.chunks)
+        nbytes = 4 * int(np.prod(args.shape))
+        print(f"{nbytes / 1e6:.1f} MB uncompressed, "
+              f"{os.path.getsize(filename) / 1e6:.1f} MB on disk")
+
+        start = time.perf_counter()
+        with netCDF4.Dataset(filename) as ds:
+            ds.variables['tas'].set_auto_mask(False)
+            ds.variables['tas'][...].max()
+        elapsed = time.perf_counter() - start
+        print(f"  netCDF4         : {elapsed:7.3f} s "
+              f"{nbytes / elapsed / 1e9:6.2f} GB/s")
+
+        layout = StorageLayout.from_file(filename, 'tas')
+        with netCDF4.Dataset(filename) as ds:
+            plan = ChunkPlan.from_variable(ds.variables['tas'])
+        layout.attach(plan)
+        threads = 1
+        while threads <= args.max_threads:
+            start = time.perf_counter()
+            reduce_chunks(filename, layout, plan, 'max', (0, 1, 2),
+                          max_workers=threads)
+            elapsed = time.perf_counter() - start
+            print(f"  {threads:3d} thread(s)   : {elapsed:7.3f} s "
+                  f"{nbytes / elapsed / 1e9:6.2f} GB/s")
+            threads *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Throughput of the vectorised reduction engine against struct unpacking.
+
+Run as a script, e.g.::
+
+    python benchmarks/bench_reductions.py --size-mb 256 --dtype f4
+
+and it prints the throughput in GB/s of every operation over an
+in-memory slab of the requested size, alongside the original
+``struct.unpack`` + builtin ``sum`` implementation for reference.
+"""
+import argparse
+import struct
+import time
+
+import numpy as np
+
+from activestorage.reductions import OPERATIONS, reduce_bytes
+
+
+def struct_mean(buffer, n):
+    """The original prototype: unpack to a tuple and use builtin sum."""
+    floats = struct.unpack('f' * n, buffer)
+    return sum(floats) / n
+
+
+def throughput(func, nbytes, repeat=3):
+    """Return the best throughput of ``func()`` in GB/s."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return nbytes / best / 1e9
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size-mb', type=float, default=64.)
+    parser.add_argument('--dtype', default='f4')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-struct', action='store_true',
+                        help="don't time the (slow) struct baseline")
+    args = parser.parse_args(argv)
+
+    dtype = np.dtype(args.dtype)
+    n = int(args.size_mb * 1e6) // dtype.itemsize
+    buffer = np.random.default_rng(0).random(n).astype(dtype).tobytes()
+    nbytes = len(buffer)
+    print(f"{nbytes / 1e6:.1f} MB of {dtype}")
+
+    for op in OPERATIONS:
+        rate = throughput(lambda: reduce_bytes(buffer, dtype, op), nbytes,
+                          args.repeat)
+        print(f"  numpy  {op:>5}: {rate:8.3f} GB/s")
+
+    if not args.skip_struct and dtype == np.dtype('f4'):
+        rate = throughput(lambda: struct_mean(buffer, n), nbytes, 1)
+        print(f"  struct  mean: {rate:8.3f} GB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Cost of an active storage round trip against a local read.
+
+Run as a script, e.g.::
+
+    python benchmarks/bench_server.py --size-mb 1 16 256
+
+It starts a local `activestorage.server.ActiveStorageServer` and, for
+each size, reports the time of a local read and reduction alongside
+the round trip to the server, the bytes that crossed the wire and the
+server's CPU time.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from activestorage.client import ActiveStorageClient
+from activestorage.server import ActiveStorageServer
+from activestorage.storage import do_operation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size-mb', type=float, nargs='+',
+                        default=[0.001, 1., 64.])
+    parser.add_argument('--op', default='mean')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.data')
+        n = int(max(args.size_mb) * 1e6) // 4
+        np.random.default_rng(0).random(n, dtype='f4').tofile(filename)
+
+        server = ActiveStorageServer(root=tmp)
+        server.start()
+        client = ActiveStorageClient(server.url)
+        print(f"{'MB':>9} {'local s':>9} {'active s':>9} {'wire B':>8} "
+              f"{'server CPU s':>12}")
+        try:
+            for size in args.size_mb:
+                count = int(size * 1e6) // 4
+                with open(filename, 'rb') as f:
+                    f.is_active = False
+                    start = time.perf_counter()
+                    do_operation(f, 0, count, args.op)
+                    local = time.perf_counter() - start
+
+                    f.is_active = True
+                    f.active_client = client
+                    start = time.perf_counter()
+                    do_operation(f, 0, count, args.op)
+                    active = time.perf_counter() - start
+
+                stats = client.last_stats
+                wire = stats['bytes_sent'] + stats['bytes_received']
+                print(f"{size:9.3f} {local:9.5f} {active:9.5f} {wire:8d} "
+                      f"{stats['server_cpu_time']:12.5f}")
+        finally:
+            client.close()
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Benchmark suite of active against local reductions.
+
+Run as a script, e.g.::
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --shape 120 180 360 --chunks 1 180 360 \\
+        --dtype f4 f8 --missing 0 0.1 --output results.json
+    python benchmarks/suite.py --compare old.json results.json
+
+For every combination of variable shape, chunk shape, compression,
+dtype and missing-value fraction it writes a synthetic netCDF4 file,
+then runs every reduction operation through the active path
+(``activestorage.active.load``) and the local path
+(``load(..., active=False)``, which reads the whole subspace and
+reduces it here). Each run is made in a fresh process, and records
+
+``wall_time``
+    seconds taken by ``load``
+``bytes_read``
+    bytes read from storage, as counted by the requests recorded in
+    ``activestorage.stats.collector()`` (including the pages of
+    memory-mapped files that are reduced)
+``bytes_returned``
+    bytes delivered to the caller of the storage: the partial result
+    for the active path, the whole subspace for the local path
+``peak_rss``
+    peak resident set size of the process, in bytes
+
+Results are written as JSON, with the git commit and library versions,
+so that two runs can be compared with ``--compare``.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import netCDF4
+import numpy as np
+
+from activestorage import stats
+from activestorage.active import load
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.reductions import OPERATIONS
+
+#: Fill value used by the synthetic files
+FILL_VALUE = -999
+
+
+def generate(filename, shape, chunks, dtype='f4', compression=False,
+             missing=0., seed=0):
+    """
+    Write a synthetic variable 'tas' to a netCDF4 file.
+
+    Parameters
+    ----------
+    filename: str
+    shape: tuple of int, shape of the variable
+    chunks: tuple of int, chunk shape, or None for contiguous storage
+    dtype: numpy dtype of the variable
+    compression: bool, deflate and shuffle the chunks
+    missing: float, the fraction of values that are missing
+    seed: int, of the random values
+    """
+    dtype = np.dtype(dtype)
+    rng = np.random.default_rng(seed)
+    with netCDF4.Dataset(filename, 'w') as ds:
+        dims = [f'd{i}' for i in range(len(shape))]
+        for dim, size in zip(dims, shape):
+            ds.createDimension(dim, size)
+        var = ds.createVariable(
+            'tas', dtype, dims, zlib=compression, shuffle=compression,
+            contiguous=chunks is None, chunksizes=chunks,
+            fill_value=np.array(FILL_VALUE, dtype=dtype))
+        var.set_auto_mask(False)
+        for i in range(shape[0]):
+            values = 250 + 50 * rng.random(shape[1:])
+            if missing:
+                values[rng.random(shape[1:]) < missing] = FILL_VALUE
+            var[i] = values.astype(dtype)
+
+
+def _measure(filename, op, active, pipe):
+    """Run one reduction and send its measurements down ``pipe``."""
+    stats.collector().reset()
+    start = time.perf_counter()
+    result = load(filename, 'tas', op, active=active, cache=False)
+    wall_time = time.perf_counter() - start
+    bytes_read = sum(request.bytes_read
+                     for request in stats.collector().requests)
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    if active:
+        array = NetCDFArray(filename=filename, ncvar='tas',
+                            active_method=op)
+        returned = sum(v.nbytes for v in array[...].values())
+    else:
+        with netCDF4.Dataset(filename) as ds:
+            var = ds.variables['tas']
+            returned = var.size * var.dtype.itemsize
+
+    pipe.send({
+        'wall_time': wall_time,
+        'bytes_read': bytes_read,
+        'bytes_returned': returned,
+        'peak_rss': peak_rss,
+        'result': float(result),
+    })
+    pipe.close()
+
+
+def measure(filename, op, active):
+    """Run one reduction in a fresh process and return its measurements."""
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_measure,
+                              args=(filename, op, active, sender))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    finally:
+        process.join()
+
+
+def environment():
+    """The commit and versions that results were measured with."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'netCDF4': netCDF4.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run(args):
+    """Run every case and return the results document."""
+    chunkings = [None if c == [0] else tuple(c) for c in args.chunks]
+    cases = itertools.product(args.shape, chunkings, args.compression,
+                              args.dtype, args.missing)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for shape, chunks, compression, dtype, missing in cases:
+            shape = tuple(shape)
+            if chunks is None and compression:
+                # only chunked variables can be compressed
+                continue
+            if chunks is not None and len(chunks) != len(shape):
+                continue
+            filename = os.path.join(tmp, 'bench.nc')
+            generate(filename, shape, chunks, dtype, compression, missing)
+            case = {
+                'shape': list(shape),
+                'chunks': None if chunks is None else list(chunks),
+                'compression': compression,
+                'dtype': dtype,
+                'missing': missing,
+                'file_size': os.path.getsize(filename),
+            }
+            for op, active in itertools.product(args.ops, (True, False)):
+                record = dict(case, op=op,
+                              path='active' if active else 'local')
+                record.update(measure(filename, op, active))
+                results.append(record)
+                print(f"{str(shape):>16} {str(chunks):>16} "
+                      f"{'zlib' if compression else 'raw':4} {dtype:3} "
+                      f"{missing:4.2f} {op:5} {record['path']:6} "
+                      f"{record['wall_time']:8.4f} s "
+                      f"{record['peak_rss'] / 1e6:7.1f} MB RSS",
+                      flush=True)
+    return {'environment': environment(), 'results': results}
+
+
+def _case_key(record):
+    return json.dumps({k: v for k, v in record.items()
+                       if k in ('shape', 'chunks', 'compression', 'dtype',
+                                'missing', 'op', 'path')}, sort_keys=True)
+
+
+def compare(old_file, new_file, threshold=0.2):
+    """
+    Print the change in wall time and peak RSS of each common case.
+
+    Returns the number of cases that are slower or bigger by more
+    than ``threshold`` (a fraction).
+    """
+    with open(old_file) as f:
+        old = {_case_key(r): r for r in json.load(f)['results']}
+    with open(new_file) as f:
+        new = json.load(f)['results']
+
+    regressions = 0
+    for record in new:
+        before = old.get(_case_key(record))
+        if before is None:
+            continue
+        ratios = [record[m] / before[m] if before[m] else 1.
+                  for m in ('wall_time', 'peak_rss')]
+        flag = ''
+        if any(r > 1 + threshold for r in ratios):
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"{record['shape']} {record['chunks']} {record['dtype']} "
+              f"{record['op']:5} {record['path']:6} time x{ratios[0]:.2f} "
+              f"RSS x{ratios[1]:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shape', type=int, nargs='+', action='append',
+                        help="variable shape, may be repeated")
+    parser.add_argument('--chunks', type=int, nargs='+', action='append',
+                        help="chunk shape, may be repeated; 0 for "
+                             "contiguous storage")
+    parser.add_argument('--compression', type=int, nargs='+',
+                        default=[0, 1], help="0 for none, 1 for zlib")
+    parser.add_argument('--dtype', nargs='+', default=['f4', 'f8'])
+    parser.add_argument('--missing', type=float, nargs='+',
+                        default=[0., 0.1])
+    parser.add_argument('--ops', nargs='+', default=list(OPERATIONS))
+    parser.add_argument('--output', help="JSON file to write results to")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two result files instead")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(*args.compare, threshold=args.threshold) else 0
+
+    args.shape = args.shape or [[24, 96, 192]]
+    args.chunks = args.chunks or [[0], [1, 96, 192], [12, 16, 100]]
+    args.compression = [bool(c) for c in args.compression]
+    document = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,6 +24,9 @@ REQUIREMENTS = {
     # Installation dependencies
     # Use with pip install . to install from source
     'install': [
+        # the private task spec that dask_optimization relies on
+        'dask>=2025.5.0,<2026.9',
+        'h5py',
         'netCDF4',
         'numpy',
     ],
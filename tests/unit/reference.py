@@ -0,0 +1,26 @@
+"""numpy answers to check the reduction operations against."""
+import numpy as np
+
+
+def reference(op, data, axis=None):
+    """
+    Return the reduction ``op`` of a (masked) array, computed by numpy.
+
+    The moments are computed in float64 with the population (ddof 0)
+    conventions of ``activestorage.reductions.MOMENTS``.
+    """
+    data = np.ma.asanyarray(data)
+    if op == 'count':
+        return np.ma.count(data, axis=axis)
+    if op not in ('skew', 'kurt'):
+        if op in ('var', 'std'):
+            data = data.astype('f8')
+        return getattr(np.ma, op)(data, axis=axis)
+
+    data = data.astype('f8')
+    deviation = data - data.mean(axis=axis, keepdims=True)
+    var = (deviation**2).mean(axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if op == 'skew':
+            return (deviation**3).mean(axis=axis) / var**1.5
+        return (deviation**4).mean(axis=axis) / var**2 - 3
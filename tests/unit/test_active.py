@@ -0,0 +1,150 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage import stats
+from activestorage.active import load
+from activestorage.cache import ResultCache
+
+
+class TestLoad(unittest.TestCase):
+    """Test loading data and reductions of netCDF variables."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        data = np.random.default_rng(2).random((12, 8, 10), dtype='f4')
+        data[5, 1:3] = -999
+        self.data = np.ma.masked_equal(data, -999)
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), data.shape):
+                ds.createDimension(name, size)
+            ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                              chunksizes=(6, 4, 5),
+                              fill_value=-999)[...] = self.data
+            # cell areas, missing over "land"
+            area = np.ma.masked_less(
+                np.random.default_rng(1).random((8, 10)), 0.2)
+            self.area = area
+            ds.createVariable('area', 'f8', ('lat', 'lon'),
+                              fill_value=-1.)[...] = area
+        self.cache = ResultCache()
+
+    def test_data(self):
+        np.testing.assert_array_equal(load(self.filename, 'tas'), self.data)
+
+    def test_reduction(self):
+        for op in ('max', 'mean', 'sum'):
+            self.assertAlmostEqual(
+                load(self.filename, 'tas', op, cache=self.cache),
+                getattr(self.data, op)(), places=3)
+
+        result = load(self.filename, 'tas', 'min', indices=(slice(2, 9),),
+                      axis=(1, 2), cache=self.cache)
+        np.testing.assert_array_equal(result,
+                                      self.data[2:9].min(axis=(1, 2)))
+
+    def test_local(self):
+        """Reading everything and reducing here gives the same answer."""
+        for op in ('max', 'count', 'mean'):
+            np.testing.assert_allclose(
+                load(self.filename, 'tas', op, axis=(0, 2), cache=False),
+                load(self.filename, 'tas', op, axis=(0, 2), cache=False,
+                     active=False), rtol=1e-6)
+
+    def test_named_axes(self):
+        """A time mean field and a zonal maximum, by dimension name."""
+        result = load(self.filename, 'tas', 'mean', axis='time',
+                      cache=self.cache)
+        self.assertEqual(result.shape, (8, 10))
+        np.testing.assert_allclose(result, self.data.mean(axis=0),
+                                   rtol=1e-5)
+
+        result = load(self.filename, 'tas', 'max', axis='lon',
+                      cache=self.cache)
+        self.assertEqual(result.shape, (12, 8))
+        np.testing.assert_array_equal(result, self.data.max(axis=2))
+        # the same question by position is answered from the cache
+        hits = self.cache.hits
+        load(self.filename, 'tas', 'max', axis=2, cache=self.cache)
+        self.assertEqual(self.cache.hits, hits + 1)
+
+        # dimensions dropped by an integer index can't be reduced
+        with self.assertRaises(ValueError):
+            load(self.filename, 'tas', 'max', indices=(slice(None), 3),
+                 axis='lat')
+
+    def test_sketches(self):
+        """Percentiles, histograms and exceedances, reduced by chunk."""
+        data = self.data.astype('f8')
+        result = load(self.filename, 'tas', 'quantile(0.9)', axis='time',
+                      cache=self.cache)
+        # there are few enough values per cell for exact quantiles
+        expected = np.ma.apply_along_axis(
+            lambda x: np.quantile(x.compressed(), 0.9, method='hazen'), 0,
+            data)
+        np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+        result = load(self.filename, 'tas', 'histogram(0, 1, 10)',
+                      axis=(1, 2), cache=self.cache)
+        self.assertEqual(result.shape, (12, 10))
+        np.testing.assert_array_equal(
+            result[5], np.histogram(data[5].compressed(), 10, (0, 1))[0])
+
+        result = load(self.filename, 'tas', 'count_above(0.75)',
+                      cache=self.cache)
+        self.assertEqual(result, np.sum(data > 0.75))
+
+    def test_weighted(self):
+        """Area weighted means over the valid cells of the grid."""
+        valid = ~np.ma.getmaskarray(self.data) & ~self.area.mask
+        weights = np.where(valid, self.area.filled(0), 0.)
+        expected = ((self.data.filled(0) * weights).sum(axis=(1, 2))
+                    / weights.sum(axis=(1, 2)))
+        for active in (True, False):
+            np.testing.assert_allclose(
+                load(self.filename, 'tas', 'mean', axis=(1, 2),
+                     weights='area', active=active, cache=self.cache),
+                expected, rtol=1e-5)
+
+        # a land-sea mask of zeros and ones
+        land = self.area.mask
+        result = load(self.filename, 'tas', 'max', indices=(slice(2, 9),),
+                      axis=(1, 2), weights=land.astype('i1'),
+                      cache=self.cache)
+        np.testing.assert_array_equal(
+            result, np.ma.masked_where(np.broadcast_to(~land, (7, 8, 10)),
+                                       self.data[2:9]).max(axis=(1, 2)))
+
+        # the weights are part of the cache key, so only the repeated
+        # weighted mean was answered from the cache
+        unweighted = load(self.filename, 'tas', 'mean', axis=(1, 2),
+                          cache=self.cache)
+        np.testing.assert_allclose(unweighted, self.data.mean(axis=(1, 2)),
+                                   rtol=1e-5)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_cached(self):
+        """The second time, the answer comes from the cache."""
+        stats.collector().reset()
+        first = load(self.filename, 'tas', 'max', axis=0, cache=self.cache)
+        routes = [r.route for r in stats.collector().requests]
+        self.assertNotIn('cache', routes)
+        second = load(self.filename, 'tas', 'max', axis=0, cache=self.cache)
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual((self.cache.misses, self.cache.hits), (1, 1))
+        self.assertEqual([r.route for r in stats.collector().requests],
+                         routes + ['cache'])
+
+        load(self.filename, 'tas', 'max', axis=0, cache=False)
+        self.assertEqual(self.cache.misses, 1)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
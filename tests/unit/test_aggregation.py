@@ -0,0 +1,112 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import dask
+import dask.array as da
+import netCDF4
+import numpy as np
+
+from activestorage import stats
+from activestorage.aggregation import AggregatedDataset
+from activestorage.dask_optimization import optimize
+from activestorage.handles import dataset_pool
+from activestorage.reductions import OPERATIONS
+
+from .reference import reference
+
+
+class TestAggregatedDataset(unittest.TestCase):
+    """Test reductions over a variable split along time into files."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        data = np.random.default_rng(6).random((12, 8, 10), dtype='f4')
+        data[4] = -999
+        data[7, 2:5, 3] = -999
+        self.data = np.ma.masked_equal(data, -999)
+        self.files = []
+        for i, (start, stop) in enumerate(((0, 5), (5, 9), (9, 12))):
+            filename = str(Path(self.tempdir.name) / f'tas_{i}.nc')
+            with netCDF4.Dataset(filename, 'w') as ds:
+                ds.createDimension('time', None)
+                ds.createDimension('lat', 8)
+                ds.createDimension('lon', 10)
+                ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                                  chunksizes=(2, 4, 5), fill_value=-999)
+                ds['tas'][...] = self.data[start:stop]
+            self.files.append(filename)
+        self.dataset = AggregatedDataset(
+            str(Path(self.tempdir.name) / 'tas_*.nc'), 'tas')
+
+    def test_index(self):
+        self.assertEqual(self.dataset.files, self.files)
+        self.assertEqual(self.dataset.shape, (12, 8, 10))
+        self.assertEqual(self.dataset.offsets.tolist(), [0, 5, 9, 12])
+        for indices in (Ellipsis, (slice(3, 10), 2), (6, slice(1, 4)),
+                        (slice(None, None, 4),), ([11, 0, 5, 6],)):
+            np.testing.assert_array_equal(self.dataset[indices],
+                                          self.data[indices])
+
+    def test_reductions(self):
+        for indices in (Ellipsis, (slice(3, 10),), (slice(1, 11, 3), 2),
+                        7, ([11, 0, 5, 6],)):
+            data = self.data[indices]
+            for op in OPERATIONS:
+                for axis in (None, 0, -1):
+                    result = self.dataset.reduce(op, indices, axis=axis)
+                    expected = reference(op, data, axis)
+                    self.assertEqual(np.shape(result), np.shape(expected))
+                    np.testing.assert_allclose(
+                        np.ma.filled(result, np.nan),
+                        np.ma.filled(expected, np.nan), rtol=1e-5,
+                        err_msg=f"{indices} {op} {axis}")
+
+    def test_overlapping_files(self):
+        """Only the files that overlap the subspace are read."""
+        stats.collector().reset()
+        self.dataset.reduce('max', (slice(6, 9),))
+        self.assertEqual(
+            {request.filename for request in stats.collector().requests},
+            {self.files[1]})
+
+    def test_weighted(self):
+        weights = np.arange(80.).reshape(8, 10)
+        result = self.dataset.reduce('mean', axis=(1, 2), weights=weights)
+        w = np.ma.masked_where(np.ma.getmaskarray(self.data),
+                               np.broadcast_to(weights, self.data.shape))
+        np.testing.assert_allclose(
+            result, (self.data * w).sum(axis=(1, 2)) / w.sum(axis=(1, 2)),
+            rtol=1e-5)
+
+    def test_dask(self):
+        """Dask reductions are pushed into each file's reads."""
+        dx = da.from_array(self.dataset, chunks=(4, 8, 10), lock=False)
+        stats.collector().reset()
+        with dask.config.set(array_optimize=optimize):
+            result = dx.mean(axis=0).compute(scheduler='sync')
+        np.testing.assert_allclose(result, self.data.mean(axis=0),
+                                   rtol=1e-5)
+        self.assertEqual({r.route for r in stats.collector().requests},
+                         {'chunks'})
+
+    def test_mismatch(self):
+        dataset_pool().close()
+        with netCDF4.Dataset(self.files[2], 'a') as ds:
+            ds.createDimension('x', 3)
+            ds.createVariable('other', 'f4', ('time', 'x'))
+        with netCDF4.Dataset(self.files[0], 'a') as ds:
+            ds.createDimension('x', 4)
+            ds.createVariable('other', 'f4', ('time', 'x'))
+        with self.assertRaises(ValueError):
+            AggregatedDataset(self.files[::2], 'other')
+        with self.assertRaises(FileNotFoundError):
+            AggregatedDataset(str(Path(self.tempdir.name) / 'x_*.nc'),
+                              'tas')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,73 +1,26 @@
 #
 # Boiler plate code for playing with active storage reads
 
-import struct
 import tempfile
 import unittest
 from pathlib import Path
 
-# FIXME: Add striding examples. We might want to consider
-# using numpy mmap at that point.
-# FIXME: Add example with missing data
-# FIXME: Add other datatypes than 32 bit floats
-# FIXME: Add other operations (full set = sum, mean, count, min, max)
+import numpy as np
+
+from activestorage.reductions import MissingValues
+from activestorage.storage import (
+    do_operation,
+    hyperslab,
+    memmap_hyperslab,
+    raw_write,
+    standard_read,
+)
+
 # FIXME: Make sure that the byte representation is consistent with netcdf
 # byte representations
 # and/or think about what we need to tell active storage about float format.
 
 
-def raw_write(f, list_of_floats):
-    """ Does what it says on the tin, assume f open for binary writing"""
-    data = struct.pack('f' * len(list_of_floats), *list_of_floats)
-    f.write(data)
-
-
-def standard_read(f, i, j):
-    """
-    From open file f, read floats from byte position <i> to byte position <j>.
-    """
-    f.seek(i, 0)
-    n = j - i
-    assert n % 4 == 0
-    nn = int(n / 4)
-    bytes = f.read(n)
-    floats = struct.unpack('f' * nn, bytes)
-    return list(floats)
-
-
-def mock_active_read_operation(f, i, n, op='mean'):
-    """
-    Return <op> applied to <n> floats starting at the <i>th byte of file <f>
-    """
-    f.seek(i, 0)
-    nbytes = n * 4
-    bytes = f.read(nbytes)
-    floats = struct.unpack('f' * n, bytes)
-    print('Mocking active ', op)
-    if 'mean':
-        return sum(floats) / n
-    else:
-        raise NotImplementedError
-
-
-def do_operation(f, i, n, op):
-    """
-    do an operation on f, and if f is on active storage,
-    which needs to be an attribute of f, then use active
-    read operations, otherwise do ordinary operations.
-    """
-    if f.is_active:
-        return mock_active_read_operation(f, i, n, op)
-    else:
-        j = i + 4 * n
-        floats = standard_read(f, i, j)
-        if op == 'mean':
-            mean = sum(floats) / n
-            return mean
-        else:
-            raise NotImplementedError
-
-
 class TestActive(unittest.TestCase):
     """
     Simple test harness for extension to real active storage
@@ -107,6 +60,50 @@ class TestActive(unittest.TestCase):
         self.assertEqual(ans1, ans2)
         print(ans1)
 
+    def test_compare_active_operations(self):
+        """Active and local paths agree for every operation."""
+        expected = {'sum': 14., 'mean': 3.5, 'min': 2., 'max': 5.,
+                    'count': 4}
+        for op, value in expected.items():
+            answers = []
+            for is_active in (False, True):
+                with open(self.dummyfile, 'rb') as f:
+                    f.is_active = is_active
+                    answers.append(do_operation(f, 8, 4, op))
+            self.assertEqual(answers, [value, value], op)
+
+    def test_compare_active_hyperslab(self):
+        """Strided hyperslab reads agree with numpy slicing."""
+        # the 12 values as a (3, 4) array starting at byte 0
+        expected = np.arange(12, dtype='f4').reshape(3, 4)[0:3:2, 1:4:2]
+        for is_active in (False, True):
+            with open(self.dummyfile, 'rb') as f:
+                f.is_active = is_active
+                ans = do_operation(f, 0, None, 'sum', shape=(3, 4),
+                                   start=(0, 1), count=(2, 2),
+                                   stride=(2, 2))
+            self.assertEqual(ans, expected.sum())
+
+    def test_compare_active_missing(self):
+        """Missing data are ignored on both paths."""
+        # 4., 5. and 6. are missing
+        missing = MissingValues(fill_value=4., missing_value=[5., 6.])
+        for is_active in (False, True):
+            with open(self.dummyfile, 'rb') as f:
+                f.is_active = is_active
+                ans = do_operation(f, 8, 6, 'mean', missing=missing)
+            self.assertEqual(ans, (2. + 3. + 7.) / 3)
+
+    def test_hyperslab_offset(self):
+        """The array may start part way into the file."""
+        with open(self.dummyfile, 'rb') as f:
+            view = memmap_hyperslab(f, 8, (5, 2), start=(1, 1), stride=(2, 1))
+        np.testing.assert_array_equal(view, [[5.], [9.]])
+
+    def test_hyperslab_out_of_bounds(self):
+        with self.assertRaises(IndexError):
+            hyperslab((3, 4), start=(0, 0), count=(2, 3), stride=(1, 2))
+
     def tearDown(self):
         # explicitly clean up
         self.tempdir.cleanup()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from activestorage.cache import ResultCache, cache_key
+
+
+class TestResultCache(unittest.TestCase):
+    """Test the reduction result cache."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tempdir.name) / 'cache'
+        self.filename = Path(self.tempdir.name) / 'test.nc'
+        self.filename.write_bytes(b'data')
+        self.partial = {'sum': np.arange(6.).reshape(2, 3),
+                        'count': np.full((2, 3), 4)}
+
+    def test_lru(self):
+        cache = ResultCache(max_entries=2)
+        for key in 'abca':
+            if cache.get(key) is None:
+                cache.put(key, self.partial)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 5))
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['nbytes'], 2 * 96)
+
+    def test_copies(self):
+        """Changing a result put or got doesn't change the cache."""
+        cache = ResultCache()
+        cache.put('k', self.partial)
+        self.partial['sum'][0, 0] = -1
+        partial = cache.get('k')
+        self.assertEqual(partial['sum'][0, 0], 0)
+        partial['sum'] *= 2
+        del partial['count']
+        np.testing.assert_array_equal(cache.get('k')['sum'],
+                                      np.arange(6.).reshape(2, 3))
+        self.assertIn('count', cache.get('k'))
+
+    def test_disk(self):
+        """Results on disk outlive the cache object that wrote them."""
+        ResultCache(directory=self.directory).put('k', self.partial)
+        cache = ResultCache(directory=self.directory)
+        partial = cache.get('k')
+        np.testing.assert_array_equal(partial['sum'], self.partial['sum'])
+        self.assertEqual(partial['count'].dtype, self.partial['count'].dtype)
+        self.assertEqual(cache.disk_hits, 1)
+
+    def test_disk_eviction(self):
+        cache = ResultCache(directory=self.directory, max_bytes=1500)
+        for key in 'abc':
+            cache.put(key, self.partial)
+            time.sleep(0.01)
+        files = sorted(p.stem for p in self.directory.iterdir())
+        self.assertEqual(files, ['b', 'c'])
+
+    def test_key(self):
+        """Keys follow the selection, operation and file version."""
+        shape = (4, 6)
+        key = cache_key(self.filename, 'tas', shape, Ellipsis, 'max')
+        self.assertEqual(
+            key, cache_key(str(self.filename), 'tas', shape,
+                           (slice(None), slice(0, 6)), 'max', axis=(0, 1)))
+        self.assertNotEqual(
+            key, cache_key(self.filename, 'tas', shape, Ellipsis, 'min'))
+        self.assertNotEqual(
+            key, cache_key(self.filename, 'tas', shape, Ellipsis, 'max',
+                           axis=0))
+        self.assertNotEqual(
+            key, cache_key(self.filename, 'tas', shape, Ellipsis, 'max',
+                           mask=False))
+
+        checksum = cache_key(self.filename, 'tas', shape, Ellipsis, 'max',
+                             checksum=True)
+        os.utime(self.filename, ns=(0, 0))
+        self.assertNotEqual(
+            key, cache_key(self.filename, 'tas', shape, Ellipsis, 'max'))
+        self.assertEqual(
+            checksum, cache_key(self.filename, 'tas', shape, Ellipsis,
+                                'max', checksum=True))
+
+        # checksums identify copies, but not changed contents
+        copy = Path(self.tempdir.name) / 'copy.nc'
+        shutil.copy(self.filename, copy)
+        self.assertEqual(
+            checksum, cache_key(copy, 'tas', shape, Ellipsis, 'max',
+                                checksum=True))
+        copy.write_bytes(b'atad')
+        self.assertNotEqual(
+            checksum, cache_key(copy, 'tas', shape, Ellipsis, 'max',
+                                checksum=True))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
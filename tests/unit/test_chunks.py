@@ -0,0 +1,127 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage.chunks import (
+    H5Z_FILTER_FLETCHER32,
+    StorageLayout,
+    fletcher32,
+    reduce_chunks,
+    unshuffle,
+)
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.plan import ChunkPlan
+from activestorage.reductions import OPERATIONS, MissingValues, finalise
+
+from .reference import reference
+
+
+class TestChunks(unittest.TestCase):
+    """Test reading and decoding raw stored chunks."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        rng = np.random.default_rng(5)
+        self.data = {
+            'zlib': rng.random((10, 9, 8)).astype('f4'),
+            'big': rng.random((10, 9, 8)).astype('>f8'),
+            'ints': rng.integers(-100, 100, (10, 9, 8)).astype('i2'),
+            'contiguous': rng.random((10, 9, 8)).astype('f4'),
+        }
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip('tyx', (10, 9, 8)):
+                ds.createDimension(name, size)
+            ds.createVariable('zlib', 'f4', tuple('tyx'), zlib=True,
+                              shuffle=True, fletcher32=True,
+                              chunksizes=(4, 4, 3))
+            ds.createVariable('big', 'f8', tuple('tyx'), zlib=True,
+                              endian='big', chunksizes=(3, 9, 8))
+            ds.createVariable('ints', 'i2', tuple('tyx'), shuffle=True,
+                              zlib=True, complevel=9, chunksizes=(5, 5, 5))
+            ds.createVariable('contiguous', 'f4', tuple('tyx'),
+                              contiguous=True)
+            for name, data in self.data.items():
+                ds.variables[name][...] = data
+            ds.createVariable('empty', 'f4', tuple('tyx'),
+                              chunksizes=(5, 5, 5), fill_value=-1.)
+
+    def reduce(self, ncvar, indices, op, axis):
+        layout = StorageLayout.from_file(self.filename, ncvar)
+        with netCDF4.Dataset(self.filename) as ds:
+            variable = ds.variables[ncvar]
+            plan = ChunkPlan.from_variable(variable, indices)
+            missing = MissingValues.from_variable(variable)
+        layout.attach(plan)
+        partial = reduce_chunks(self.filename, layout, plan, op, axis,
+                                missing=missing, max_workers=4)
+        return finalise(partial, op)
+
+    def test_reduce_chunks(self):
+        indices = (slice(1, 9), [0, 4, 5, 8], slice(2, 8, 2))
+        for ncvar, data in self.data.items():
+            selected = data[1:9][:, [0, 4, 5, 8]][..., 2:8:2]
+            for op in OPERATIONS:
+                for axis in ((0, 1, 2), (0, 2)):
+                    expected = np.expand_dims(
+                        reference(op, selected, axis), axis)
+                    np.testing.assert_allclose(
+                        self.reduce(ncvar, indices, op, axis), expected,
+                        rtol=1e-6, err_msg=f"{ncvar} {op} {axis}")
+
+    def test_unwritten_chunks(self):
+        """Chunks that were never written hold only missing data."""
+        result = self.reduce('empty', Ellipsis, 'max', (0, 1, 2))
+        self.assertIs(result[0, 0, 0], np.ma.masked)
+
+    def test_layout(self):
+        layout = StorageLayout.from_file(self.filename, 'zlib')
+        self.assertEqual(layout.chunk_shape, (4, 4, 3))
+        self.assertEqual(len(layout.chunks), 3 * 3 * 3)
+        self.assertEqual([code for code, _ in layout.filters], [3, 2, 1])
+        self.assertTrue(StorageLayout.from_file(self.filename,
+                                                'contiguous').contiguous)
+
+    def test_netcdf3_fallback(self):
+        """netCDF3 files are reduced by reading through netCDF4."""
+        filename = str(Path(self.tempdir.name) / 'classic.nc')
+        with netCDF4.Dataset(filename, 'w', format='NETCDF3_CLASSIC') as ds:
+            ds.createDimension('x', 6)
+            ds.createVariable('v', 'f4', ('x',))[...] = np.arange(6)
+        array = NetCDFArray(filename=filename, ncvar='v', dtype='f4',
+                            ndim=1, shape=(6,), size=6, active_method='sum')
+        self.assertIsNone(array.storage_layout())
+        self.assertEqual(array[1:4]['sum'].item(), 6)
+
+    def test_unshuffle(self):
+        data = np.arange(7, dtype='i4')
+        shuffled = np.frombuffer(data.tobytes(), 'u1').reshape(7, 4).T
+        raw = shuffled.tobytes() + b'xy'
+        self.assertEqual(unshuffle(raw, 4).tobytes(), data.tobytes() + b'xy')
+
+    def test_fletcher32(self):
+        """Chunks whose Fletcher32 checksum doesn't match are refused."""
+        layout = StorageLayout.from_file(self.filename, 'ints')
+        offset, size, _ = layout.chunks[(0, 0, 0)]
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            raw = f.read(size)
+        layout = StorageLayout('i2', (5, 5, 5), (5, 5, 5),
+                               [(H5Z_FILTER_FLETCHER32, ())], {})
+        checksum = fletcher32(raw).to_bytes(4, 'little')
+        for stored in (checksum, checksum[::-1]):
+            self.assertEqual(bytes(layout.decode(raw + stored)), raw)
+        corrupt = bytearray(raw)
+        corrupt[100] ^= 1
+        with self.assertRaisesRegex(OSError, 'Fletcher32'):
+            layout.decode(bytes(corrupt) + checksum)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
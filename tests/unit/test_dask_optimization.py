@@ -0,0 +1,108 @@
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+import dask
+import dask.array as da
+import netCDF4
+import numpy as np
+from dask.utils import ensure_dict
+
+from activestorage import stats
+from activestorage import dask_optimization
+from activestorage.dask_optimization import active_block, optimize, register
+from activestorage.netcdf_array import NetCDFArray
+
+
+class TestDaskOptimization(unittest.TestCase):
+    """Test the fusion of dask reductions into active storage reads."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        data = np.random.default_rng(5).random((12, 8, 10), dtype='f4')
+        # missing data, including a whole block
+        data[:6, :4, :5] = -999
+        data[7, 2:5, 3] = -999
+        self.data = np.ma.masked_equal(data, -999)
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), data.shape):
+                ds.createDimension(name, size)
+            var = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                                    chunksizes=(6, 4, 5), fill_value=-999)
+            var[...] = self.data
+        self.array = NetCDFArray(filename=self.filename, ncvar='tas',
+                                 dtype=data.dtype, ndim=3,
+                                 shape=data.shape, size=data.size)
+
+    def reductions(self, dx):
+        return {
+            'sum': dx.sum, 'mean': dx.mean, 'min': dx.min, 'max': dx.max,
+            'count': lambda axis: da.ma.count(dx, axis=axis),
+        }
+
+    def test_register(self):
+        """Only registered on request, and not over the user's choice."""
+        self.assertIsNot(dask.config.get('array_optimize', None), optimize)
+        with dask.config.set(array_optimize=None):
+            register()
+            self.assertIs(dask.config.get('array_optimize'), optimize)
+        with dask.config.set(array_optimize=len):
+            register()
+            self.assertIs(dask.config.get('array_optimize'), len)
+
+    def test_unfusable(self):
+        """Without dask's task spec, graphs are left to dask."""
+        dx = da.from_array(self.array, chunks=(6, 4, 5), lock=False)
+        reduction = dx.max(axis=0)
+        with mock.patch.object(dask_optimization, 'FUSABLE', False):
+            dsk = ensure_dict(optimize(reduction.__dask_graph__(),
+                                       reduction.__dask_keys__()))
+        self.assertNotIn(active_block, {getattr(task, 'func', None)
+                                        for task in dsk.values()})
+
+    def test_fused(self):
+        """Every operation is fused, and right, over any axes."""
+        for chunks in ((6, 4, 5), (5, 3, 10)):
+            dx = da.from_array(self.array, chunks=chunks, lock=False)
+            for op, method in self.reductions(dx).items():
+                for axis in (None, 0, (1, 2), (0, 2)):
+                    reduction = method(axis=axis)
+                    dsk = ensure_dict(optimize(reduction.__dask_graph__(),
+                                               reduction.__dask_keys__()))
+                    functions = {getattr(task, 'func', None)
+                                 for task in dsk.values()}
+                    self.assertIn(active_block, functions)
+                    self.assertNotIn(da.core.getter, functions)
+
+                    stats.collector().reset()
+                    with dask.config.set(array_optimize=optimize):
+                        result = reduction.compute(scheduler='sync')
+                    routes = {r.route for r in stats.collector().requests}
+                    self.assertEqual(routes, {'chunks'})
+                    expected = getattr(np.ma, op)(self.data, axis=axis)
+                    self.assertEqual(np.shape(result), np.shape(expected))
+                    np.testing.assert_allclose(
+                        np.ma.filled(result, np.nan),
+                        np.ma.filled(expected, np.nan),
+                        rtol=1e-5, err_msg=f"{chunks} {op} {axis}")
+
+    def test_unfused(self):
+        """Other graphs are computed as they were."""
+        dx = da.from_array(self.array, chunks=(6, 4, 5), lock=False)
+        stats.collector().reset()
+        result = (dx + 1).max(axis=0).compute(scheduler='sync')
+        self.assertEqual({r.route for r in stats.collector().requests},
+                         {'read'})
+        np.testing.assert_allclose(result, self.data.max(axis=0) + 1)
+
+        numpy = da.from_array(self.data.filled(0), chunks=4)
+        self.assertAlmostEqual(numpy.sum().compute(), self.data.sum(), 3)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage.dask_reduction import active_reduction
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.reductions import OPERATIONS
+
+from .reference import reference
+
+
+class TestDaskReduction(unittest.TestCase):
+    """Test dask reduction trees over active storage partial results."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        data = np.random.default_rng(3).random((12, 8, 10), dtype='f4')
+        # missing data, including a whole time step
+        data[4] = -999
+        data[7, 2:5, 3] = -999
+        self.data = np.ma.masked_equal(data, -999)
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), data.shape):
+                ds.createDimension(name, size)
+            var = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                                    chunksizes=(6, 4, 5), fill_value=-999)
+            var[...] = self.data
+        self.array = NetCDFArray(filename=self.filename, ncvar='tas',
+                                 dtype=data.dtype, ndim=3,
+                                 shape=data.shape, size=data.size)
+
+    def expected(self, op, axis):
+        return reference(op, self.data, axis)
+
+    def test_reductions(self):
+        """Every operation is right over any chunking and any tree."""
+        for chunks in ('auto', (6, -1, -1), (5, 3, 4)):
+            for op in OPERATIONS:
+                for axis in (None, 0, (1, 2), (0, 2)):
+                    result = active_reduction(self.array, op, axis=axis,
+                                              chunks=chunks, split_every=2)
+                    result = result.compute(scheduler='sync')
+                    expected = self.expected(op, axis)
+                    self.assertEqual(np.shape(result), np.shape(expected))
+                    np.testing.assert_allclose(
+                        np.ma.filled(result, np.nan),
+                        np.ma.filled(expected, np.nan),
+                        rtol=1e-5, err_msg=f"{chunks} {op} {axis}")
+
+    def test_keepdims(self):
+        result = active_reduction(self.array, 'max', axis=1, keepdims=True,
+                                  chunks=(6, 3, 5))
+        self.assertEqual(result.shape, (12, 1, 10))
+        self.assertEqual(result.compute(scheduler='sync').shape,
+                         (12, 1, 10))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage import stats
+from activestorage.active import load
+from activestorage.decoding import Packing
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.reductions import OPERATIONS
+from activestorage.streaming import SlabReader
+
+from .reference import reference
+
+
+class TestDecoding(unittest.TestCase):
+    """Test reductions of packed and big-endian variables."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(22)
+        self.packed = rng.integers(-3000, 3000, (12, 8, 10), dtype='i2')
+        self.packed[4, 2:5] = -32767
+        self.weights = rng.random((8, 10))
+
+    def _write(self, name, scale_factor, add_offset, dtype='i2',
+               fmt='NETCDF4', **kwargs):
+        """Write the packed values, and return them unpacked exactly."""
+        filename = str(Path(self.tempdir.name) / name)
+        with netCDF4.Dataset(filename, 'w', format=fmt) as ds:
+            for dim, size in zip(('time', 'lat', 'lon'), self.packed.shape):
+                ds.createDimension(dim, size)
+            var = ds.createVariable('ta', dtype, ('time', 'lat', 'lon'),
+                                    fill_value=-32767, **kwargs)
+            var.scale_factor = scale_factor
+            var.add_offset = add_offset
+            var.set_auto_maskandscale(False)
+            var[...] = self.packed
+        data = np.ma.masked_equal(self.packed, -32767)
+        return filename, data * np.float64(scale_factor) + add_offset
+
+    def _check(self, filename, data, route):
+        stats.collector().reset()
+        for op in OPERATIONS:
+            for axis in (None, (1, 2)):
+                result = load(filename, 'ta', op, axis=axis, cache=False)
+                np.testing.assert_allclose(
+                    np.ma.filled(result, -1),
+                    np.ma.filled(reference(op, data, axis), -1),
+                    rtol=1e-6, err_msg=f"{op} {axis}")
+
+        # percentiles of 12 values per cell are exact
+        result = load(filename, 'ta', 'quantile(0.25)', axis='time',
+                      cache=False)
+        expected = np.ma.apply_along_axis(
+            lambda x: np.quantile(x.compressed(), 0.25, method='hazen'), 0,
+            data)
+        np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+        # bin edges and thresholds half way between packed values
+        result = load(filename, 'ta', 'histogram(265.005, 295.005, 6)',
+                      cache=False)
+        np.testing.assert_array_equal(
+            result, np.histogram(data.compressed(), 6,
+                                 (265.005, 295.005))[0])
+        for op, expected in (('count_above(285.005)', np.sum(data > 285.005)),
+                             ('count_below(271.005)',
+                              np.sum(data < 271.005))):
+            self.assertEqual(load(filename, 'ta', op, cache=False), expected)
+
+        # area weighted means
+        valid = ~np.ma.getmaskarray(data)
+        weights = np.where(valid, self.weights, 0)
+        np.testing.assert_allclose(
+            load(filename, 'ta', 'mean', axis=(1, 2), weights=self.weights,
+                 cache=False),
+            (data.filled(0) * weights).sum(axis=(1, 2))
+            / weights.sum(axis=(1, 2)), rtol=1e-6)
+
+        self.assertEqual({r.route for r in stats.collector().requests},
+                         {route})
+        for op in ('min', 'var', 'count_above(285.005)'):
+            np.testing.assert_allclose(
+                SlabReader(filename, 'ta', max_memory=1000).reduce(op, 0),
+                load(filename, 'ta', op, axis=0, cache=False), rtol=1e-6)
+
+    def test_chunks(self):
+        """Packed, big-endian chunks are reduced as stored."""
+        filename, data = self._write('chunks.nc', 0.01, 280.,
+                                     dtype='>i2', endian='big',
+                                     chunksizes=(6, 4, 5))
+        self._check(filename, data, 'chunks')
+
+    def test_netcdf(self):
+        """netCDF classic files are read by libnetcdf."""
+        filename, data = self._write('classic.nc', np.float32(0.01),
+                                     np.float32(280.),
+                                     fmt='NETCDF3_CLASSIC')
+        self._check(filename, data, 'netcdf')
+
+    def test_negative_scale(self):
+        filename, data = self._write('negative.nc', -0.01, 280.,
+                                     chunksizes=(6, 4, 5))
+        self._check(filename, data, 'chunks')
+
+    def test_plain_read_after_active(self):
+        """Reading stored values doesn't change later plain reads."""
+        for name, fmt in (('plain.nc', 'NETCDF4'),
+                          ('plain3.nc', 'NETCDF3_CLASSIC')):
+            filename, data = self._write(name, np.float32(0.01),
+                                         np.float32(280.), fmt=fmt)
+            array = NetCDFArray(filename=filename, ncvar='ta',
+                                shape=data.shape)
+            before = array[0, 0]
+            np.testing.assert_allclose(before, data[0, 0], rtol=1e-6)
+            load(filename, 'ta', 'max', cache=False)
+            SlabReader(filename, 'ta').reduce('min', 0)
+            np.testing.assert_array_equal(array[0, 0], before)
+
+    def test_from_attributes(self):
+        # h5py reads attributes as arrays of one element
+        packing = Packing.from_attributes({'scale_factor': np.array([2.]),
+                                           'units': 'K'})
+        self.assertEqual((packing.scale, packing.offset), (2., 0))
+        self.assertIsNone(Packing.from_attributes({'units': 'K'}))
+
+    def test_packed_operation(self):
+        packing = Packing(scale_factor=-0.5, add_offset=10.)
+        self.assertEqual(packing.packed_operation('min'), 'max')
+        self.assertEqual(packing.packed_operation('count_above(9)'),
+                         'count_below(2.0)')
+        self.assertEqual(packing.packed_operation('histogram(8, 9.5, 3)'),
+                         'histogram(1.0, 4.0, 3)')
+        self.assertEqual(packing.packed_operation('quantile(0.5)'),
+                         'quantile(0.5)')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage import executors, stats
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.reductions import empty_partial
+
+
+class FakeClient:
+    """Stands in for a ``distributed.Client``."""
+
+    def __init__(self):
+        self.tasks = 0
+
+    def nthreads(self):
+        return {'worker-0': 2, 'worker-1': 2}
+
+    def map(self, function, tasks, pure=True):
+        self.tasks += len(tasks)
+        return [function(task) for task in tasks]
+
+    def gather(self, futures):
+        return futures
+
+
+class TestExecutors(unittest.TestCase):
+    """Test reducing stored chunks with each kind of executor."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        data = np.random.default_rng(7).random((12, 8, 10), dtype='f4')
+        data[4] = -999
+        data[7, 2:5, 3] = -999
+        self.data = np.ma.masked_equal(data, -999)
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), data.shape):
+                ds.createDimension(name, size)
+            ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                              chunksizes=(3, 4, 5), zlib=True,
+                              fill_value=-999)[...] = self.data
+
+    def reduce(self, op, axis, executor, weights=None):
+        array = NetCDFArray(filename=self.filename, ncvar='tas',
+                            active_method=op, active_axis=axis,
+                            active_weights=weights, executor=executor,
+                            max_workers=2)
+        return array[1:11, :, 2:]
+
+    def assert_same(self, executor):
+        for op in ('sum', 'mean', 'max', 'count'):
+            for axis in (None, 0, (1, 2)):
+                for weights in (None, np.arange(80.).reshape(8, 10)):
+                    expected = self.reduce(op, axis, 'threads', weights)
+                    result = self.reduce(op, axis, executor, weights)
+                    self.assertEqual(set(result), set(expected))
+                    for field, values in expected.items():
+                        np.testing.assert_allclose(
+                            result[field], values, rtol=1e-6,
+                            err_msg=f"{executor} {op} {axis} {field}")
+
+    def test_get_executor(self):
+        self.assertIsInstance(executors.get_executor(),
+                              executors.ThreadExecutor)
+        self.assertEqual(executors.get_executor('threads', 3).workers, 3)
+        with ThreadPoolExecutor(2) as pool:
+            self.assertTrue(executors.get_executor(pool).in_process)
+        client = executors.get_executor(FakeClient())
+        self.assertEqual(client.workers, 4)
+        self.assertFalse(client.shared_memory)
+        with self.assertRaises(ValueError):
+            executors.get_executor('gpu')
+        with self.assertRaises(TypeError):
+            executors.get_executor(42)
+
+    def test_serial(self):
+        self.assert_same('serial')
+
+    def test_processes(self):
+        """Worker processes return their results in shared memory."""
+        self.assert_same('processes')
+        stats.collector().reset()
+        self.reduce('max', None, 'processes')
+        request = stats.collector().requests[-1]
+        self.assertEqual(request.elements, 10 * 8 * 8)
+        self.assertGreater(request.bytes_read, 0)
+        self.assertIn('wait', request.timings)
+
+    def test_distributed(self):
+        client = FakeClient()
+        self.assert_same(client)
+        self.assertGreater(client.tasks, 0)
+
+    def test_shared_partial(self):
+        partial = empty_partial('max', (2, 1), 'f4')
+        shared = executors.SharedPartial(partial, slots=3)
+        try:
+            region = {'max': np.array([[5.]]), 'count': np.array([[2]])}
+            executors.write(shared.spec, [(0, (slice(0, 1),), region),
+                                          (2, (slice(0, 1),), region)])
+            arrays = shared.arrays()
+            self.assertEqual(arrays['count'][:, 0, 0].tolist(), [2, 0, 2])
+            self.assertEqual(arrays['max'][2, 0, 0], 5)
+            del arrays
+        finally:
+            shared.close()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
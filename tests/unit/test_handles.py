@@ -0,0 +1,130 @@
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage.handles import DatasetPool, netcdf_lock
+
+
+class TestDatasetPool(unittest.TestCase):
+    """Test the pool of open netCDF datasets."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filenames = []
+        for i in range(3):
+            filename = str(Path(self.tempdir.name) / f'test{i}.nc')
+            with netCDF4.Dataset(filename, 'w') as ds:
+                ds.createDimension('x', 10)
+                grp = ds.createGroup('forecast')
+                var = grp.createVariable('tas', 'f4', ('x',),
+                                         chunksizes=(5,), fill_value=-1)
+                var[...] = np.arange(10) + i
+            self.filenames.append(filename)
+        self.pool = DatasetPool(max_open=2)
+
+    def test_reuse(self):
+        for _ in range(3):
+            with self.pool.dataset(self.filenames[0]) as nc:
+                self.assertEqual(nc['forecast/tas'][3], 3)
+        self.assertEqual((self.pool.misses, self.pool.hits), (1, 2))
+
+    def test_lru(self):
+        """The least recently used handle is closed first."""
+        for i in (0, 1, 0, 2):
+            with self.pool.dataset(self.filenames[i]):
+                pass
+        self.assertEqual(len(self.pool), 2)
+        with self.pool.dataset(self.filenames[0]):
+            pass
+        self.assertEqual(self.pool.misses, 3)
+
+    def test_max_open(self):
+        """A thread waits for a handle when max_open are in use."""
+        opened = threading.Event()
+
+        def use_third():
+            with self.pool.dataset(self.filenames[2]):
+                opened.set()
+
+        with self.pool.dataset(self.filenames[0]), \
+                self.pool.dataset(self.filenames[1]):
+            thread = threading.Thread(target=use_third)
+            thread.start()
+            self.assertFalse(opened.wait(0.1))
+        thread.join(5)
+        self.assertTrue(opened.is_set())
+        self.assertEqual(len(self.pool), 2)
+
+    def test_wait_without_lock(self):
+        """A thread waiting for a handle doesn't stop one being returned."""
+        holding = threading.Event()
+        values = []
+
+        def nested():
+            with self.pool.dataset(self.filenames[0]):
+                holding.set()
+                # waits for the main thread's handle
+                with self.pool.dataset(self.filenames[2]) as nc, \
+                        netcdf_lock:
+                    values.append(int(nc['forecast/tas'][0]))
+
+        with self.pool.dataset(self.filenames[1]) as nc:
+            thread = threading.Thread(target=nested, daemon=True)
+            thread.start()
+            self.assertTrue(holding.wait(5))
+            time.sleep(0.05)
+            with netcdf_lock:
+                values.append(int(nc['forecast/tas'][0]))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(values, [1, 2])
+
+    def test_threads(self):
+        def read(i):
+            with self.pool.dataset(self.filenames[i % 3]) as nc, \
+                    netcdf_lock:
+                return int(nc['forecast/tas'][9])
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(read, range(60)))
+        self.assertEqual(results, [9 + i % 3 for i in range(60)])
+        self.assertLessEqual(len(self.pool), 2)
+
+    def test_metadata(self):
+        metadata = self.pool.metadata(self.filenames[1], 'tas',
+                                      group=['forecast'])
+        self.assertEqual(metadata.shape, (10,))
+        self.assertEqual(metadata.chunk_shape, (5,))
+        self.assertEqual(metadata.missing.fill_value, -1)
+        self.assertFalse(metadata.packed)
+        self.assertIs(self.pool.metadata(self.filenames[1], 'tas',
+                                         group=['forecast']), metadata)
+
+        # the file changes, so is read again
+        self.pool.close()
+        time.sleep(0.01)
+        with netCDF4.Dataset(self.filenames[1], 'a') as ds:
+            ds['forecast/tas'].scale_factor = 2.
+        metadata = self.pool.metadata(self.filenames[1], 'tas',
+                                      group=['forecast'])
+        self.assertTrue(metadata.packed)
+
+    def test_missing_file(self):
+        with self.assertRaises(OSError):
+            with self.pool.dataset(Path(self.tempdir.name) / 'none.nc'):
+                pass
+        self.assertEqual(len(self.pool), 0)
+
+    def tearDown(self):
+        self.pool.close()
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage.netcdf_array import NetCDFArray
+
+
+class TestNetCDFArray(unittest.TestCase):
+    """Test chunk-wise reads of a netCDF variable."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        self.data = np.random.default_rng(1).random((12, 8, 10),
+                                                    dtype='f4')
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), self.data.shape):
+                ds.createDimension(name, size)
+            var = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                                    chunksizes=(6, 4, 5))
+            var[...] = self.data
+        self.array = NetCDFArray(filename=self.filename, ncvar='tas',
+                                 dtype=self.data.dtype, ndim=3,
+                                 shape=self.data.shape, size=self.data.size)
+
+    def test_plan(self):
+        plan = self.array.plan((slice(0, 6), slice(None), slice(2, 10)))
+        self.assertEqual(plan.chunk_shape, (6, 4, 5))
+        self.assertEqual(len(plan.full_chunks), 2)
+        self.assertEqual(len(plan.partial_chunks), 2)
+        self.assertFalse(plan.filters['zlib'])
+
+    def test_read(self):
+        indices = (slice(3, 9), 2, slice(2, 9))
+        np.testing.assert_array_equal(self.array[indices],
+                                      self.data[indices])
+
+    def test_max(self):
+        self.array.active_method = 'max'
+        for indices in (Ellipsis, (slice(3, 9), slice(1, 7), slice(2, 9))):
+            partial = self.array[indices]
+            self.assertEqual(partial['max'].shape, (1, 1, 1))
+            self.assertEqual(partial['max'][0, 0, 0],
+                             self.data[indices].max())
+            self.assertEqual(partial['count'][0, 0, 0],
+                             self.data[indices].size)
+
+    def test_axis_partial(self):
+        self.array.active_method = 'sum'
+        self.array.active_axis = (0, 2)
+        indices = (slice(2, 11), [0, 3, 6], slice(1, 10, 2))
+        partial = self.array[indices]
+        np.testing.assert_allclose(
+            partial['sum'], self.data[indices].sum(axis=(0, 2),
+                                                   keepdims=True),
+            rtol=1e-6)
+
+    def test_missing_values(self):
+        """Missing data conventions are read from the variable attributes."""
+        with netCDF4.Dataset(self.filename, 'a') as ds:
+            var = ds.variables['tas']
+            var.missing_value = np.float32(0.5)
+            var.valid_range = np.array([0.1, 0.9], dtype='f4')
+        missing = self.array.missing_values()
+        self.assertEqual(missing.missing_value, np.float32(0.5))
+        self.assertEqual((missing.valid_min, missing.valid_max),
+                         (np.float32(0.1), np.float32(0.9)))
+
+        with netCDF4.Dataset(self.filename) as ds:
+            expected = ds.variables['tas'][...]
+        self.array.active_method = 'mean'
+        partial = self.array[...]
+        self.assertEqual(partial['count'].item(), expected.count())
+        self.assertAlmostEqual(partial['sum'].item(), expected.sum(),
+                               places=2)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
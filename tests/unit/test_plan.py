@@ -0,0 +1,74 @@
+import unittest
+
+import numpy as np
+
+from activestorage.plan import normalise_indices, plan_selection
+
+
+class TestPlan(unittest.TestCase):
+    """Test mapping selections on to storage chunks."""
+
+    def setUp(self):
+        self.data = np.arange(12 * 10 * 9).reshape(12, 10, 9)
+
+    def assemble(self, plan):
+        """Rebuild the selection chunk by chunk from the plan."""
+        out = np.empty(plan.out_shape, dtype=self.data.dtype)
+        for chunk in plan:
+            selection = np.ix_(*[
+                np.arange(s.start, s.stop, s.step)
+                if isinstance(s, slice) else np.atleast_1d(s)
+                for s in chunk.array_selection])
+            values = self.data[selection]
+            values = values.reshape([
+                n for n, s in zip(values.shape, chunk.array_selection)
+                if not isinstance(s, int)])
+            out[np.ix_(*[np.arange(o.start, o.stop)
+                         if isinstance(o, slice) else o
+                         for o in chunk.out_selection])] = values
+        return out
+
+    def test_selections_reassemble(self):
+        """Every selection is exactly covered by its chunks."""
+        for indices in (
+                Ellipsis,
+                (slice(2, 11), slice(None), slice(1, 8)),
+                (slice(1, 12, 5), slice(None, None, 3), 4),
+                (5, [1, 3, 7], slice(None, None, -2)),
+                (slice(3, 3), Ellipsis),
+        ):
+            plan = plan_selection(self.data.shape, (4, 5, 3), indices)
+            np.testing.assert_array_equal(self.assemble(plan),
+                                          self.data[indices])
+            self.assertEqual(plan.nselected, self.data[indices].size)
+
+    def test_full_and_partial(self):
+        plan = plan_selection((12, 10, 9), (4, 5, 3),
+                              (slice(0, 8), slice(0, 10), slice(1, 9)))
+        self.assertEqual(len(plan), 2 * 2 * 3)
+        self.assertEqual(len(plan.full_chunks), 2 * 2 * 2)
+        for chunk in plan.partial_chunks:
+            self.assertEqual(chunk.coords[2], 0)
+            self.assertEqual(chunk.selection[2], slice(1, 3, 1))
+
+    def test_strided_slice_is_never_full(self):
+        plan = plan_selection((8,), (4,), slice(None, None, 2))
+        self.assertEqual(len(plan.partial_chunks), 2)
+
+    def test_contiguous(self):
+        plan = plan_selection((12, 10), (12, 10), (slice(0, 6), 2))
+        self.assertTrue(plan.contiguous)
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(plan.out_shape, (6,))
+
+    def test_bad_indices(self):
+        with self.assertRaises(IndexError):
+            normalise_indices((0, 0, 0), (3, 3))
+        with self.assertRaises(IndexError):
+            normalise_indices(3, (3,))
+        with self.assertRaises(IndexError):
+            normalise_indices((Ellipsis, Ellipsis), (3,))
+
+
+if __name__ == "__main__":
+    unittest.main()
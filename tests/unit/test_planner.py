@@ -0,0 +1,94 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage.active import load
+from activestorage.planner import CostModel, Planner, Work
+
+
+class TestPlanner(unittest.TestCase):
+    """Test the choice between reducing next to the data and here."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        self.data = np.random.default_rng(24).random((24, 20, 30),
+                                                     dtype='f4')
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), self.data.shape):
+                ds.createDimension(name, size)
+            ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                              zlib=True, chunksizes=(6, 10, 10),
+                              )[...] = self.data
+        # a slow network to the storage, and a fast server
+        self.model = CostModel(bandwidth=1e7, latency=1e-3, decode_rate=1e8,
+                               startup=1e-3, workers=4)
+
+    def test_work(self):
+        decision = Planner(self.model).plan(
+            self.filename, 'tas', 'mean', (slice(0, 6), slice(0, 15)),
+            axis='time')
+        work = decision.work
+        self.assertEqual((work.chunks, work.full), (6, 3))
+        self.assertEqual(work.decoded, 6 * 6 * 10 * 10 * 4)
+        # random floats compress a little
+        self.assertLess(work.stored, work.decoded)
+        # a float32 sum and an intp count for each of 15 x 30 cells
+        self.assertEqual(work.returned, 15 * 30 * (4 + 8))
+
+    def test_choice(self):
+        """Tiny selections are read here, large ones reduced remotely."""
+        planner = Planner(self.model)
+        tiny = Work(chunks=1, full=0, stored=4000, decoded=4000,
+                    returned=16)
+        large = Work(chunks=1000, full=1000, stored=10**9,
+                     decoded=2 * 10**9, returned=16)
+        self.assertFalse(planner.decide(tiny, 'server', 64).active)
+        decision = planner.decide(large, 'server', 64)
+        self.assertTrue(decision.active)
+        self.assertEqual(decision.route, 'server')
+        self.assertIn('to reduce locally', decision.reason)
+
+        # unless the server is too busy
+        planner.model.storage_load = 1
+        decision = planner.decide(large, 'server', 64)
+        self.assertFalse(decision.active)
+        self.assertEqual(decision.route, 'read')
+        self.assertEqual(list(planner.decisions)[-1], decision)
+
+    def test_observe(self):
+        """Measured times correct later estimates of the same route."""
+        planner = Planner(self.model, smoothing=0.5)
+        work = Work(chunks=4, full=4, stored=10**6, decoded=10**6,
+                    returned=16)
+        decision = planner.decide(work, 'chunks')
+        self.assertTrue(decision.active)
+        planner.observe(decision, 4 * decision.estimates['active'])
+        self.assertEqual(planner.corrections, {'chunks': 2.5})
+        again = planner.decide(work, 'chunks')
+        self.assertAlmostEqual(again.estimates['active'],
+                               2.5 * decision.estimates['active'])
+
+    def test_load(self):
+        """``active='auto'`` gives the answer of either way."""
+        # decoding is slow, so is worth doing in parallel
+        planner = Planner(CostModel(decode_rate=1e6, workers=4))
+        for indices in ((slice(0, 1), slice(0, 2), slice(0, 1)), Ellipsis):
+            result = load(self.filename, 'tas', 'max', indices=indices,
+                          axis='lat', active='auto', cache=False,
+                          planner=planner)
+            np.testing.assert_array_equal(result,
+                                          self.data[indices].max(axis=1))
+            self.assertIsNotNone(planner.decisions[-1].elapsed)
+        self.assertEqual([d.active for d in planner.decisions],
+                         [False, True])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
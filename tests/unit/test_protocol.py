@@ -0,0 +1,65 @@
+import pickle
+import unittest
+
+import numpy as np
+
+from activestorage import protocol
+from activestorage.reductions import MissingValues, partial_reduce
+
+
+class TestProtocol(unittest.TestCase):
+    """Test the binary encoding of requests and partial results."""
+
+    def test_round_trip(self):
+        document = {'path': 'tas.nc', 'offset': 2**40, 'big': 2**64 - 1,
+                    'scale': 0.5, 'axis': [0, 2], 'missing': None,
+                    'flags': [True, False], 'raw': b'\x00\xff',
+                    'name': 'température'}
+        self.assertEqual(protocol.loads(protocol.dumps(document)), document)
+
+    def test_partial_is_zero_copy(self):
+        """Arrays are read-only views of the received bytes."""
+        data = np.random.default_rng(23).random((4, 6, 5)).astype('>f4')
+        partial = partial_reduce(data, 'var', axis=(0, 2))
+        body = protocol.dumps({'partial': protocol.encode_partial(partial)})
+        decoded = protocol.decode_partial(protocol.loads(body)['partial'])
+        self.assertEqual(decoded.keys(), partial.keys())
+        for field, values in decoded.items():
+            np.testing.assert_array_equal(values, partial[field])
+            self.assertEqual(values.dtype, partial[field].dtype)
+            self.assertFalse(values.flags.writeable)
+            self.assertEqual(values.ctypes.data % values.dtype.alignment, 0)
+
+        # much smaller than JSON for large partials
+        self.assertLess(len(body), sum(
+            len(repr(values.tolist())) for values in partial.values()))
+
+    def test_missing(self):
+        missing = MissingValues(fill_value=np.float32(1e20), valid_max=50)
+        decoded = protocol.decode_missing(protocol.loads(protocol.dumps(
+            protocol.encode_missing(missing))))
+        self.assertEqual(decoded.fill_value, np.float32(1e20))
+        self.assertEqual(decoded.valid_max, 50)
+
+    def test_refused(self):
+        """Objects can't be sent, and nothing is unpickled."""
+        with self.assertRaises(TypeError):
+            protocol.dumps({'partial': np.array([object()])})
+        with self.assertRaises(TypeError):
+            protocol.dumps({'function': len})
+        for data in (pickle.dumps({'requests': []}), b'ASW\x09N',
+                     protocol.dumps({'x': np.arange(9)})[:-8]):
+            with self.assertRaises(ValueError):
+                protocol.loads(data)
+
+        # an object dtype smuggled into an array header
+        body = protocol.dumps({'x': np.arange(2.)}).replace(b'<f8', b'|O8')
+        with self.assertRaises(ValueError):
+            protocol.loads(body)
+
+    def test_json(self):
+        self.assertEqual(protocol.loads(b'{"requests": []}'), {'requests': []})
+
+
+if __name__ == "__main__":
+    unittest.main()
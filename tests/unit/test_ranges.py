@@ -0,0 +1,180 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from activestorage import stats
+from activestorage.ranges import (
+    coalesce,
+    gather_rows,
+    read_ranges,
+    read_rows,
+    selection_rows,
+)
+from activestorage.storage import (
+    hyperslab,
+    memmap_hyperslab,
+    read_hyperslab,
+)
+
+
+class TestRanges(unittest.TestCase):
+    """Test the merging and reading of many byte ranges."""
+
+    def setUp(self):
+        self.file = tempfile.TemporaryFile()
+        self.data = np.arange(40 * 30 * 50, dtype='f4').reshape(40, 30, 50)
+        self.file.write(b'header' + self.data.tobytes())
+        self.file.flush()
+
+    def test_coalesce(self):
+        starts, stops, group = coalesce([300, 0, 100, 120, 1000],
+                                        [50, 100, 50, 10, 10], gap=150)
+        self.assertEqual(starts.tolist(), [0, 1000])
+        self.assertEqual(stops.tolist(), [350, 1010])
+        self.assertEqual(group.tolist(), [0, 0, 0, 0, 1])
+
+        # touching ranges are merged even with no gap, up to max_size
+        starts, stops, group = coalesce([0, 10, 20, 30], [10] * 4, gap=0,
+                                        max_size=25)
+        self.assertEqual(starts.tolist(), [0, 20])
+        self.assertEqual(stops.tolist(), [20, 40])
+        self.assertEqual(group.tolist(), [0, 0, 1, 1])
+
+        # a range larger than max_size is read whole
+        starts, stops, _ = coalesce([0, 10], [100, 5], max_size=50)
+        self.assertEqual((starts.tolist(), stops.tolist()),
+                         ([0, 10], [100, 15]))
+
+        self.assertEqual(coalesce([], [])[0].size, 0)
+
+    def test_read_ranges(self):
+        offsets = [6 + 4000, 6, 6 + 40, 6 + 100000]
+        sizes = [100, 20, 20, 8]
+        request = stats.RequestStats('max', 'test.nc', 'x')
+        data = list(read_ranges(self.file, offsets, sizes, gap=1000,
+                                stats=request))
+        raw = b'header' + self.data.tobytes()
+        # in file order
+        self.assertEqual([k for k, _ in data], [1, 2, 0, 3])
+        self.assertEqual({k: bytes(d) for k, d in data},
+                         {k: raw[o:o + n]
+                          for k, (o, n) in enumerate(zip(offsets, sizes))})
+        # the 20 bytes between the second and third ranges are read too
+        self.assertEqual(request.bytes_read, 100 + 60 + 8)
+
+        # reads are no larger than max_size, unless one range is
+        reads = []
+        with mock.patch('activestorage.ranges.read_into',
+                        side_effect=lambda fd, b, o: reads.append(len(b))):
+            list(read_ranges(self.file, [0, 40, 80, 120], [40, 40, 40, 400],
+                             max_size=100))
+        self.assertEqual(reads, [80, 40, 400])
+
+    def test_selection_rows(self):
+        itemsize = self.data.itemsize
+        selection = (np.array([3, 1]), 2, slice(0, 50, 7))
+        rows, per_row = selection_rows(6, self.data.shape, selection,
+                                       itemsize)
+        self.assertEqual(per_row, 1)
+        starts, stops, group = coalesce(rows, np.full(rows.size, itemsize),
+                                        gap=64)
+        buffers = [os.pread(self.file.fileno(), stop - start, start)
+                   for start, stop in zip(starts, stops)]
+        out = np.empty(rows.size, dtype='f4')
+        gather_rows(buffers, starts, group, rows, per_row, out)
+        np.testing.assert_array_equal(
+            out.reshape(2, 8), self.data[[3, 1], 2, ::7])
+
+    def test_read_rows(self):
+        """Rows are read in order, a bounded merged range at a time."""
+        selection = (np.array([30, 2, 3]), slice(0, 30, 4), slice(5, 9, 1))
+        rows, per_row = selection_rows(6, self.data.shape, selection,
+                                       self.data.itemsize)
+        for gap, max_size in ((0, None), (1 << 20, None), (1 << 20, 9000)):
+            reads = []
+
+            def read_into(fd, buffer, offset):
+                reads.append(buffer.nbytes)
+                return os.preadv(fd, [buffer], offset)
+
+            request = stats.RequestStats('max', 'test.nc', 'x')
+            with mock.patch('activestorage.ranges.read_into', read_into):
+                result = read_rows(self.file, rows, per_row, 'f4', gap=gap,
+                                   max_size=max_size, stats=request)
+            np.testing.assert_array_equal(
+                result.reshape(3, 8, 4), self.data[[30, 2, 3], ::4, 5:9])
+            self.assertEqual(request.bytes_read, sum(reads))
+            if not gap:
+                self.assertEqual(len(reads), rows.size)
+            if max_size:
+                self.assertLessEqual(max(reads), max_size)
+
+    def test_read_hyperslab(self):
+        """Hyperslabs match numpy, whether rows are merged or not."""
+        for start, count, stride in (((0, 0, 0), None, None),
+                                     ((3, 2, 1), (5, 4, 30), (7, 3, 1)),
+                                     ((1, 0, 5), (20, 30, 9), (2, 1, 5)),
+                                     ((39, 29, 49), (1, 1, 1), None)):
+            expected = self.data[hyperslab(self.data.shape, start, count,
+                                           stride)]
+            for gap in (0, 64, 1 << 20):
+                request = stats.RequestStats('max', 'test.nc', 'x')
+                result = read_hyperslab(self.file, 6, self.data.shape,
+                                        start, count, stride, gap=gap,
+                                        request=request)
+                np.testing.assert_array_equal(result, expected,
+                                              err_msg=f"{stride} {gap}")
+                self.assertGreaterEqual(request.bytes_read, expected.nbytes)
+                if not gap and (stride is None or stride[-1] == 1):
+                    self.assertEqual(request.bytes_read, expected.nbytes)
+
+    def test_read_hyperslab_gather(self):
+        """Merged ranges of too many rows to scatter are gathered."""
+        with mock.patch('os.sysconf', return_value=4):
+            for start, stride in (((0, 0, 1), (1, 1, 2)),
+                                  ((1, 3, 2), (3, 4, 1))):
+                result = read_hyperslab(self.file, 6, self.data.shape,
+                                        start, None, stride, max_size=5000)
+                np.testing.assert_array_equal(
+                    result, self.data[hyperslab(self.data.shape, start,
+                                                None, stride)])
+
+    def test_read_hyperslab_bounded(self):
+        """No read is larger than max_size, or than the result."""
+        reads = []
+
+        def read_into(fd, buffer, offset):
+            reads.append((isinstance(buffer, np.ndarray), len(buffer)))
+            return os.preadv(fd, [buffer], offset)
+
+        with mock.patch('activestorage.storage.read_into', read_into):
+            result = read_hyperslab(self.file, 6, self.data.shape,
+                                    max_size=10000)
+            np.testing.assert_array_equal(result, self.data)
+            # a whole slab is read in place, in pieces
+            self.assertEqual(sum(n for _, n in reads), self.data.nbytes)
+            self.assertFalse(any(buffered for buffered, _ in reads))
+
+            reads.clear()
+            result = read_hyperslab(self.file, 6, self.data.shape,
+                                    stride=(1, 1, 2), max_size=10000)
+            np.testing.assert_array_equal(result, self.data[..., ::2])
+            self.assertLessEqual(max(n for _, n in reads), 10000)
+
+        # rows longer than max_size are mapped
+        with mock.patch('activestorage.storage.memmap_hyperslab',
+                        wraps=memmap_hyperslab) as mapped:
+            result = read_hyperslab(self.file, 6, (self.data.size,), (1,),
+                                    None, (3,), max_size=100)
+        np.testing.assert_array_equal(result, self.data.ravel()[1::3])
+        mapped.assert_called_once()
+
+    def tearDown(self):
+        self.file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,251 @@
+import unittest
+
+import numpy as np
+
+from activestorage import reductions
+from activestorage.reductions import (
+    MOMENTS,
+    OPERATIONS,
+    MissingValues,
+    as_array,
+    empty_partial,
+    finalise,
+    merge_into,
+    merge_partials,
+    partial_reduce,
+    reduce_array,
+    reduce_bytes,
+    reduce_partial,
+)
+
+from .reference import reference
+
+NUMERIC_DTYPES = ('i1', 'u1', 'i2', 'u2', 'i4', 'u4', 'i8', 'u8',
+                  'f2', 'f4', 'f8')
+
+
+class TestReductions(unittest.TestCase):
+    """Test the vectorised reduction engine."""
+
+    def test_as_array_is_zero_copy(self):
+        """The view shares memory with the buffer it was made from."""
+        buffer = bytearray(np.arange(4, dtype='f4').tobytes())
+        view = as_array(buffer, 'f4')
+        buffer[:4] = np.float32(42).tobytes()
+        self.assertEqual(view[0], 42)
+
+    def test_as_array_offset_and_count(self):
+        buffer = np.arange(10, dtype='i2').tobytes()
+        view = as_array(buffer, 'i2', count=3, offset=4)
+        np.testing.assert_array_equal(view, [2, 3, 4])
+
+    def test_all_dtypes_and_operations(self):
+        """Every operation agrees with numpy for every numeric dtype."""
+        for dtype in NUMERIC_DTYPES:
+            data = np.arange(1, 101).astype(dtype)
+            expected = {'sum': data.sum(), 'mean': data.mean(),
+                        'min': data.min(), 'max': data.max(),
+                        'count': data.size}
+            for op in OPERATIONS:
+                result = reduce_bytes(data.tobytes(), dtype, op)
+                if op in MOMENTS:
+                    self.assertAlmostEqual(result, reference(op, data),
+                                           msg=(dtype, op))
+                else:
+                    self.assertEqual(result, expected[op], (dtype, op))
+
+    def test_merge_partials(self):
+        """Partial results of pieces merge to the result of the whole."""
+        data = np.arange(1, 101, dtype='i2')
+        for op in OPERATIONS:
+            partials = [partial_reduce(piece, op)
+                        for piece in np.array_split(data, 7)]
+            result = finalise(merge_partials(partials, op), op)
+            self.assertAlmostEqual(result.item(), reduce_array(data, op),
+                                   msg=op)
+
+    def test_axis_partials(self):
+        """Blocks laid side by side reduce along the requested axes."""
+        data = np.random.default_rng(2).random((6, 4, 5))
+        for op in OPERATIONS:
+            for axis in (0, (0, 2)):
+                blocks = [partial_reduce(data[i:i + 2], op, axis=axis)
+                          for i in range(0, 6, 2)]
+                stacked = {field: np.concatenate([b[field] for b in blocks])
+                           for field in blocks[0]}
+                result = finalise(reduce_partial(stacked, op, axis=0), op)
+                expected = finalise(partial_reduce(data, op, axis=axis), op)
+                np.testing.assert_allclose(result, expected)
+                self.assertEqual(result.shape, np.sum(
+                    data, axis=axis, keepdims=True).shape)
+
+    def test_merge_into(self):
+        data = np.arange(12.).reshape(3, 4)
+        target = empty_partial('max', (1, 4), data.dtype)
+        merge_into(target, partial_reduce(data[:, :2], 'max', axis=0),
+                   'max', (slice(None), slice(0, 2)))
+        merge_into(target, partial_reduce(data[:, 2:], 'max', axis=0),
+                   'max', (slice(None), slice(2, 4)))
+        np.testing.assert_array_equal(finalise(target, 'max'),
+                                      [[8, 9, 10, 11]])
+
+    def test_moments(self):
+        """Moments merge stably, in any grouping, far from zero."""
+        rng = np.random.default_rng(20)
+        data = (1e5 + rng.standard_normal((40, 3))).astype('f4')
+        expected = {op: reference(op, data, 0) for op in MOMENTS}
+        for sizes in ((1, 39), (7, 7, 7, 19), (20, 20)):
+            pieces = np.split(data, np.cumsum(sizes)[:-1])
+            for op in MOMENTS:
+                partials = [partial_reduce(piece, op, axis=0)
+                            for piece in pieces]
+                self.assertEqual(partials[0]['m2'].dtype, np.float64)
+                result = finalise(merge_partials(partials, op), op)
+                np.testing.assert_allclose(result.ravel(), expected[op],
+                                           rtol=1e-9, err_msg=f"{op}")
+
+        # weighted, with zero weights left out
+        weights = rng.random(40)
+        weights[::5] = 0
+        valid = weights != 0
+        x, w = data[valid].astype('f8'), weights[valid][:, None]
+        mean = (x * w).sum(axis=0) / w.sum()
+        partials = [partial_reduce(data[i:i + 8], 'var', axis=0,
+                                   weights=weights[i:i + 8, None])
+                    for i in range(0, 40, 8)]
+        np.testing.assert_allclose(
+            finalise(merge_partials(partials, 'var'), 'var').ravel(),
+            (w * (x - mean)**2).sum(axis=0) / w.sum(), rtol=1e-9)
+
+    def test_sketches(self):
+        """Histograms and threshold counts are exact, quantiles close."""
+        rng = np.random.default_rng(21)
+        data = np.ma.masked_greater(rng.gamma(2., size=(4, 5000)), 9)
+        valid = data.compressed()
+        pieces = [data[:, i:i + 700] for i in range(0, 5000, 700)]
+
+        op = 'histogram(0, 8, 16)'
+        result = finalise(merge_partials(
+            [partial_reduce(p, op, axis=1) for p in pieces], op), op)
+        self.assertEqual(result.shape, (4, 1, 16))
+        np.testing.assert_array_equal(
+            result.sum(axis=0)[0], np.histogram(valid, 16, (0, 8))[0])
+
+        for op, expected in (('count_above(3)', np.sum(valid > 3)),
+                             ('count_below(0.5)', np.sum(valid < 0.5))):
+            self.assertEqual(reduce_array(data, op), expected)
+
+        for q in (0.01, 0.5, 0.95, 0.999):
+            op = f'quantile({q})'
+            partials = [partial_reduce(p, op, axis=1) for p in pieces]
+            # a fixed size, whatever the size of the data
+            self.assertEqual(partials[0]['centroids'].nbytes,
+                             partials[-1]['centroids'].nbytes)
+            result = finalise(merge_partials(partials, op), op).ravel()
+            for row, value in zip(data, result):
+                rank = np.mean(row.compressed() < value)
+                self.assertAlmostEqual(rank, q, delta=0.005, msg=op)
+
+        # quantiles of a few values are numpy's (hazen) quantiles
+        x = rng.random(30)
+        self.assertAlmostEqual(reduce_array(x, 'quantile(0.3)'),
+                               np.quantile(x, 0.3, method='hazen'))
+
+        for op in ('quantile', 'quantile(2)', 'histogram(1, 0, 3)',
+                   'count_above(x)'):
+            with self.assertRaises(ValueError):
+                reduce_array(x, op)
+
+    def test_masked(self):
+        """Masked values are ignored, and reductions of nothing masked."""
+        data = np.ma.masked_greater(np.arange(6.).reshape(2, 3), 2)
+        for op, expected in (('sum', [3., np.ma.masked]),
+                             ('mean', [1., np.ma.masked]),
+                             ('max', [2., np.ma.masked]),
+                             ('count', [3, 0])):
+            result = finalise(partial_reduce(data, op, axis=1), op)
+            self.assertEqual(result.ravel().tolist(),
+                             np.ma.array(expected, dtype=float).tolist(), op)
+
+        # nothing masked, as netCDF4 returns data without missing values
+        data = np.ma.masked_array(np.arange(6.))
+        self.assertEqual(finalise(partial_reduce(data, 'sum'), 'sum'), 15.)
+
+    def test_weighted(self):
+        """Weights broadcast, and zero weights are left out."""
+        data = np.arange(12.).reshape(2, 2, 3)
+        data[1, 0, 0] = -999
+        missing = MissingValues(fill_value=-999.)
+        weights = np.array([[1., 2., 0.], [0.5, 0.5, 0.5]])
+        valid = (data != -999) & (weights != 0)
+        for op in ('sum', 'mean', 'min', 'max', 'count'):
+            parts = [partial_reduce(data[i:i + 1], op, axis=(0, 2),
+                                    missing=missing, weights=weights)
+                     for i in range(2)]
+            result = finalise(merge_partials(parts, op), op).ravel()
+            values = np.ma.masked_where(~valid, data)
+            w = np.ma.masked_where(~valid, np.broadcast_to(weights,
+                                                           data.shape))
+            expected = {
+                'sum': (values * w).sum(axis=(0, 2)),
+                'mean': (values * w).sum(axis=(0, 2)) / w.sum(axis=(0, 2)),
+                'min': values.min(axis=(0, 2)),
+                'max': values.max(axis=(0, 2)),
+                'count': values.count(axis=(0, 2)),
+            }[op]
+            np.testing.assert_allclose(result, expected, err_msg=op)
+
+    def test_missing_values(self):
+        """Missing values are ignored without making a masked array."""
+        data = np.arange(-5., 20.).reshape(5, 5)
+        data[1, 1] = -999.
+        data[3] = np.nan
+        missing = MissingValues(fill_value=-999., missing_value=np.nan,
+                                valid_min=-2., valid_max=18.)
+        expected = np.ma.masked_where(~missing.valid(data), data)
+        self.assertEqual(np.ma.count(expected), 15)
+        for op in OPERATIONS:
+            for axis in (None, 0, 1):
+                result = finalise(
+                    partial_reduce(data, op, axis=axis, missing=missing), op)
+                np.testing.assert_allclose(
+                    np.ma.filled(result.squeeze(), -1),
+                    np.ma.filled(reference(op, expected, axis), -1),
+                    rtol=1e-12 if op in MOMENTS else 0,
+                    err_msg=f"{op} {axis}")
+
+    def test_missing_values_blocks(self):
+        """Results don't depend on how the data are split into blocks."""
+        data = np.random.default_rng(4).integers(0, 10, (300, 7, 50))
+        missing = MissingValues(fill_value=3, valid_max=8)
+        expected = np.ma.masked_where((data == 3) | (data > 8), data)
+        old_block_size = reductions.BLOCK_SIZE
+        try:
+            for block_size in (1, 1000, 1 << 20):
+                reductions.BLOCK_SIZE = block_size
+                result, count = reduce_array(data, 'sum', missing=missing,
+                                             return_count=True)
+                self.assertEqual(result, expected.sum())
+                self.assertEqual(count, expected.count())
+                result = finalise(partial_reduce(data, 'max', axis=(0, 2),
+                                                 missing=missing), 'max')
+                np.testing.assert_array_equal(
+                    result.ravel(), expected.max(axis=(0, 2)))
+        finally:
+            reductions.BLOCK_SIZE = old_block_size
+
+    def test_all_missing(self):
+        data = np.full(4, -1., dtype='f4')
+        result, count = reduce_array(data, 'max',
+                                     missing=MissingValues(fill_value=-1.),
+                                     return_count=True)
+        self.assertIs(result, np.ma.masked)
+        self.assertEqual(count, 0)
+
+    def test_unknown_operation(self):
+        with self.assertRaises(NotImplementedError):
+            reduce_array(np.arange(3), 'median')
+
+
+if __name__ == "__main__":
+    unittest.main()
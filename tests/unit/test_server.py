@@ -0,0 +1,244 @@
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from pathlib import Path
+
+import dask
+import netCDF4
+import numpy as np
+
+from activestorage import stats as _stats
+from activestorage.chunks import StorageLayout
+from activestorage.client import ActiveStorageClient, ActiveStorageError
+from activestorage.dask_reduction import active_reduction
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.plan import plan_selection
+from activestorage.reductions import OPERATIONS, MissingValues, finalise
+from activestorage.server import ActiveStorageServer, execute
+from activestorage.stats import RequestStats
+from activestorage.storage import do_operation, raw_write
+
+from .reference import reference
+
+
+class TestServer(unittest.TestCase):
+    """Test the local active storage server and its client."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dummydir = Path(self.tempdir.name)
+        self.dummyfile = self.dummydir / 'dummy.data'
+        self.data = [float(i) for i in range(12)]
+        with open(self.dummyfile, 'wb') as f:
+            raw_write(f, self.data)
+
+        self.server = ActiveStorageServer(root=self.dummydir)
+        self.server.start()
+        self.client = ActiveStorageClient(self.server.url)
+
+    def test_compare_active(self):
+        """The server agrees with a local read for every operation."""
+        for op in OPERATIONS:
+            answers = []
+            for client in (None, self.client):
+                with open(self.dummyfile, 'rb') as f:
+                    f.is_active = client is not None
+                    f.active_client = client
+                    answers.append(do_operation(
+                        f, 8, 6, op, missing=MissingValues(fill_value=4.)))
+            self.assertEqual(answers[0], answers[1], op)
+
+        stats = self.client.last_stats
+        self.assertEqual(stats['bytes_read'], 24)
+        self.assertGreater(stats['bytes_received'], 0)
+        self.assertGreater(stats['latency'], 0)
+
+    def test_threads(self):
+        """Threads sharing a client each count their own request."""
+        def reduce(n):
+            for _ in range(4):
+                with open(self.dummyfile, 'rb') as f:
+                    f.is_active = True
+                    f.active_client = self.client
+                    do_operation(f, 0, n, 'max')
+
+        def slow_finalise(partial, op):
+            # let other threads' round trips finish in the meantime
+            time.sleep(0.1)
+            return finalise(partial, op)
+
+        _stats.collector().reset()
+        threads = [threading.Thread(target=reduce, args=(n,))
+                   for n in range(1, 9)]
+        with mock.patch('activestorage.client.finalise', slow_finalise):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(
+            sorted(r.bytes_read for r in _stats.collector().requests),
+            sorted(4 * n for n in range(1, 9) for _ in range(4)))
+
+    def test_hyperslab(self):
+        with open(self.dummyfile, 'rb') as f:
+            f.is_active = True
+            f.active_client = self.client
+            ans = do_operation(f, 0, None, 'max', shape=(3, 4),
+                               start=(0, 0), count=(2, 2), stride=(2, 1))
+        self.assertEqual(ans, 9.)
+
+    def test_chunks(self):
+        """Stored netCDF4 chunks are decoded and reduced by the server."""
+        filename = self.dummydir / 'test.nc'
+        data = np.arange(60, dtype='f4').reshape(6, 10)
+        with netCDF4.Dataset(filename, 'w') as ds:
+            ds.createDimension('y', 6)
+            ds.createDimension('x', 10)
+            ds.createVariable('v', 'f4', ('y', 'x'), zlib=True, shuffle=True,
+                              chunksizes=(3, 4))[...] = data
+        layout = StorageLayout.from_file(filename, 'v')
+        chunks = []
+        for coords in ((0, 0), (1, 2)):
+            offset, size, filter_mask = layout.chunks[coords]
+            chunks.append({'offset': offset, 'size': size,
+                           'filter_mask': filter_mask,
+                           'selection': [[0, 3, 1], [1, 2, 1]]})
+        partial = self.client.reduce({
+            'path': 'test.nc', 'dtype': '<f4', 'op': 'sum',
+            'chunks': chunks, 'chunk_shape': [3, 4],
+            'filters': layout.filters,
+        })
+        self.assertEqual(finalise(partial, 'sum').item(),
+                         data[0:3, 1].sum() + data[3:6, 9].sum())
+
+    def test_contiguous(self):
+        """Only the selection of a contiguous variable is read."""
+        filename = self.dummydir / 'flat.nc'
+        data = np.arange(100 * 1000, dtype='f4').reshape(100, 1000)
+        with netCDF4.Dataset(filename, 'w') as ds:
+            ds.createDimension('y', 100)
+            ds.createDimension('x', 1000)
+            ds.createVariable('v', 'f4', ('y', 'x'),
+                              contiguous=True)[...] = data
+        layout = StorageLayout.from_file(filename, 'v')
+        for indices, axis in (((slice(0, 1), slice(0, 10)), (0, 1)),
+                              ((slice(5, 50, 7), 3), ()),
+                              ((slice(2, 4), slice(10, 990, 2)), (1,)),
+                              (([4, 1], slice(0, 3)), (0,))):
+            plan = plan_selection(layout.shape, layout.shape, indices,
+                                  dtype=layout.dtype)
+            stats = RequestStats()
+            partial = self.client.reduce_chunks(str(filename), layout, plan,
+                                                'max', axis, stats=stats)
+            expected = data[indices].max(axis=axis, keepdims=True)
+            np.testing.assert_array_equal(finalise(partial, 'max'), expected)
+            if indices == (slice(0, 1), slice(0, 10)):
+                self.assertEqual(stats.bytes_read, 40)
+        # an integer array index reads only its rows, and between them
+        self.assertEqual(stats.bytes_read, (3 * 1000 + 3) * 4)
+
+    def test_chunk_requests(self):
+        """The stored chunks of a selection go in one request."""
+        filename = self.dummydir / 'chunked.nc'
+        data = np.arange(12 * 10, dtype='f4').reshape(12, 10)
+        with netCDF4.Dataset(filename, 'w') as ds:
+            ds.createDimension('y', 12)
+            ds.createDimension('x', 10)
+            ds.createVariable('v', 'f4', ('y', 'x'), zlib=True,
+                              chunksizes=(3, 4))[:9] = data[:9]
+        data[9:] = netCDF4.default_fillvals['f4']
+        layout = StorageLayout.from_file(filename, 'v')
+        for indices, axis in (((slice(1, 11), [8, 0, 3]), (0,)),
+                              ((slice(None), slice(2, 9, 3)), (0, 1)),
+                              ((5, slice(None)), ())):
+            plan = plan_selection(layout.shape, layout.chunk_shape, indices,
+                                  dtype=layout.dtype)
+            for op in ('max', 'var'):
+                with mock.patch('activestorage.server.execute',
+                                wraps=execute) as requests:
+                    partial = self.client.reduce_chunks(str(filename),
+                                                        layout, plan, op,
+                                                        axis)
+                self.assertEqual(requests.call_count, 1)
+                expected = reference(op, data[indices], axis)
+                np.testing.assert_allclose(
+                    finalise(partial, op).reshape(np.shape(expected)),
+                    expected, rtol=1e-6, err_msg=f"{indices} {op}")
+
+    def test_batching(self):
+        """Queued requests are sent in batches and fanned back out."""
+        client = ActiveStorageClient(self.server.url, batch_size=4,
+                                     flush_interval=0.01)
+        futures = [client.submit({'path': 'dummy.data', 'dtype': '<f4',
+                                  'op': 'max', 'offset': 4 * i, 'size': 4})
+                   for i in range(10)]
+        answers = [finalise(f.result(), 'max').item() for f in futures]
+        self.assertEqual(answers, self.data[:10])
+        # two full batches, then the last two at the deadline
+        self.assertEqual(client.round_trips, 3)
+
+        bad = client.submit({'path': '/etc/passwd', 'dtype': '<f4',
+                             'op': 'max', 'offset': 0, 'size': 4})
+        with self.assertRaises(ActiveStorageError):
+            bad.result()
+        client.close()
+
+    def test_netcdf_array(self):
+        """Small dask blocks are reduced by the server in few round trips."""
+        filename = self.dummydir / 'tas.nc'
+        data = np.random.default_rng(5).random((12, 8, 10), dtype='f4')
+        data[3, 2:6] = -999
+        data = np.ma.masked_equal(data, -999)
+        with netCDF4.Dataset(filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), data.shape):
+                ds.createDimension(name, size)
+            ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'), zlib=True,
+                              chunksizes=(3, 4, 5), fill_value=-999)[:8] = \
+                data[:8]
+        # the last time steps were never written
+        data[8:] = np.ma.masked
+
+        array = NetCDFArray(filename=str(filename), ncvar='tas', dtype='f4',
+                            shape=data.shape, ndim=3, size=data.size,
+                            active_client=self.client)
+        self.client.batch_size = 8
+        for op, axis in (('mean', None), ('max', (0, 2)), ('sum', 1)):
+            with dask.config.set(scheduler='threads', num_workers=4):
+                result = active_reduction(array, op, axis=axis,
+                                          chunks=(3, 4, 5)).compute()
+            np.testing.assert_allclose(result, getattr(data, op)(axis=axis),
+                                       rtol=1e-6, err_msg=op)
+        # 16 of the 32 chunks are stored, for each of 3 reductions
+        self.assertLess(self.client.round_trips, 48)
+
+    def test_bad_requests(self):
+        """Bad requests are answered with errors, and the server goes on."""
+        request = {'path': 'dummy.data', 'dtype': '<f4', 'op': 'max'}
+        for bad in ({'offset': 0, 'shape': [10, 10], 'count': [5, 20]},
+                    {'chunks': [{'offset': 0, 'size': 48, 'filter_mask': 0,
+                                 'selection': [[0, 12, 1]]}],
+                     'chunk_shape': [12], 'filters': [[1, [4]]]}):
+            with self.assertRaisesRegex(ActiveStorageError, 'answered 400'):
+                self.client.reduce(dict(request, **bad))
+
+        with mock.patch('activestorage.server.execute',
+                        side_effect=RuntimeError("unexpected")):
+            with self.assertRaisesRegex(ActiveStorageError, 'answered 500'):
+                self.client.reduce_range('dummy.data', 0, 4, 'f4', 'max')
+        self.assertEqual(
+            self.client.reduce_range('dummy.data', 0, 48, 'f4', 'max'), 11.)
+
+    def test_outside_root(self):
+        with self.assertRaises(ActiveStorageError):
+            self.client.reduce_range('/etc/passwd', 0, 4, 'f4', 'max')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
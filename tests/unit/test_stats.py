@@ -0,0 +1,90 @@
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage import stats
+from activestorage.netcdf_array import NetCDFArray
+from activestorage.storage import do_operation, raw_write
+
+
+class TestStats(unittest.TestCase):
+    """Test the counts of data moved by each request."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'test.nc')
+        data = np.random.default_rng(4).random((12, 8, 10), dtype='f4')
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), data.shape):
+                ds.createDimension(name, size)
+            ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                              zlib=True, shuffle=True,
+                              chunksizes=(6, 4, 5))[...] = data
+        self.array = NetCDFArray(filename=self.filename, ncvar='tas',
+                                 dtype=data.dtype, ndim=3, shape=data.shape,
+                                 size=data.size)
+        stats.collector().reset()
+
+    def test_chunks(self):
+        self.array.active_method = 'max'
+        self.array[:6, :4]
+        request = stats.collector().requests[-1]
+        self.assertEqual((request.op, request.route), ('max', 'chunks'))
+        self.assertEqual(request.elements, 6 * 4 * 10)
+        self.assertEqual(request.bytes_decompressed, 2 * 6 * 4 * 5 * 4)
+        self.assertGreater(request.bytes_read, 0)
+        # the max and the count
+        self.assertEqual(request.bytes_returned, 4 + 8)
+        self.assertEqual(set(request.timings), {'read', 'decode', 'reduce'})
+
+    def test_read(self):
+        """Unreduced reads move everything."""
+        self.array[...]
+        request = stats.collector().requests[-1]
+        self.assertEqual(request.route, 'read')
+        self.assertEqual(request.reduction_ratio, 1)
+
+    def test_do_operation(self):
+        filename = Path(self.tempdir.name) / 'test.data'
+        with open(filename, 'wb') as f:
+            raw_write(f, range(100))
+        with open(filename, 'rb') as f:
+            for f.is_active in (False, True):
+                do_operation(f, 0, 100, 'sum')
+        summary = stats.collector().summary()
+        self.assertEqual(summary['local']['reduction_ratio'], 1)
+        self.assertEqual(summary['mock']['bytes_read'], 400)
+        self.assertEqual(summary['mock']['reduction_ratio'], 100)
+        self.assertEqual(summary['mock']['elements'], 100)
+
+    def test_log(self):
+        stream = io.StringIO()
+        handler = stats.log_to(stream=stream)
+        try:
+            self.array.active_method = 'sum'
+            self.array[0]
+        finally:
+            stats.logger.removeHandler(handler)
+        record = json.loads(stream.getvalue().splitlines()[-1])
+        self.assertEqual(record['op'], 'sum')
+        self.assertEqual(record['elements'], 80)
+        self.assertGreater(record['reduction_ratio'], 1)
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with stats.record('max', 'x.nc'):
+                raise ValueError("bad")
+        self.assertEqual(stats.collector().requests[-1].error,
+                         "ValueError: bad")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
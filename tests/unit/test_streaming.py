@@ -0,0 +1,148 @@
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from activestorage import stats
+from activestorage.reductions import OPERATIONS, finalise
+from activestorage.streaming import SlabReader
+
+from .reference import reference
+
+
+class TestSlabReader(unittest.TestCase):
+    """Test reading and reducing a variable in slabs."""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = str(Path(self.tempdir.name) / 'tas.nc')
+        data = np.random.default_rng(18).random((20, 6, 8), dtype='f4')
+        data[3] = -999
+        data[11, 1:4, 2] = -999
+        self.data = np.ma.masked_equal(data, -999)
+        with netCDF4.Dataset(self.filename, 'w') as ds:
+            ds.createDimension('time', None)
+            ds.createDimension('lat', 6)
+            ds.createDimension('lon', 8)
+            ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                              chunksizes=(3, 3, 4), fill_value=-999)
+            ds['tas'][...] = self.data
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_slabs(self):
+        """Slabs fit the budget and end at chunk boundaries."""
+        row = 6 * 8 * 5
+        reader = SlabReader(self.filename, 'tas', max_memory=2 * 7 * row)
+        self.assertEqual(reader.slabs,
+                         [(0, 6), (6, 12), (12, 18), (18, 20)])
+        # a chunk thicker than the budget is split
+        reader = SlabReader(self.filename, 'tas', max_memory=2 * 2 * row)
+        self.assertEqual(reader.slabs[:3], [(0, 2), (2, 3), (3, 5)])
+        # a slab is never thinner than a row
+        reader = SlabReader(self.filename, 'tas', max_memory=1)
+        self.assertEqual(len(reader), 20)
+
+    def test_iter(self):
+        for indices in (Ellipsis, (slice(2, 17, 3), 1),
+                        (4, slice(None, None, 2)), ([15, 0, 7, 8],)):
+            reader = SlabReader(self.filename, 'tas', indices,
+                                max_memory=2000)
+            expected = self.data[indices]
+            result = np.ma.masked_all(reader.shape, dtype='f4')
+            for index, slab in reader:
+                result[index] = slab
+            np.testing.assert_array_equal(result, expected)
+            np.testing.assert_array_equal(np.ma.getmaskarray(result),
+                                          np.ma.getmaskarray(expected))
+
+    def test_reductions(self):
+        for indices in (Ellipsis, (slice(2, 17, 3), 1), ([15, 0, 7, 8],)):
+            reader = SlabReader(self.filename, 'tas', indices,
+                                max_memory=2000)
+            data = self.data[indices]
+            for op in OPERATIONS:
+                for axis in (None, 0, -1, (0, 1)):
+                    if axis == (0, 1) and data.ndim < 3:
+                        continue
+                    result = reader.reduce(op, axis=axis)
+                    expected = reference(op, data, axis)
+                    self.assertEqual(np.shape(result), np.shape(expected))
+                    np.testing.assert_allclose(
+                        np.ma.filled(result, np.nan),
+                        np.ma.filled(expected, np.nan), rtol=1e-5,
+                        err_msg=f"{indices} {op} {axis}")
+
+    def test_weighted(self):
+        weights = np.arange(48.).reshape(6, 8)
+        reader = SlabReader(self.filename, 'tas', max_memory=2000)
+        result = reader.reduce('mean', axis=(1, 2), weights=weights)
+        w = np.ma.masked_where(np.ma.getmaskarray(self.data),
+                               np.broadcast_to(weights, self.data.shape))
+        np.testing.assert_allclose(
+            result, (self.data * w).sum(axis=(1, 2)) / w.sum(axis=(1, 2)),
+            rtol=1e-5)
+
+    def test_memory(self):
+        """Reductions, with their temporary memory, fit the budget."""
+        filename = str(Path(self.tempdir.name) / 'thetao.nc')
+        data = np.random.default_rng(18).random((24, 40, 50), dtype='f4')
+        data[5, :10] = -999
+        data = np.ma.masked_equal(data, -999)
+        with netCDF4.Dataset(filename, 'w') as ds:
+            for name, size in zip(('time', 'lat', 'lon'), data.shape):
+                ds.createDimension(name, size)
+            ds.createVariable('thetao', 'f4', ('time', 'lat', 'lon'),
+                              chunksizes=(4, 40, 50), fill_value=-999)
+            ds['thetao'][...] = data
+
+        weights = np.arange(50.)
+        for op, axis, max_memory in (('sum', 0, 2**19), ('var', 0, 2**19),
+                                     ('kurt', (1, 2), 2**19),
+                                     ('kurt', 0, 2**19),
+                                     ('quantile(0.5)', 0, 2**22)):
+            for w in (None, weights):
+                reader = SlabReader(filename, 'thetao',
+                                    max_memory=max_memory)
+                tracemalloc.start()
+                try:
+                    partial = reader.partial(op, axis=axis, weights=w)
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                self.assertLessEqual(peak, max_memory, f"{op} {axis}")
+                if w is not None:
+                    continue
+                result = finalise(partial, op).squeeze()
+                if op == 'quantile(0.5)':
+                    expected = np.nanquantile(data.filled(np.nan), 0.5,
+                                              axis=axis, method='hazen')
+                else:
+                    expected = reference(op, data, axis)
+                np.testing.assert_allclose(result, expected, rtol=1e-5,
+                                           err_msg=f"{op} {axis}")
+
+    def test_break(self):
+        """Leaving a loop early stops the read-ahead thread."""
+        reader = SlabReader(self.filename, 'tas', max_memory=1)
+        slabs = iter(reader)
+        next(slabs)
+        slabs.close()
+        self.assertNotIn('activestorage-slab-reader',
+                         [thread.name for thread in threading.enumerate()])
+
+    def test_stats(self):
+        stats.collector().reset()
+        SlabReader(self.filename, 'tas', max_memory=2000).reduce('max')
+        request, = stats.collector().requests
+        self.assertEqual(request.route, 'stream')
+        self.assertEqual(request.elements, self.data.size)
+
+
+if __name__ == '__main__':
+    unittest.main()